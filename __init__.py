@@ -9,13 +9,14 @@ def get_logger():
 
     The logger uses a file handler with a standard log message format,
     suppresses duplicate handlers, and is intended for application-wide usage.
+    The log file is only opened when the first message is logged.
 
     Returns:
         logging.Logger: Configured logger for this application.
     """
     logger = getLogger("log.log")
     logger.setLevel(INFO)
-    file_handler = FileHandler("log.log")
+    file_handler = FileHandler("log.log", delay=True)
     file_handler.setLevel(INFO)
     formatter = Formatter(
         "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
@@ -40,13 +41,113 @@ def read_config():
     SIM_THRESHOLD = config.get("General", "SIM_THRESHOLD")
     LANG_CODES = config.get("General", "LANG_CODES").split(",")
     SBERT_MODEL_NAME = config.get("General", "SBERT_MODEL_NAME")
+    FETCH_CONCURRENCY = config.getint("General", "FETCH_CONCURRENCY",
+                                      fallback=8)
+    PAGE_STORE_DB = config.get("General", "PAGE_STORE_DB",
+                               fallback="page_store.db")
+    PAGE_STORE_TTL = config.getint("General", "PAGE_STORE_TTL",
+                                   fallback=86400)
+    PAGE_STORE_OFFLINE = config.getboolean("General", "PAGE_STORE_OFFLINE",
+                                           fallback=False)
+    HTML_BACKEND = config.get("General", "HTML_BACKEND", fallback="auto")
+    TRANSPORT = config.get("General", "TRANSPORT", fallback="live")
+    TRANSPORT_ARCHIVE = config.get("General", "TRANSPORT_ARCHIVE",
+                                   fallback="http_archive.db")
+    REPLAY_LATENCY = config.getfloat("General", "REPLAY_LATENCY",
+                                     fallback=0.0)
+    LEASE_SECONDS = config.getint("General", "LEASE_SECONDS", fallback=300)
+    EMBED_BATCH_SIZE = config.getint("General", "EMBED_BATCH_SIZE",
+                                     fallback=64)
+    PAGE_SCORE = config.get("General", "PAGE_SCORE", fallback="centroid")
+    PAGE_SCORE_TOP_K = config.getint("General", "PAGE_SCORE_TOP_K",
+                                     fallback=5)
+    EMBEDDING_DTYPE = config.get("General", "EMBEDDING_DTYPE",
+                                 fallback="float32")
+    RESCORE_FACTOR = config.getint("General", "RESCORE_FACTOR", fallback=4)
+    EMBEDDING_STORE_DIR = config.get("General", "EMBEDDING_STORE_DIR",
+                                     fallback="")
+    EMBEDDING_CACHE_DB = config.get("General", "EMBEDDING_CACHE_DB",
+                                    fallback="embedding_cache.db")
+    EMBEDDING_CACHE_SIZE = config.getint("General", "EMBEDDING_CACHE_SIZE",
+                                         fallback=10000)
+    ENCODER_BACKEND = config.get("General", "ENCODER_BACKEND",
+                                 fallback="torch")
+    ENCODER_THREADS = config.getint("General", "ENCODER_THREADS", fallback=0)
+    ENCODER_INTEROP_THREADS = config.getint("General",
+                                            "ENCODER_INTEROP_THREADS",
+                                            fallback=0)
+    ENCODER_QUANTIZATION = config.get("General", "ENCODER_QUANTIZATION",
+                                      fallback="avx2")
+    ENCODER_DIR = config.get("General", "ENCODER_DIR", fallback="models")
+    ENCODER_POOL_SIZE = config.getint("General", "ENCODER_POOL_SIZE",
+                                      fallback=0)
+    ENCODER_POOL_THREADS = config.getint("General", "ENCODER_POOL_THREADS",
+                                         fallback=0)
+    DB_SYNCHRONOUS = config.get("General", "DB_SYNCHRONOUS", fallback="NORMAL")
+    DB_MMAP_SIZE = config.getint("General", "DB_MMAP_SIZE",
+                                 fallback=268435456)
+    DB_CACHE_SIZE = config.getint("General", "DB_CACHE_SIZE", fallback=-65536)
+    DB_TEMP_STORE = config.get("General", "DB_TEMP_STORE", fallback="MEMORY")
+    BULK_WRITE_ROWS = config.getint("General", "BULK_WRITE_ROWS",
+                                    fallback=1000)
+    BULK_WRITE_MS = config.getfloat("General", "BULK_WRITE_MS", fallback=500)
+    READ_CHUNK_ROWS = config.getint("General", "READ_CHUNK_ROWS",
+                                    fallback=10000)
+    EXPORT_DIR = config.get("General", "EXPORT_DIR", fallback="export")
+    RRF_K = config.getint("General", "RRF_K", fallback=60)
+    ANN_INDEX = config.getboolean("General", "ANN_INDEX", fallback=True)
+    ANN_INDEX_DIR = config.get("General", "ANN_INDEX_DIR", fallback="")
+    ANN_MIN_ROWS = config.getint("General", "ANN_MIN_ROWS", fallback=100000)
+    ANN_M = config.getint("General", "ANN_M", fallback=16)
+    ANN_EF_CONSTRUCTION = config.getint("General", "ANN_EF_CONSTRUCTION",
+                                        fallback=200)
+    ANN_EF = config.getint("General", "ANN_EF", fallback=100)
 
     config_values = {
         "DB_NAME": DB_NAME,
         "SEED_PAGE_NAME": SEED_PAGE_NAME,
         "SIM_THRESHOLD": SIM_THRESHOLD,
         "LANG_CODES": LANG_CODES,
-        "SBERT_MODEL_NAME": SBERT_MODEL_NAME
+        "SBERT_MODEL_NAME": SBERT_MODEL_NAME,
+        "FETCH_CONCURRENCY": FETCH_CONCURRENCY,
+        "PAGE_STORE_DB": PAGE_STORE_DB,
+        "PAGE_STORE_TTL": PAGE_STORE_TTL,
+        "PAGE_STORE_OFFLINE": PAGE_STORE_OFFLINE,
+        "HTML_BACKEND": HTML_BACKEND,
+        "TRANSPORT": TRANSPORT,
+        "TRANSPORT_ARCHIVE": TRANSPORT_ARCHIVE,
+        "REPLAY_LATENCY": REPLAY_LATENCY,
+        "LEASE_SECONDS": LEASE_SECONDS,
+        "EMBED_BATCH_SIZE": EMBED_BATCH_SIZE,
+        "PAGE_SCORE": PAGE_SCORE,
+        "PAGE_SCORE_TOP_K": PAGE_SCORE_TOP_K,
+        "EMBEDDING_DTYPE": EMBEDDING_DTYPE,
+        "RESCORE_FACTOR": RESCORE_FACTOR,
+        "EMBEDDING_STORE_DIR": EMBEDDING_STORE_DIR,
+        "EMBEDDING_CACHE_DB": EMBEDDING_CACHE_DB,
+        "EMBEDDING_CACHE_SIZE": EMBEDDING_CACHE_SIZE,
+        "ENCODER_BACKEND": ENCODER_BACKEND,
+        "ENCODER_THREADS": ENCODER_THREADS,
+        "ENCODER_INTEROP_THREADS": ENCODER_INTEROP_THREADS,
+        "ENCODER_QUANTIZATION": ENCODER_QUANTIZATION,
+        "ENCODER_DIR": ENCODER_DIR,
+        "ENCODER_POOL_SIZE": ENCODER_POOL_SIZE,
+        "ENCODER_POOL_THREADS": ENCODER_POOL_THREADS,
+        "DB_SYNCHRONOUS": DB_SYNCHRONOUS,
+        "DB_MMAP_SIZE": DB_MMAP_SIZE,
+        "DB_CACHE_SIZE": DB_CACHE_SIZE,
+        "DB_TEMP_STORE": DB_TEMP_STORE,
+        "BULK_WRITE_ROWS": BULK_WRITE_ROWS,
+        "BULK_WRITE_MS": BULK_WRITE_MS,
+        "READ_CHUNK_ROWS": READ_CHUNK_ROWS,
+        "EXPORT_DIR": EXPORT_DIR,
+        "RRF_K": RRF_K,
+        "ANN_INDEX": ANN_INDEX,
+        "ANN_INDEX_DIR": ANN_INDEX_DIR,
+        "ANN_MIN_ROWS": ANN_MIN_ROWS,
+        "ANN_M": ANN_M,
+        "ANN_EF_CONSTRUCTION": ANN_EF_CONSTRUCTION,
+        "ANN_EF": ANN_EF
     }
     return config_values
 
@@ -56,11 +157,16 @@ def get_headers():
     Reads the access token, app name, and email from the '.env' file and
     returns a headers dictionary.
 
+    The access token is not required when the responses are replayed
+    (TRANSPORT = replay in config.ini).
+
     Returns:
         dict: A headers dictionary with Authorization and User-Agent keys
               for Wikipedia API requests.
     """
     env_vars = {**dotenv_values()}
+    if config["TRANSPORT"] == "replay":
+        return {"User-Agent": env_vars.get("APP_NAME", "wiki-graph")}
     ACCESS_TOKEN = env_vars["ACCESS_TOKEN"]
     APP_NAME = env_vars["APP_NAME"]
     EMAIL = env_vars["EMAIL"]
@@ -71,8 +177,17 @@ def get_headers():
     return headers
 
 
+def __getattr__(name):
+    """
+    Read the headers from the '.env' file on first use, so that importing
+    the package does not require the access token.
+    """
+    if name == "headers":
+        globals()["headers"] = get_headers()
+        return globals()["headers"]
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
 logger = get_logger()
 
 config = read_config()
-
-headers = get_headers()
@@ -0,0 +1,200 @@
+"""
+Approximate nearest-neighbour (HNSW) index of the paragraph embeddings.
+
+The embeddings of the corpus are indexed, keyed by paragraph id, in an
+hnswlib graph (cosine space) persisted in the directory ANN_INDEX_DIR (by
+default <DB_NAME>.hnsw next to the database):
+    - index.bin: the graph and the float32 vectors.
+    - deleted.npy: the ids marked deleted.
+    - meta.json: the greatest indexed id and the graph parameters.
+
+sync() brings the index up to date with the paragraph ids of the corpus,
+like EmbeddingStore.sync: the paragraphs inserted since the last sync are
+added to the graph, and the deleted ones are marked deleted, the searches
+skip them. The index is rebuilt when more than MAX_DELETED of it is
+deleted, or when the graph parameters change.
+
+The graph has ANN_M links per node and is built with ANN_EF_CONSTRUCTION
+candidates. A search explores ANN_EF candidates (at least k): the knob
+between recall and latency, see `python bench.py ann`. Unlike the embedding
+store, each process loads the whole index in memory.
+
+Needs `pip install hnswlib`.
+
+Usage:
+    index = AnnIndex()
+    index.sync(paragraph_ids, codes, scales)
+    scores, paragraph_ids = index.search(query_embedding, k)
+"""
+import json
+import os
+import numpy as np
+from __init__ import logger, config
+import db_utils as db
+from quantization import dequantize
+from embedding_store import lock_dir
+
+try:
+    import hnswlib
+except ImportError:
+    hnswlib = None
+
+
+ANN_INDEX = config["ANN_INDEX"]
+ANN_INDEX_DIR = config["ANN_INDEX_DIR"]
+ANN_MIN_ROWS = config["ANN_MIN_ROWS"]
+ANN_M = config["ANN_M"]
+ANN_EF_CONSTRUCTION = config["ANN_EF_CONSTRUCTION"]
+ANN_EF = config["ANN_EF"]
+
+# Fraction of deleted ids above which the index is rebuilt
+MAX_DELETED = 0.25
+# Rows added to the graph at a time
+ADD_ROWS = 65536
+
+
+def check_hnswlib():
+    if hnswlib is None:
+        raise ImportError('The ANN index needs hnswlib: pip install hnswlib')
+
+
+def use_ann_index(n_rows: int) -> bool:
+    """Whether to search a corpus of n_rows paragraphs with the index."""
+    return ANN_INDEX and hnswlib is not None and n_rows >= ANN_MIN_ROWS
+
+
+class AnnIndex:
+    """
+    HNSW index of the paragraph embeddings keyed by paragraph id.
+
+    - path (str): The directory of the index files.
+    - ef (int): Candidates explored by a search.
+    - m (int): Links per node of the graph.
+    - ef_construction (int): Candidates explored when adding a node.
+    """
+    def __init__(self, path: str = None, ef: int = ANN_EF, m: int = ANN_M,
+                 ef_construction: int = ANN_EF_CONSTRUCTION):
+        self.path = path or ANN_INDEX_DIR or f'{db.DB_NAME}.hnsw'
+        self.ef = ef
+        self.m = m
+        self.ef_construction = ef_construction
+        self.index = None
+        self.max_id = 0
+        self.deleted = np.empty(0, dtype=np.int64)
+
+    def _file(self, name: str) -> str:
+        return os.path.join(self.path, name)
+
+    def _params(self, dim: int) -> dict:
+        return {'space': 'cosine', 'dim': dim, 'M': self.m,
+                'ef_construction': self.ef_construction}
+
+    def _new(self, dim: int, n_rows: int):
+        """Start an empty index with room for n_rows."""
+        self.index = hnswlib.Index(space='cosine', dim=dim)
+        self.index.init_index(max_elements=max(n_rows, 1), M=self.m,
+                              ef_construction=self.ef_construction)
+        self.max_id = 0
+        self.deleted = np.empty(0, dtype=np.int64)
+
+    def _load(self, dim: int) -> bool:
+        """
+        Load the saved index.
+
+        Returns:
+            bool: False if there is no saved index with these parameters.
+        """
+        if not os.path.exists(self._file('meta.json')):
+            return False
+        with open(self._file('meta.json')) as f:
+            meta = json.load(f)
+        if meta['params'] != self._params(dim):
+            return False
+        self.index = hnswlib.Index(space='cosine', dim=dim)
+        self.index.load_index(self._file('index.bin'))
+        self.max_id = meta['max_id']
+        self.deleted = np.load(self._file('deleted.npy'))
+        return True
+
+    def _save(self, dim: int):
+        """Save the index, meta.json is replaced last."""
+        self.index.save_index(self._file('index.tmp.bin'))
+        os.replace(self._file('index.tmp.bin'), self._file('index.bin'))
+        np.save(self._file('deleted.tmp.npy'), self.deleted)
+        os.replace(self._file('deleted.tmp.npy'), self._file('deleted.npy'))
+        with open(self._file('meta.tmp.json'), 'w') as f:
+            json.dump({'max_id': self.max_id,
+                       'params': self._params(dim)}, f)
+        os.replace(self._file('meta.tmp.json'), self._file('meta.json'))
+
+    def _add(self, paragraph_ids: np.ndarray, codes: np.ndarray,
+             scales: np.ndarray, start: int):
+        """Add the rows from start on to the graph, one chunk at a time."""
+        n = len(paragraph_ids) - start
+        capacity = self.index.get_current_count() + n
+        if capacity > self.index.get_max_elements():
+            self.index.resize_index(capacity)
+        for i in range(start, len(paragraph_ids), ADD_ROWS):
+            j = i + ADD_ROWS
+            self.index.add_items(
+                dequantize(codes[i:j], None if scales is None
+                           else scales[i:j]),
+                paragraph_ids[i:j])
+            logger.info(f'Indexed {min(j, len(paragraph_ids)) - start}/{n} '
+                        f'embeddings')
+        self.max_id = int(paragraph_ids[-1])
+
+    def sync(self, paragraph_ids, codes: np.ndarray,
+             scales: np.ndarray = None):
+        """
+        Bring the index up to date with the corpus and load it.
+
+        Args:
+            paragraph_ids: The ascending ids of the corpus paragraphs.
+            codes (np.ndarray): Their embeddings, in their stored format.
+            scales (np.ndarray): The per-row scales of int8 embeddings.
+        """
+        check_hnswlib()
+        paragraph_ids = np.asarray(paragraph_ids, dtype=np.int64)
+        dim = codes.shape[1]
+        with lock_dir(self.path):
+            changed = False
+            if not self._load(dim):
+                self._new(dim, len(paragraph_ids))
+                changed = True
+            # ids above the corpus were added by a process with a newer one
+            labels = np.array(self.index.get_ids_list(), dtype=np.int64)
+            max_id = int(paragraph_ids[-1]) if len(paragraph_ids) else 0
+            deleted = np.setdiff1d(labels[labels <= max_id], paragraph_ids)
+            deleted = np.setdiff1d(deleted, self.deleted)
+            for paragraph_id in deleted:
+                self.index.mark_deleted(int(paragraph_id))
+            if len(deleted):
+                self.deleted = np.union1d(self.deleted, deleted)
+                changed = True
+                logger.info(f'Deleted {len(deleted)} embeddings from the '
+                            f'ANN index')
+            if len(self.deleted) > MAX_DELETED * len(labels):
+                self._new(dim, len(paragraph_ids))
+            start = np.searchsorted(paragraph_ids, self.max_id, side='right')
+            if start < len(paragraph_ids):
+                self._add(paragraph_ids, codes, scales, start)
+                changed = True
+            if changed:
+                self._save(dim)
+        logger.info(f'Loaded the ANN index {self.path} with '
+                    f'{self.index.get_current_count() - len(self.deleted)} '
+                    f'embeddings')
+
+    def search(self, query: np.ndarray, k: int) -> tuple:
+        """
+        Return the (scores, paragraph ids) of the k paragraphs most similar
+        to a query, by approximate cosine similarity, descending.
+        """
+        k = min(k, self.index.get_current_count() - len(self.deleted))
+        if k <= 0:
+            return np.empty(0, dtype=np.float32), np.empty(0, dtype=np.int64)
+        self.index.set_ef(max(self.ef, k))
+        labels, distances = self.index.knn_query(
+            np.asarray(query, dtype=np.float32).reshape(1, -1), k=k)
+        return 1 - distances[0], labels[0].astype(np.int64)
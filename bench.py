@@ -0,0 +1,325 @@
+"""
+wiki-graph benchmarks.
+
+Usage:
+    python bench.py extract --lang-code en --limit 200
+    python bench.py extract --files data/London.html data/Paris.html
+    python bench.py pipeline --max-pages 5 --max-new-pages 5 --profile out.prof
+    python bench.py quantization --k 10 --queries 200
+    python bench.py encoder --backends torch onnx onnx-int8 --threads 4
+    python bench.py writes --rows 20000
+    python bench.py ann --k 10 --queries 200 --ef 16 32 64 128 256
+
+Run the pipeline benchmark with TRANSPORT = replay in config.ini to profile
+against a recorded crawl instead of live Wikipedia.
+"""
+import argparse
+import cProfile
+import time
+from __init__ import logger
+
+
+def bench_extract(args):
+    """
+    Time every installed HTML extraction backend against the bs4 reference
+    on the same html, and check that they extract the same content.
+
+    The html is read from the given files or from the page store.
+    """
+    from extract import extract_page, available_backends
+    from page_store import PageStore
+
+    if args.files:
+        htmls = []
+        for path in args.files:
+            with open(path, encoding='utf-8') as f:
+                htmls.append(f.read())
+    else:
+        htmls = [html for _, _, html in PageStore().iter_pages(
+            lang_code=args.lang_code, limit=args.limit)]
+    if not htmls:
+        raise SystemExit('No html to benchmark')
+    print(f'{len(htmls)} pages, '
+          f'{sum(map(len, htmls)) / 1e6:.1f} M characters')
+
+    reference = [extract_page(html, 'bs4') for html in htmls]
+    timings = {}
+    backends = ['bs4'] + [b for b in available_backends() if b != 'bs4']
+    for backend in backends:
+        start = time.perf_counter()
+        for _ in range(args.repeat):
+            extracted = [extract_page(html, backend) for html in htmls]
+        elapsed = (time.perf_counter() - start) / args.repeat
+        timings[backend] = elapsed
+        same = all(
+            e.paragraphs == r.paragraphs
+            and set(e.internal_page_names) == set(r.internal_page_names)
+            and e.shortdescription == r.shortdescription
+            for e, r in zip(extracted, reference)
+            )
+        print(f'{backend:<12} {elapsed * 1000 / len(htmls):8.2f} ms/page  '
+              f'{timings["bs4"] / elapsed:5.1f}x  '
+              f'same output: {same}')
+    logger.info(f'Extraction benchmark: {timings}')
+
+
+def bench_pipeline(args):
+    """
+    Time the crawl, corpus build and page links build stages,
+    optionally under cProfile.
+    """
+    from wiki_graph import CorpusManager, Crawler, PagesGraph
+    from encoder import get_cache
+    import db_utils as db
+
+    db.create_tables()
+    crawler = Crawler(max_pages=args.max_pages,
+                      max_new_pages=args.max_new_pages)
+    stages = {
+        'crawl': crawler.crawl,
+        'corpus_build': CorpusManager()._build,
+        'page_links_build': PagesGraph().build_page_links,
+        }
+    profiler = cProfile.Profile() if args.profile else None
+    timings = {}
+    for name, stage in stages.items():
+        start = time.perf_counter()
+        if profiler:
+            profiler.runcall(stage)
+        else:
+            stage()
+        timings[name] = time.perf_counter() - start
+        print(f'{name:<18} {timings[name]:8.2f} s')
+    cache = get_cache().get_info()
+    print(f'embedding cache    {cache["hits"]} hits, {cache["misses"]} misses')
+    if profiler:
+        profiler.dump_stats(args.profile)
+        print(f'Profile written to {args.profile}')
+    logger.info(f'Pipeline benchmark: {timings}')
+
+
+def bench_quantization(args):
+    """
+    Compare the search on float16 and int8 embeddings with the exact float32
+    search: recall@k, with and without float32 rescoring, memory and time
+    per query. The rescoring reads the float32 embeddings of the candidates
+    from an embedding store sidecar, as the corpus search does. Stored
+    paragraph embeddings are used as queries.
+    """
+    import tempfile
+    import numpy as np
+    import db_utils as db
+    import quantization as q
+    from embedding_store import EmbeddingStore
+
+    with db.paragraph_embeddings_chunks() as (n_rows, chunks):
+        exact, _ = q.load_matrix_chunks(n_rows, chunks, 'float32')
+    rng = np.random.default_rng(0)
+    queries = exact[rng.choice(len(exact), min(args.queries, len(exact)),
+                               replace=False)]
+    k = min(args.k, len(exact))
+    truth = [set(q.search(exact, None, query, k)[1]) for query in queries]
+    print(f'{len(exact)} embeddings, {len(queries)} queries, k={k}, '
+          f'rescore factor {args.rescore_factor}')
+    with tempfile.TemporaryDirectory() as tmp:
+        store = EmbeddingStore(tmp)
+        ids = np.arange(1, len(exact) + 1)
+        store.append_exact(ids, exact)
+        for dtype in q.EMBEDDING_DTYPES:
+            codes, scales = q.quantize(exact, dtype)
+            nbytes = codes.nbytes + (scales.nbytes if scales is not None
+                                     else 0)
+            recall = recall_rescored = 0
+            start = time.perf_counter()
+            for query, relevant in zip(queries, truth):
+                _, indices = q.search(codes, scales, query, k)
+                recall += len(relevant & set(indices)) / k
+            elapsed = time.perf_counter() - start
+            start = time.perf_counter()
+            for query, relevant in zip(queries, truth):
+                _, candidates = q.search(codes, scales, query,
+                                         k * args.rescore_factor)
+                _, indices = q.rescore(query, candidates,
+                                       store.exact_rows(ids[candidates]), k)
+                recall_rescored += len(relevant & set(indices)) / k
+            elapsed_rescored = time.perf_counter() - start
+            print(f'{dtype:<8} {nbytes / 2**20:8.1f} MiB  '
+                  f'{elapsed * 1000 / len(queries):7.2f} ms/query  '
+                  f'recall@{k} {recall / len(queries):.3f}  '
+                  f'rescored {elapsed_rescored * 1000 / len(queries):7.2f} '
+                  f'ms/query  recall@{k} '
+                  f'{recall_rescored / len(queries):.3f}')
+
+
+def bench_encoder(args):
+    """
+    Compare the throughput of the encoder backends on the corpus paragraphs,
+    and check that their embeddings are within tolerance of the torch ones.
+    """
+    import db_utils as db
+    from encoder import check_compatibility, cosine_distances, load_encoder
+
+    texts = [text for _, _, _, text, _, _ in db.get_paragraph_corpus()]
+    texts = texts[:args.limit]
+    if not texts:
+        raise SystemExit('No paragraphs to benchmark')
+    print(f'{len(texts)} paragraphs, batch size {args.batch_size}, '
+          f'threads {args.threads or "default"}/'
+          f'{args.interop_threads or "default"}')
+    backends = ['torch'] + [b for b in args.backends if b != 'torch']
+    reference = None
+    for backend in backends:
+        model = load_encoder(backend, args.threads, args.interop_threads)
+        model.encode(texts[:args.batch_size], batch_size=args.batch_size)
+        start = time.perf_counter()
+        embeddings = model.encode(texts, batch_size=args.batch_size)
+        elapsed = time.perf_counter() - start
+        if reference is None:
+            reference, torch_elapsed = embeddings, elapsed
+        distance = cosine_distances(reference, embeddings).max()
+        compatible = check_compatibility(reference, embeddings, backend)
+        print(f'{backend:<10} {len(texts) / elapsed:8.1f} paragraphs/s  '
+              f'{torch_elapsed / elapsed:5.2f}x  '
+              f'max cosine distance {distance:.1e}  '
+              f'compatible: {compatible}')
+
+
+def bench_writes(args):
+    """
+    Compare the insert throughput of page links written one row per
+    transaction with the BulkWriter, on a temporary database.
+    """
+    import os
+    import tempfile
+    import db_utils as db
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db.DB_NAME = os.path.join(tmp, 'bench.db')
+        db.create_tables()
+        rows = [(i, i + 1) for i in range(args.rows)]
+        start = time.perf_counter()
+        for source_page_id, target_page_id in rows:
+            db.insert_page_link(source_page_id, target_page_id)
+        single = args.rows / (time.perf_counter() - start)
+        with db.get_cursor() as cur:
+            cur.execute("DELETE FROM page_links")
+        start = time.perf_counter()
+        with db.BulkWriter(db.PAGE_LINK_INSERT, max_rows=args.max_rows) \
+                as writer:
+            for row in rows:
+                writer.add(row)
+        bulk = args.rows / (time.perf_counter() - start)
+        db.close_connection()
+    print(f'{args.rows} page links')
+    print(f'{"single":<8} {single:10.0f} rows/s')
+    print(f'{"bulk":<8} {bulk:10.0f} rows/s  {bulk / single:5.1f}x')
+
+
+def bench_ann(args):
+    """
+    Compare the HNSW index search with the exact search: build time,
+    recall@k and time per query for each ef. Stored paragraph embeddings
+    (or --random ones) are indexed, in a temporary directory, and used as
+    queries.
+    """
+    import tempfile
+    import numpy as np
+    import db_utils as db
+    import quantization as q
+    from ann_index import AnnIndex
+
+    if args.random:
+        # in clusters of about 100, like the paragraphs of related pages;
+        # uniformly random embeddings have no near neighbours to find
+        rng = np.random.default_rng(0)
+        centers = rng.normal(size=(max(1, args.random // 100), args.dim))
+        exact = centers[rng.integers(len(centers), size=args.random)]
+        exact += rng.normal(scale=0.5, size=exact.shape)
+        exact = exact.astype(np.float32)
+    else:
+        with db.paragraph_embeddings_chunks() as (n_rows, chunks):
+            exact, _ = q.load_matrix_chunks(n_rows, chunks, 'float32')
+    rng = np.random.default_rng(0)
+    queries = exact[rng.choice(len(exact), min(args.queries, len(exact)),
+                               replace=False)]
+    k = min(args.k, len(exact))
+    start = time.perf_counter()
+    truth = [set(q.search(exact, None, query, k)[1] + 1)
+             for query in queries]
+    elapsed = time.perf_counter() - start
+    print(f'{len(exact)} embeddings, {len(queries)} queries, k={k}')
+    print(f'{"exact":<8} {elapsed * 1000 / len(queries):7.2f} ms/query')
+    with tempfile.TemporaryDirectory() as tmp:
+        index = AnnIndex(path=tmp)
+        start = time.perf_counter()
+        index.sync(np.arange(1, len(exact) + 1), exact)
+        print(f'built in {time.perf_counter() - start:.1f} s '
+              f'(M={index.m}, ef_construction={index.ef_construction})')
+        for ef in args.ef:
+            index.ef = ef
+            recall = 0
+            start = time.perf_counter()
+            for query, relevant in zip(queries, truth):
+                _, ids = index.search(query, k)
+                recall += len(relevant & set(ids)) / k
+            elapsed = time.perf_counter() - start
+            print(f'ef={ef:<5} {elapsed * 1000 / len(queries):7.2f} '
+                  f'ms/query  recall@{k} {recall / len(queries):.3f}')
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    sub = ap.add_subparsers(dest='command', required=True)
+
+    ap_extract = sub.add_parser('extract', help=bench_extract.__doc__)
+    ap_extract.add_argument('--files', nargs='*')
+    ap_extract.add_argument('--lang-code', default=None)
+    ap_extract.add_argument('--limit', type=int, default=200)
+    ap_extract.add_argument('--repeat', type=int, default=3)
+    ap_extract.set_defaults(func=bench_extract)
+
+    ap_pipeline = sub.add_parser('pipeline', help=bench_pipeline.__doc__)
+    ap_pipeline.add_argument('--max-pages', type=int, default=5,
+                             help='New pages crawled at most')
+    ap_pipeline.add_argument('--max-new-pages', type=int, default=5,
+                             help='Frontier pages claimed at a time')
+    ap_pipeline.add_argument('--profile', default=None)
+    ap_pipeline.set_defaults(func=bench_pipeline)
+
+    ap_quantization = sub.add_parser('quantization',
+                                     help=bench_quantization.__doc__)
+    ap_quantization.add_argument('--k', type=int, default=10)
+    ap_quantization.add_argument('--queries', type=int, default=200)
+    ap_quantization.add_argument('--rescore-factor', type=int, default=4)
+    ap_quantization.set_defaults(func=bench_quantization)
+
+    ap_encoder = sub.add_parser('encoder', help=bench_encoder.__doc__)
+    ap_encoder.add_argument('--backends', nargs='*',
+                            default=['torch', 'onnx', 'onnx-int8'])
+    ap_encoder.add_argument('--limit', type=int, default=2000)
+    ap_encoder.add_argument('--batch-size', type=int, default=64)
+    ap_encoder.add_argument('--threads', type=int, default=0)
+    ap_encoder.add_argument('--interop-threads', type=int, default=0)
+    ap_encoder.set_defaults(func=bench_encoder)
+
+    ap_writes = sub.add_parser('writes', help=bench_writes.__doc__)
+    ap_writes.add_argument('--rows', type=int, default=20000)
+    ap_writes.add_argument('--max-rows', type=int, default=1000)
+    ap_writes.set_defaults(func=bench_writes)
+
+    ap_ann = sub.add_parser('ann', help=bench_ann.__doc__)
+    ap_ann.add_argument('--k', type=int, default=10)
+    ap_ann.add_argument('--queries', type=int, default=200)
+    ap_ann.add_argument('--ef', type=int, nargs='*',
+                        default=[16, 32, 64, 128, 256])
+    ap_ann.add_argument('--random', type=int, default=0,
+                        help='Index this many random embeddings instead')
+    ap_ann.add_argument('--dim', type=int, default=384)
+    ap_ann.set_defaults(func=bench_ann)
+
+    args = ap.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
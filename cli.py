@@ -1,27 +1,177 @@
 """wiki-graph CLI."""
 
 import argparse
+import multiprocessing
+import sys
+import time
+from contextlib import contextmanager
 from __init__ import logger
-from wiki_graph import CorpusManager, Crawler, PagesGraph
-import db_utils as db
 
 
-def main():
+COMMANDS = ['info', 'crawl', 'embed', 'graph', 'search', 'quantize',
+            'export', 'run']
+
+
+@contextmanager
+def timed_imports(command: str):
+    """Measure and report the import time of a command."""
+    start = time.perf_counter()
+    yield
+    elapsed = time.perf_counter() - start
+    logger.info(f'{command}: imports took {elapsed:.2f} s')
+    print(f'{command}: imports took {elapsed:.2f} s', file=sys.stderr)
+
+
+def log_cache_info():
     """
-    Main function to build the corpus.
+    Log the counters of the embedding caches used by the model or the
+    encoder pools of this process.
+    """
+    from encoder import get_caches
+    for cache in get_caches():
+        cache.get_info()
 
-    Usage:
-        python cli.py --runs 10 --max-pages 10 --max-new-pages 10
+
+def crawl_worker(runs: int, max_pages: int, max_new_pages: int):
+    """Crawl worker process: run the crawler `runs` times."""
+    from wiki_graph import Crawler
+
+    for n in range(runs):
+        logger.info(f'Worker run {n}')
+        try:
+            crawler = Crawler(max_pages=max_pages,
+                              max_new_pages=max_new_pages)
+            crawler.crawl()
+        except Exception as e:
+            logger.warning(str(e))
+
+
+def crawl_workers(workers: int, runs: int, max_pages: int,
+                  max_new_pages: int):
     """
-    logger.info('Starting main...')
-    ap = argparse.ArgumentParser()
-    ap.add_argument("--runs", type=int, required=True, default=5)
-    ap.add_argument("--max-pages", type=int, required=True, default=5)
-    ap.add_argument("--max-new-pages", type=int, required=True, default=5)
-    args = ap.parse_args()
+    Run the crawl in several worker processes.
+    The workers share the work through the leases table.
+    """
+    ctx = multiprocessing.get_context('spawn')
+    processes = [ctx.Process(target=crawl_worker,
+                             args=(runs, max_pages, max_new_pages))
+                 for _ in range(workers)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+
+
+def info(args):
+    """Show the number of rows per table."""
+    with timed_imports('info'):
+        import db_utils as db
+    db.create_tables()
+    for table, count in db.get_db_info().items():
+        print(f'{table:<20} {count}')
+
+
+def crawl(args):
+    """Crawl the pages similar to the seed page."""
+    with timed_imports('crawl'):
+        import db_utils as db
+        from wiki_graph import Recrawler
+    db.create_tables()
+    db.get_db_info()
+    if args.recrawl_days is not None:
+        Recrawler(max_age_days=args.recrawl_days).recrawl()
+    if args.workers > 1:
+        crawl_workers(args.workers, args.runs, args.max_pages,
+                      args.max_new_pages)
+    else:
+        crawl_worker(args.runs, args.max_pages, args.max_new_pages)
+    log_cache_info()
+
+
+def embed(args):
+    """Download and embed the paragraphs of the pages not in the corpus."""
+    with timed_imports('embed'):
+        import db_utils as db
+        from wiki_graph import CorpusManager
+    db.create_tables()
+    cm = CorpusManager()
+    if args.pool_size is not None:
+        cm.pool_size = args.pool_size
+    cm._build()
+    log_cache_info()
+
+
+def graph(args):
+    """Build the page links and draw the graph."""
+    with timed_imports('graph'):
+        import db_utils as db
+        from wiki_graph import PagesGraph
+    db.create_tables()
+    PagesGraph(lang_code=args.lang_code).load()
+
+
+def search(args):
+    """Search the corpus for the paragraphs or pages similar to a query."""
+    with timed_imports('search'):
+        from wiki_graph import CorpusManager
+    cm = CorpusManager()
+    cm.load(build=False)
+    if args.pages:
+        df = cm.similarity_by_pages(args.query, top_k_min=args.top_k,
+                                    mode=args.mode)
+    else:
+        df = cm.similarity_by_paragraphs(args.query, top_k_min=args.top_k,
+                                         mode=args.mode)
+    print(df.head(args.limit).to_string())
+    log_cache_info()
+
+
+def quantize(args):
+    """Convert the stored embeddings to another format and vacuum the db."""
+    with timed_imports('quantize'):
+        import db_utils as db
+        from embedding_store import EmbeddingStore
+    db.create_tables()
+    n = EmbeddingStore().quantize(args.dtype)
+    print(f'Converted {n} embeddings to {args.dtype}')
+    db.vacuum()
+
+
+def export(args):
+    """Export the tables to Parquet datasets partitioned by lang_code."""
+    with timed_imports('export'):
+        import db_utils as db
+        from export import EXPORT_DIR, export_tables
+    db.create_tables()
+    exported = export_tables(full=args.full, path=args.dir or EXPORT_DIR)
+    for table, n_rows in exported.items():
+        print(f'{table:<20} {n_rows} rows')
+
+
+def run(args):
+    """Crawl, build the corpus and the graph, `runs` times."""
+    with timed_imports('run'):
+        import db_utils as db
+        from wiki_graph import CorpusManager, Crawler, PagesGraph, Recrawler
     logger.info(f'Runs: {args.runs}, max_pages: {args.max_pages}, '
                 f'max_new_pages: {args.max_new_pages}')
 
+    if args.recrawl_days is not None:
+        db.create_tables()
+        Recrawler(max_age_days=args.recrawl_days).recrawl()
+
+    if args.workers > 1:
+        db.create_tables()
+        db.get_db_info()
+        crawl_workers(args.workers, args.runs, args.max_pages,
+                      args.max_new_pages)
+        cm = CorpusManager()
+        cm.load()
+        pg = PagesGraph()
+        pg.load()
+        log_cache_info()
+        return
+
     for n in range(args.runs):
         logger.info(f'Run {n}')
         try:
@@ -37,6 +187,99 @@ def main():
 
         except Exception as e:
             logger.warning(str(e))
+    log_cache_info()
+
+
+def add_crawl_arguments(ap: argparse.ArgumentParser):
+    ap.add_argument("--runs", type=int, required=True, default=5)
+    ap.add_argument("--max-pages", type=int, required=True, default=5,
+                    help="New pages crawled per run at most")
+    ap.add_argument("--max-new-pages", type=int, required=True, default=5,
+                    help="Frontier pages claimed and downloaded at a time")
+    ap.add_argument("--recrawl-days", type=int, default=None,
+                    help="Refresh the pages crawled more than N days ago")
+    ap.add_argument("--workers", type=int, default=1,
+                    help="Number of crawl worker processes")
+
+
+def main():
+    """
+    Main function to build the corpus.
+
+    Each command imports only the modules it needs; the SBERT model is
+    loaded only by the commands that encode text.
+
+    Usage:
+        python cli.py info
+        python cli.py crawl --runs 10 --max-pages 10 --max-new-pages 10
+        python cli.py crawl --runs 10 --max-pages 10 --max-new-pages 10 \
+            --workers 4
+        python cli.py embed --pool-size 8
+        python cli.py graph
+        python cli.py search "river bridges" --pages
+        python cli.py search "Tower Bridge" --mode hybrid
+        python cli.py quantize --dtype int8
+        python cli.py export --full
+        python cli.py run --runs 10 --max-pages 10 --max-new-pages 10 \
+            --recrawl-days 30
+
+    Without a command, the arguments are those of `run`:
+        python cli.py --runs 10 --max-pages 10 --max-new-pages 10
+    """
+    logger.info('Starting main...')
+    ap = argparse.ArgumentParser()
+    sub = ap.add_subparsers(dest='command', required=True)
+
+    sub.add_parser('info', help=info.__doc__).set_defaults(func=info)
+
+    ap_crawl = sub.add_parser('crawl', help=crawl.__doc__)
+    add_crawl_arguments(ap_crawl)
+    ap_crawl.set_defaults(func=crawl)
+
+    ap_embed = sub.add_parser('embed', help=embed.__doc__)
+    ap_embed.add_argument("--pool-size", type=int, default=None,
+                          help="Number of encoder processes "
+                               "(ENCODER_POOL_SIZE in config.ini)")
+    ap_embed.set_defaults(func=embed)
+
+    ap_graph = sub.add_parser('graph', help=graph.__doc__)
+    ap_graph.add_argument("--lang-code", default='en')
+    ap_graph.set_defaults(func=graph)
+
+    ap_search = sub.add_parser('search', help=search.__doc__)
+    ap_search.add_argument("query")
+    ap_search.add_argument("--pages", action="store_true",
+                           help="Group the results by page")
+    ap_search.add_argument("--mode", default='dense',
+                           choices=['dense', 'text', 'hybrid'],
+                           help="Search by embedding similarity, by BM25 "
+                                "full-text relevance, or both fused")
+    ap_search.add_argument("--top-k", type=int, default=100)
+    ap_search.add_argument("--limit", type=int, default=20)
+    ap_search.set_defaults(func=search)
+
+    ap_quantize = sub.add_parser('quantize', help=quantize.__doc__)
+    ap_quantize.add_argument("--dtype", required=True,
+                             choices=['float32', 'float16', 'int8'])
+    ap_quantize.set_defaults(func=quantize)
+
+    ap_export = sub.add_parser('export', help=export.__doc__)
+    ap_export.add_argument("--full", action="store_true",
+                           help="Rewrite the datasets instead of appending "
+                                "the new rows")
+    ap_export.add_argument("--dir", default=None,
+                           help="Export directory (EXPORT_DIR in config.ini)")
+    ap_export.set_defaults(func=export)
+
+    ap_run = sub.add_parser('run', help=run.__doc__)
+    add_crawl_arguments(ap_run)
+    ap_run.set_defaults(func=run)
+
+    argv = sys.argv[1:]
+    if argv and argv[0] not in COMMANDS and argv[0] not in ('-h', '--help'):
+        argv = ['run'] + argv
+    args = ap.parse_args(argv)
+    args.func(args)
     logger.info('Finished main')
 
 
@@ -5,116 +5,552 @@ Functionality includes:
     - Database and table creation
     - Selection and insertion of data:
         - Pages, autonyms, page links, paragraphs and embeddings).
+    - The crawl frontier (discovered but not yet fetched page names).
+    - The known canonical titles and the redirects cache.
+    - Leases of work items (frontier page names, pages) to crawl workers.
+    - Buffered bulk writes of many rows (BulkWriter).
+    - Versioned schema migrations (MIGRATIONS), see create_tables.
+    - Chunked reads of large queries (read_chunks and the *_chunks readers).
+    - Full-text search of the paragraphs (paragraph_fts, an FTS5 index).
+
+All the helpers go through get_cursor(), on one connection per thread (and
+per process), opened once with the DB_PRAGMAS: WAL journal mode, so that
+readers do not block the writer, and the synchronous, mmap_size, cache_size
+and temp_store settings of config.ini.
 """
+import atexit
+import os
+import re
 import sqlite3
+import threading
+import time
+from contextlib import contextmanager
 from datetime import datetime
 from __init__ import logger, config
+from titles import canonical_title, html_url
 
 
 DB_NAME = config['DB_NAME']
+# Seconds to wait for the write lock held by other workers
+DB_TIMEOUT = 60
+DB_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': config['DB_SYNCHRONOUS'],
+    'mmap_size': config['DB_MMAP_SIZE'],
+    'cache_size': config['DB_CACHE_SIZE'],
+    'temp_store': config['DB_TEMP_STORE'],
+    }
+# Rows buffered by a BulkWriter, and milliseconds between its flushes
+BULK_WRITE_ROWS = config['BULK_WRITE_ROWS']
+BULK_WRITE_MS = config['BULK_WRITE_MS']
+# Rows fetched at a time by the chunked readers
+READ_CHUNK_ROWS = config['READ_CHUNK_ROWS']
 current_datetime_str = datetime.now().strftime('%Y-%m-%d')
 
+# The connection of the current thread, see get_connection
+_local = threading.local()
 
-def create_tables():
-    """Create the database using the DB_NAME from .env and the tables."""
-    # Create a connection to a database file (will create if it doesn"t exist)
-    conn = sqlite3.connect(DB_NAME)
-    logger.info(f"Connected to {DB_NAME}")
 
-    # Create a cursor object to execute SQL commands
+# connections
+
+def connect() -> sqlite3.Connection:
+    """
+    Open a connection to DB_NAME with the DB_PRAGMAS and the SQL functions
+    used by the queries (canonical_title, html_url).
+    """
+    conn = sqlite3.connect(DB_NAME, timeout=DB_TIMEOUT)
+    for pragma, value in DB_PRAGMAS.items():
+        conn.execute(f"PRAGMA {pragma} = {value}")
+    conn.create_function("canonical_title", 1, canonical_title,
+                         deterministic=True)
+    conn.create_function("html_url", 2, html_url, deterministic=True)
+    return conn
+
+
+def get_connection() -> sqlite3.Connection:
+    """
+    Return the connection of the current thread, opened on first use.
+
+    A forked process does not use the connection of its parent, it opens its
+    own.
+    """
+    conn = getattr(_local, 'conn', None)
+    if conn is not None and _local.pid != os.getpid():
+        conn = None
+    if conn is not None and _local.db_name != DB_NAME:
+        close_connection()
+        conn = None
+    if conn is None:
+        conn = connect()
+        _local.conn, _local.pid, _local.db_name = conn, os.getpid(), DB_NAME
+    return conn
+
+
+def close_connection():
+    """Close the connection of the current thread, if any."""
+    conn = getattr(_local, 'conn', None)
+    if conn is not None and _local.pid == os.getpid():
+        conn.close()
+    _local.conn = None
+
+
+atexit.register(close_connection)
+
+
+@contextmanager
+def get_cursor():
+    """
+    Yield a cursor on the connection of the current thread.
+
+    The transaction is committed when the block exits, or rolled back if it
+    raises, and the cursor is closed.
+
+    Usage:
+        with get_cursor() as cur:
+            cur.execute(...)
+    """
+    conn = get_connection()
     cur = conn.cursor()
+    try:
+        yield cur
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+    finally:
+        cur.close()
+
+
+@contextmanager
+def read_chunks(sql: str, params: tuple = (),
+                chunk_size: int = READ_CHUNK_ROWS):
+    """
+    Read the rows of a query in chunks, with their count.
+
+    The rows are counted with COUNT(*) and read in the same read
+    transaction, so that the count matches the rows: consumers can
+    preallocate their arrays and fill them in place, one chunk of
+    fetchmany rows at a time. The transaction runs on a connection of its
+    own, so that the thread can write meanwhile (e.g. through a
+    BulkWriter): with WAL, the reader keeps its snapshot of the database
+    and does not see the writes committed after it started.
+
+    Yields:
+        tuple: (n_rows, chunks), chunks is an iterator of lists of at most
+        chunk_size rows.
+
+    Usage:
+        with read_chunks(sql, params) as (n_rows, chunks):
+            for rows in chunks:
+                ...
+    """
+    conn = connect()
+    try:
+        cur = conn.cursor()
+        cur.execute("BEGIN")
+        cur.execute(f"SELECT COUNT(*) FROM ({sql})", params)
+        n_rows = cur.fetchone()[0]
+        cur.execute(sql, params)
+        yield n_rows, iter(lambda: cur.fetchmany(chunk_size), [])
+    finally:
+        conn.close()
+
+
+class BulkWriter:
+    """
+    Buffer the rows of an INSERT or UPDATE statement and write them with
+    executemany, in one transaction, every max_rows rows or every max_ms
+    milliseconds (checked when a row is added), and on exit.
+
+    - sql (str): The statement, e.g. PAGE_LINK_INSERT.
+    - max_rows (int): Number of rows buffered before a flush.
+    - max_ms (float): Milliseconds between flushes.
+    - n_rows (int): Number of rows written.
+    - write_seconds (float): Time spent writing.
+
+    Usage:
+        with BulkWriter(PAGE_LINK_INSERT) as writer:
+            writer.add((source_page_id, target_page_id))
+    """
+    def __init__(self, sql: str, max_rows: int = BULK_WRITE_ROWS,
+                 max_ms: float = BULK_WRITE_MS):
+        self.sql = sql
+        self.max_rows = max_rows
+        self.max_ms = max_ms
+        self.rows = []
+        self.n_rows = 0
+        self.write_seconds = 0.0
+        self.last_flush = time.perf_counter()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def add(self, row: tuple):
+        """Buffer a row."""
+        self.rows.append(row)
+        self._maybe_flush()
+
+    def add_many(self, rows: list):
+        """Buffer many rows."""
+        self.rows.extend(rows)
+        self._maybe_flush()
+
+    def _maybe_flush(self):
+        elapsed_ms = (time.perf_counter() - self.last_flush) * 1000
+        if len(self.rows) >= self.max_rows or elapsed_ms >= self.max_ms:
+            self.flush()
+
+    def flush(self):
+        """Write the buffered rows in one transaction."""
+        if self.rows:
+            start = time.perf_counter()
+            with get_cursor() as cur:
+                cur.executemany(self.sql, self.rows)
+            self.write_seconds += time.perf_counter() - start
+            self.n_rows += len(self.rows)
+            self.rows = []
+        self.last_flush = time.perf_counter()
+
+    def close(self):
+        """Write the remaining rows and log the write throughput."""
+        self.flush()
+        if self.n_rows:
+            rate = self.n_rows / self.write_seconds if self.write_seconds \
+                else 0.0
+            table = re.search(r"(?:INTO|UPDATE)\s+(\w+)", self.sql).group(1)
+            logger.info(f"Wrote {self.n_rows} rows to {table} "
+                        f"at {rate:.0f} rows/sec")
+
+
+def create_tables():
+    """
+    Create the database using the DB_NAME from .env and the tables,
+    and bring the schema up to date with migrate().
+    """
+    # The connection creates the database file if it doesn't exist
+    with get_cursor() as cur:
+        logger.info(f"Connected to {DB_NAME}")
+
+        # Create a pages table
+        cur.execute(
+            """
+            CREATE TABLE IF NOT EXISTS pages (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                name TEXT,
+                lang_code TEXT,
+                url TEXT,
+                crawled_at TEXT,
+                sim_score REAL,
+                UNIQUE(url)
+                )
+            """
+            )
+
+        # Create a paragraph corpus table (paragraph text + embedding)
+        cur.execute(
+            """
+            CREATE TABLE IF NOT EXISTS paragraph_corpus (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                page_id INTEGER REFERENCES pages(id),
+                text TEXT,
+                embedding BLOB,
+                position INTEGER,
+                UNIQUE(page_id, text)
+                )
+            """
+            )
+
+        # Create a page_links table
+        cur.execute(
+            """
+            CREATE TABLE IF NOT EXISTS page_links (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                source_page_id INTEGER NOT NULL,
+                target_page_id INTEGER NOT NULL,
+                UNIQUE(source_page_id, target_page_id)
+                )
+            """
+            )
+
+        # Create a page_autonyms table
+        cur.execute(
+            """
+            CREATE TABLE IF NOT EXISTS page_autonyms (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                source_page_id INTEGER NOT NULL REFERENCES pages(id),
+                autonym TEXT,
+                autonym_page_id INTEGER NOT NULL REFERENCES pages(id),
+                lang_code TEXT,
+                UNIQUE(autonym, lang_code)
+                )
+            """
+            )
+
+        # Create a crawl_frontier table (discovered, not yet fetched pages)
+        cur.execute(
+            """
+            CREATE TABLE IF NOT EXISTS crawl_frontier (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                name TEXT NOT NULL,
+                lang_code TEXT NOT NULL,
+                priority REAL,
+                source_page_id INTEGER REFERENCES pages(id),
+                discovered_at TEXT,
+                UNIQUE(name, lang_code)
+                )
+            """
+            )
+        cur.execute(
+            """
+            CREATE INDEX IF NOT EXISTS idx_crawl_frontier_priority
+            ON crawl_frontier (lang_code, priority DESC)
+            """
+            )
+
+        # Create a leases table (work items claimed by crawl workers)
+        cur.execute(
+            """
+            CREATE TABLE IF NOT EXISTS leases (
+                key TEXT PRIMARY KEY,
+                worker_id TEXT NOT NULL,
+                expires_at REAL NOT NULL
+                )
+            """
+            )
+        cur.execute(
+            """
+            CREATE INDEX IF NOT EXISTS idx_leases_worker_id
+            ON leases (worker_id)
+            """
+            )
+
+        # Create a known_titles table (canonical titles of the saved pages)
+        cur.execute(
+            """
+            CREATE TABLE IF NOT EXISTS known_titles (
+                lang_code TEXT NOT NULL,
+                title TEXT NOT NULL,
+                PRIMARY KEY (lang_code, title)
+                ) WITHOUT ROWID
+            """
+            )
+
+        # Create a page_redirects table (canonical title -> redirect target)
+        cur.execute(
+            """
+            CREATE TABLE IF NOT EXISTS page_redirects (
+                lang_code TEXT NOT NULL,
+                title TEXT NOT NULL,
+                target TEXT NOT NULL,
+                PRIMARY KEY (lang_code, title)
+                ) WITHOUT ROWID
+            """
+            )
+
+        # Create a language_links table (cached interlanguage links)
+        cur.execute(
+            """
+            CREATE TABLE IF NOT EXISTS language_links (
+                lang_code TEXT NOT NULL,
+                title TEXT NOT NULL,
+                target_lang_code TEXT NOT NULL,
+                target_title TEXT NOT NULL,
+                PRIMARY KEY (lang_code, title, target_lang_code)
+                ) WITHOUT ROWID
+            """
+            )
+
+        # Create a dump_links table (page links staged by the dump ingestion)
+        cur.execute(
+            """
+            CREATE TABLE IF NOT EXISTS dump_links (
+                source_page_id INTEGER NOT NULL,
+                target_name TEXT NOT NULL,
+                lang_code TEXT NOT NULL
+                )
+            """
+            )
+
+        migrate(cur)
+
+
+# schema migrations
+
+def _add_revision_id(cur: sqlite3.Cursor):
+    """Add pages.revision_id"""
+    add_column(cur, "pages", "revision_id", "INTEGER")
+
+
+def _add_embedding_dtype(cur: sqlite3.Cursor):
+    """Add paragraph_corpus.embedding_dtype"""
+    add_column(cur, "paragraph_corpus", "embedding_dtype",
+               "TEXT DEFAULT 'float32'")
+
+
+def _add_lookup_indexes(cur: sqlite3.Cursor):
+    """Index the pages, paragraph, link and autonym lookups"""
+    # paragraph_corpus(page_id, text) and page_links(source_page_id,
+    # target_page_id) are already indexed by their UNIQUE constraints, but
+    # the page_id index is much smaller than the one holding the text
+    indexes = {
+        "idx_pages_lang_code_sim_score": "pages (lang_code, sim_score)",
+        "idx_pages_lang_code_name": "pages (lang_code, name)",
+        "idx_paragraph_corpus_page_id": "paragraph_corpus (page_id)",
+        "idx_page_links_target_page_id": "page_links (target_page_id)",
+        "idx_page_autonyms_source_page_id": "page_autonyms (source_page_id)",
+        "idx_page_autonyms_autonym_page_id":
+            "page_autonyms (autonym_page_id)",
+        "idx_dump_links_lang_code": "dump_links (lang_code)",
+        }
+    for name, columns in indexes.items():
+        cur.execute(f"CREATE INDEX IF NOT EXISTS {name} ON {columns}")
+    cur.execute("ANALYZE")
 
-    # Create a pages table
+
+def _add_paragraph_fts(cur: sqlite3.Cursor):
+    """Index the paragraph text for full-text search (paragraph_fts)"""
+    # External content table: the index reads the text from
+    # paragraph_corpus, and the triggers keep it in sync
     cur.execute(
         """
-        CREATE TABLE IF NOT EXISTS pages (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            name TEXT,
-            lang_code TEXT,
-            url TEXT,
-            crawled_at TEXT,
-            sim_score REAL,
-            UNIQUE(url)
+        CREATE VIRTUAL TABLE IF NOT EXISTS paragraph_fts USING fts5(
+            text,
+            content='paragraph_corpus',
+            content_rowid='id',
+            tokenize='unicode61 remove_diacritics 2'
             )
         """
         )
-
-    # Create a paragraph corpus table (paragraph text + embedding)
     cur.execute(
         """
-        CREATE TABLE IF NOT EXISTS paragraph_corpus (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            page_id INTEGER REFERENCES pages(id),
-            text TEXT,
-            embedding BLOB,
-            position INTEGER,
-            UNIQUE(page_id, text)
-            )
+        CREATE TRIGGER IF NOT EXISTS paragraph_fts_insert
+        AFTER INSERT ON paragraph_corpus BEGIN
+            INSERT INTO paragraph_fts (rowid, text)
+            VALUES (new.id, new.text);
+        END
         """
         )
-
-    # Create a page_links table
     cur.execute(
         """
-        CREATE TABLE IF NOT EXISTS page_links (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            source_page_id INTEGER NOT NULL,
-            target_page_id INTEGER NOT NULL,
-            UNIQUE(source_page_id, target_page_id)
-            )
+        CREATE TRIGGER IF NOT EXISTS paragraph_fts_delete
+        AFTER DELETE ON paragraph_corpus BEGIN
+            INSERT INTO paragraph_fts (paragraph_fts, rowid, text)
+            VALUES ('delete', old.id, old.text);
+        END
         """
         )
-
-    # Create a page_autonyms table
     cur.execute(
         """
-        CREATE TABLE IF NOT EXISTS page_autonyms (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            source_page_id INTEGER NOT NULL REFERENCES pages(id),
-            autonym TEXT,
-            autonym_page_id INTEGER NOT NULL REFERENCES pages(id),
-            lang_code TEXT,
-            UNIQUE(autonym, lang_code)
-            )
+        CREATE TRIGGER IF NOT EXISTS paragraph_fts_update
+        AFTER UPDATE OF text ON paragraph_corpus BEGIN
+            INSERT INTO paragraph_fts (paragraph_fts, rowid, text)
+            VALUES ('delete', old.id, old.text);
+            INSERT INTO paragraph_fts (rowid, text)
+            VALUES (new.id, new.text);
+        END
         """
         )
+    # index the existing paragraphs
+    cur.execute("INSERT INTO paragraph_fts (paragraph_fts) VALUES ('rebuild')")
 
 
-def delete_table(name):
-    """Delete a table."""
-    conn = sqlite3.connect(DB_NAME)
-    cur = conn.cursor()
+def _quote_page_urls(cur: sqlite3.Cursor):
+    """Percent-encode the page names in the page urls"""
+    # the urls are the unique key of the pages, recompute them with
+    # html_url so that new pages do not duplicate the saved ones
     cur.execute(
-        f"""
-        DROP TABLE IF EXISTS {name}
+        """
+        UPDATE OR IGNORE pages SET url = html_url(name, lang_code)
+        WHERE name IS NOT NULL AND lang_code IS NOT NULL
         """
         )
 
 
+# Applied in order, once: the schema version of a database is the number of
+# migrations applied to it, stored in its user_version. Append new
+# migrations, never edit or reorder the applied ones.
+MIGRATIONS = [
+    _add_revision_id,
+    _add_embedding_dtype,
+    _add_lookup_indexes,
+    _add_paragraph_fts,
+    _quote_page_urls,
+    ]
+
+
+def get_schema_version(cur: sqlite3.Cursor) -> int:
+    """Return the number of MIGRATIONS applied to the database."""
+    return cur.execute("PRAGMA user_version").fetchone()[0]
+
+
+def migrate(cur: sqlite3.Cursor):
+    """
+    Apply the MIGRATIONS the database does not have yet, and record its
+    new schema version, in the transaction of the cursor.
+
+    The add_column migrations also work on the databases created before
+    the versioning, which may have the column already.
+    """
+    version = get_schema_version(cur)
+    for version, migration in enumerate(MIGRATIONS[version:], version + 1):
+        migration(cur)
+        cur.execute(f"PRAGMA user_version = {version}")
+        logger.info(f"Migrated {DB_NAME} to schema version {version}: "
+                    f"{migration.__doc__}")
+
+
+def add_column(cur: sqlite3.Cursor, table: str, column: str, decl: str):
+    """Add a column to an existing table, if it does not have it yet."""
+    cur.execute(f"PRAGMA table_info({table})")
+    if column not in [i[1] for i in cur.fetchall()]:
+        cur.execute(f"ALTER TABLE {table} ADD COLUMN {column} {decl}")
+        logger.info(f"Added column {table}.{column}")
+
+
+def delete_table(name):
+    """Delete a table."""
+    with get_cursor() as cur:
+        cur.execute(
+            f"""
+            DROP TABLE IF EXISTS {name}
+            """
+            )
+
+
+def vacuum():
+    """Rebuild the database file to reclaim the free pages."""
+    with get_cursor() as cur:
+        cur.execute("VACUUM")
+    logger.info(f"Vacuumed {DB_NAME}")
+
+
 def get_db_info() -> dict:
     """Get database tables and number of rows in each."""
-    conn = sqlite3.connect(DB_NAME)
     logger.info(f"Connected to {DB_NAME}")
     info = {}
     info["DB_NAME"] = DB_NAME
-    cur = conn.cursor()
-    cur.execute(
-        """
-        SELECT name FROM sqlite_master WHERE type="table";
-        """
-        )
-    tables = cur.fetchall()
-    for table_tuple in tables:
-        table = table_tuple[0]
+    with get_cursor() as cur:
+        info["schema_version"] = get_schema_version(cur)
         cur.execute(
-            f"""
-            SELECT COUNT(*) FROM {table}
+            """
+            SELECT name FROM sqlite_master WHERE type="table"
+            AND name NOT LIKE 'sqlite_stat%'
+            AND name NOT LIKE 'paragraph_fts_%';
             """
             )
-        count = cur.fetchone()[0]
-        info[table] = count
-    conn.commit()
-    conn.close()
+        tables = cur.fetchall()
+        for table_tuple in tables:
+            table = table_tuple[0]
+            cur.execute(
+                f"""
+                SELECT COUNT(*) FROM {table}
+                """
+                )
+            count = cur.fetchone()[0]
+            info[table] = count
     for i in info.items():
         logger.info(i)
     return info
@@ -126,17 +562,15 @@ def get_pages_data(sim_threshold: float, lang_code: str) -> list:
     """
     Retrieve page data with similarity above threshold and from lang code.
     """
-    conn = sqlite3.connect(DB_NAME)
-    cur = conn.cursor()
-    cur.execute(
-        """
-        SELECT id, name, lang_code, sim_score FROM pages
-        WHERE lang_code = ?
-        AND sim_score >= ?
-        """, (lang_code, sim_threshold)
-        )
-    pages = cur.fetchall()
-    conn.close()
+    with get_cursor() as cur:
+        cur.execute(
+            """
+            SELECT id, name, lang_code, sim_score FROM pages
+            WHERE lang_code = ?
+            AND sim_score >= ?
+            """, (lang_code, sim_threshold)
+            )
+        pages = cur.fetchall()
     logger.info(
         f"{len(pages)} page_names from pages table "
         f"with {lang_code} and {sim_threshold}"
@@ -144,124 +578,344 @@ def get_pages_data(sim_threshold: float, lang_code: str) -> list:
     return pages
 
 
+def get_unbuilt_pages(sim_threshold: float, lang_code: str) -> list:
+    """
+    Retrieve the pages above the threshold with no paragraphs in the
+    paragraph_corpus table yet.
+
+    Returns:
+        list: List of (id, name, lang_code, sim_score) tuples.
+    """
+    with get_cursor() as cur:
+        cur.execute(
+            """
+            SELECT p.id, p.name, p.lang_code, p.sim_score FROM pages AS p
+            WHERE p.lang_code = ?
+            AND p.sim_score >= ?
+            AND NOT EXISTS (
+                SELECT 1 FROM paragraph_corpus AS pc
+                WHERE pc.page_id = p.id
+                )
+            """, (lang_code, sim_threshold)
+            )
+        pages = cur.fetchall()
+    logger.info(f"{len(pages)} {lang_code} pages not in paragraph_corpus")
+    return pages
+
+
 def insert_page_metadata(page_name: str, lang_code: str,
                          url: str, sim_score: float) -> int:
     """Save the page metadata in the pages table."""
-    conn = sqlite3.connect(DB_NAME)
-    cur = conn.cursor()
-    cur.execute(
-        """
-        INSERT OR IGNORE INTO pages
-        (name, lang_code, url, crawled_at, sim_score)
-        VALUES (?, ?, ?, ?, ?)
-        """, (page_name, lang_code, url, current_datetime_str, sim_score)
-        )
-    page_id = cur.lastrowid
-    conn.commit()
+    with get_cursor() as cur:
+        cur.execute(
+            """
+            INSERT OR IGNORE INTO pages
+            (name, lang_code, url, crawled_at, sim_score)
+            VALUES (?, ?, ?, ?, ?)
+            """, (page_name, lang_code, url, current_datetime_str, sim_score)
+            )
+        if cur.rowcount:
+            page_id = cur.lastrowid
+        else:
+            # the page was already saved
+            cur.execute("SELECT id FROM pages WHERE url = ?", (url,))
+            page_id = cur.fetchone()[0]
+        cur.execute(
+            """
+            INSERT OR IGNORE INTO known_titles (lang_code, title)
+            VALUES (?, ?)
+            """, (lang_code, canonical_title(page_name))
+            )
     return page_id
 
 
-# page_autonyms
-
-def get_unsaved_autonym_page_ids(lang_code: str, sim_threshold: float) -> list:
+def insert_pages_bulk(rows: list) -> dict:
     """
-    Retrieve unsaved autonym page IDs and names for a given language code
-    and minimum similarity threshold.
-
-    This function selects all page IDs and names from the pages table that
-    match the provided language code and have a sim_score above or equal
-    to the specified threshold. It then returns only those page IDs and
-    names that do not already exist as source_page_id in the page_autonyms
-    table.
+    Save the metadata of many pages in one transaction.
 
     Args:
-        lang_code (str): Language code (e.g., 'fr', 'de', etc.).
-        sim_threshold (float): Minimum similarity score required.
+        rows (list): List of (page_name, lang_code, url, sim_score,
+            revision_id) tuples.
 
     Returns:
-        list: List of (id, name) tuples where each page ID has not yet
-              been added to the page_autonyms table.
+        dict: Page name -> page id, including the pages already saved.
     """
-    conn = sqlite3.connect(DB_NAME)
-    cur = conn.cursor()
-    cur.execute(
-        """
-        SELECT id, name FROM pages
-        WHERE lang_code = ?
-        AND sim_score >= ?
-        """, (lang_code, sim_threshold)
-        )
-    pages = cur.fetchall()
+    with get_cursor() as cur:
+        cur.executemany(
+            """
+            INSERT OR IGNORE INTO pages
+            (name, lang_code, url, crawled_at, sim_score, revision_id)
+            VALUES (?, ?, ?, ?, ?, ?)
+            """, [(name, lang_code, url, current_datetime_str, sim_score,
+                   revision_id)
+                  for name, lang_code, url, sim_score, revision_id in rows]
+            )
+        cur.executemany(
+            """
+            INSERT OR IGNORE INTO known_titles (lang_code, title)
+            VALUES (?, ?)
+            """, [(lang_code, canonical_title(name))
+                  for name, lang_code, *_ in rows]
+            )
+        page_ids = {}
+        for name, _, url, *_ in rows:
+            cur.execute("SELECT id FROM pages WHERE url = ?", (url,))
+            page_ids[name] = cur.fetchone()[0]
+    return page_ids
 
-    conn = sqlite3.connect(DB_NAME)
-    cur = conn.cursor()
-    cur.execute(
-        """
-        SELECT source_page_id FROM page_autonyms
-        """
-        )
-    page_autonyms_page_ids = [i[0] for i in set(cur.fetchall())]
-    unsaved_pages =  set(i for i in pages if i[0] \
-                         not in page_autonyms_page_ids)
-    logger.info(f"{len(unsaved_pages)} unsaved page_ids in page_autonyms")
-    return unsaved_pages
 
+def get_stale_pages(max_age_days: int, lang_code: str) -> list:
+    """
+    Retrieve the pages crawled more than max_age_days ago (or never).
+    Autonym pages waiting for their first fetch (NULL sim_score) are not
+    stale.
 
-def read_autonyms_data(tgt_lang: str) -> list:
+    Returns:
+        list: List of (id, name, revision_id) tuples.
     """
-    Select the autonym data, join the source page name
-    and filter by autonym language.
+    with get_cursor() as cur:
+        cur.execute(
+            """
+            SELECT id, name, revision_id FROM pages
+            WHERE lang_code = ?
+            AND sim_score IS NOT NULL
+            AND (crawled_at IS NULL OR crawled_at < date('now', ?))
+            """, (lang_code, f'-{int(max_age_days)} days')
+            )
+        pages = cur.fetchall()
+    logger.info(f"{len(pages)} pages in {lang_code} older than "
+                f"{max_age_days} days")
+    return pages
+
+
+PAGE_SCORE_UPDATE = """
+    UPDATE pages SET sim_score = ?, crawled_at = ?
+    WHERE id = ?
     """
-    conn = sqlite3.connect(DB_NAME)
-    cur = conn.cursor()
-    cur.execute(
+
+
+def update_page_score(page_id: int, sim_score: float):
+    """Set the similarity score of a page and mark it as crawled today."""
+    with get_cursor() as cur:
+        cur.execute(PAGE_SCORE_UPDATE,
+                    (sim_score, current_datetime_str, page_id))
+
+
+def update_page_revision(page_id: int, revision_id: int):
+    """Set the revision id of a page and mark it as crawled today."""
+    with get_cursor() as cur:
+        cur.execute(
+            """
+            UPDATE pages SET revision_id = ?, crawled_at = ?
+            WHERE id = ?
+            """, (revision_id, current_datetime_str, page_id)
+            )
+
+
+# page_autonyms
+
+def autonyms_data_chunks(tgt_lang: str,
+                         chunk_size: int = READ_CHUNK_ROWS):
+    """Read the rows of read_autonyms_data in chunks, see read_chunks."""
+    return read_chunks(
         """
         SELECT pages.name, a.source_page_id, a.autonym,
            a.autonym_page_id, a.lang_code
         FROM page_autonyms as a
         LEFT JOIN pages ON pages.id = a.source_page_id
         WHERE a.lang_code = ?
-        """, (tgt_lang,)
+        """, (tgt_lang,), chunk_size
         )
-    result = cur.fetchall()
+
+
+def read_autonyms_data(tgt_lang: str) -> list:
+    """
+    Select the autonym data, join the source page name
+    and filter by autonym language.
+    """
+    with autonyms_data_chunks(tgt_lang) as (_, chunks):
+        result = [row for rows in chunks for row in rows]
     return result
 
 
+AUTONYM_INSERT = """
+    INSERT OR IGNORE INTO page_autonyms
+    (source_page_id, autonym, autonym_page_id, lang_code)
+    VALUES (?, ?, ?, ?)
+    """
+
+
 def insert_autonym(page_id: int, autonym: str, autonym_page_id: int, lang_code: str):
     """Insert autonym metadata to autonym table."""
-    conn = sqlite3.connect(DB_NAME)
-    cur = conn.cursor()
-    cur.execute(
-        """
-        INSERT OR IGNORE INTO page_autonyms
-        (source_page_id, autonym, autonym_page_id, lang_code)
-        VALUES (?, ?, ?, ?)
-        """, (page_id, autonym, autonym_page_id, lang_code)
-        )
-    conn.commit()
+    with get_cursor() as cur:
+        cur.execute(AUTONYM_INSERT,
+                    (page_id, autonym, autonym_page_id, lang_code))
+
+
+def insert_language_links(rows: list):
+    """
+    Cache interlanguage links.
+
+    Args:
+        rows (list): List of (lang_code, title, target_lang_code,
+            target_title) tuples, with canonical titles.
+    """
+    with get_cursor() as cur:
+        cur.executemany(
+            """
+            INSERT OR REPLACE INTO language_links
+            (lang_code, title, target_lang_code, target_title)
+            VALUES (?, ?, ?, ?)
+            """, rows
+            )
+
+
+def get_pages_without_language_links(lang_code: str,
+                                     sim_threshold: float) -> list:
+    """
+    Retrieve the pages above the threshold that have neither autonyms nor
+    cached language links, whose language links must be requested.
+
+    Returns:
+        list: List of (id, name) tuples.
+    """
+    with get_cursor() as cur:
+        cur.execute(
+            """
+            SELECT p.id, p.name FROM pages AS p
+            WHERE p.lang_code = ?
+            AND p.sim_score >= ?
+            AND NOT EXISTS (
+                SELECT 1 FROM page_autonyms AS a
+                WHERE a.source_page_id = p.id
+                )
+            AND NOT EXISTS (
+                SELECT 1 FROM language_links AS ll
+                WHERE ll.lang_code = p.lang_code
+                AND ll.title = canonical_title(p.name)
+                )
+            """, (lang_code, sim_threshold)
+            )
+        pages = cur.fetchall()
+    logger.info(f"{len(pages)} pages without language links in {lang_code}")
+    return pages
+
+
+def fill_autonyms(lang_code: str, sim_threshold: float,
+                  autonym_lang_codes: list) -> int:
+    """
+    Fill the page_autonyms table from the cached language links of the
+    pages above the threshold, in one set-based pass.
+
+    Autonym pages not saved yet are inserted with a NULL sim_score and
+    crawled_at, their content is fetched later only if needed
+    (see get_unfetched_autonym_pages).
+
+    Returns:
+        int: The number of autonyms inserted.
+    """
+    with get_cursor() as cur:
+        cur.execute("DROP TABLE IF EXISTS temp.autonym_links")
+        cur.execute(
+            f"""
+            CREATE TEMP TABLE autonym_links AS
+            SELECT p.id AS source_page_id, ll.target_title,
+            ll.target_lang_code,
+            html_url(ll.target_title, ll.target_lang_code) AS url
+            FROM pages AS p
+            JOIN language_links AS ll
+            ON ll.lang_code = p.lang_code
+            AND ll.title = canonical_title(p.name)
+            WHERE p.lang_code = ?
+            AND p.sim_score >= ?
+            AND ll.target_lang_code
+            IN ({','.join('?' * len(autonym_lang_codes))})
+            """, (lang_code, sim_threshold, *autonym_lang_codes)
+            )
+        cur.execute(
+            """
+            INSERT OR IGNORE INTO pages (name, lang_code, url)
+            SELECT target_title, target_lang_code, url FROM autonym_links
+            """
+            )
+        cur.execute(
+            """
+            INSERT OR IGNORE INTO known_titles (lang_code, title)
+            SELECT target_lang_code, target_title FROM autonym_links
+            """
+            )
+        cur.execute(
+            """
+            INSERT OR IGNORE INTO page_autonyms
+            (source_page_id, autonym, autonym_page_id, lang_code)
+            SELECT al.source_page_id, al.target_title, p.id,
+            al.target_lang_code
+            FROM autonym_links AS al
+            JOIN pages AS p ON p.url = al.url
+            """
+            )
+        n_autonyms = cur.rowcount
+        cur.execute("DROP TABLE temp.autonym_links")
+    logger.info(f"Inserted {n_autonyms} autonyms of {lang_code} pages")
+    return n_autonyms
+
+
+def get_unfetched_autonym_pages(lang_code: str, sim_threshold: float) -> list:
+    """
+    Retrieve the autonym pages of the pages above the threshold whose
+    content was not fetched yet (NULL sim_score).
+
+    Returns:
+        list: List of (id, name, lang_code) tuples.
+    """
+    with get_cursor() as cur:
+        cur.execute(
+            """
+            SELECT DISTINCT t.id, t.name, t.lang_code
+            FROM page_autonyms AS a
+            JOIN pages AS s ON s.id = a.source_page_id
+            JOIN pages AS t ON t.id = a.autonym_page_id
+            WHERE s.lang_code = ?
+            AND s.sim_score >= ?
+            AND t.sim_score IS NULL
+            """, (lang_code, sim_threshold)
+            )
+        pages = cur.fetchall()
+    logger.info(f"{len(pages)} autonym pages of {lang_code} pages to fetch")
+    return pages
 
 
 # page_links
 
-def get_page_links_page_ids() -> set:
+def get_unlinked_pages(sim_threshold: float, lang_code: str) -> list:
     """
-    Retrieve a set of all unique source_page_id values from the page_links table.
+    Retrieve the pages above the threshold that are not yet the source of
+    any link in the page_links table.
 
     Returns:
-        set: A set containing all distinct source_page_id values found in the
-            page_links table.
+        list: List of (id, name, lang_code, sim_score) tuples.
+    """
+    with get_cursor() as cur:
+        cur.execute(
+            """
+            SELECT p.id, p.name, p.lang_code, p.sim_score FROM pages AS p
+            WHERE p.lang_code = ?
+            AND p.sim_score >= ?
+            AND NOT EXISTS (
+                SELECT 1 FROM page_links AS pl
+                WHERE pl.source_page_id = p.id
+                )
+            """, (lang_code, sim_threshold)
+            )
+        pages = cur.fetchall()
+    logger.info(f"{len(pages)} {lang_code} pages not in page_links table")
+    return pages
+
+
+PAGE_LINK_INSERT = """
+    INSERT OR IGNORE INTO page_links
+    (source_page_id, target_page_id) VALUES (?, ?)
     """
-    conn = sqlite3.connect(DB_NAME)
-    cur = conn.cursor()
-    cur.execute(
-        """
-        SELECT source_page_id FROM page_links
-        """
-        )
-    links_page_ids = cur.fetchall()
-    links_page_ids = set(p[0] for p in links_page_ids)
-    logger.info(f"{len(links_page_ids)} page_ids in page_links table")
-    return links_page_ids
 
 
 def insert_page_link(source_page_id: int, target_page_id: int):
@@ -273,32 +927,63 @@ def insert_page_link(source_page_id: int, target_page_id: int):
         target_page_id (int): The page ID of the target page.
 
     This function adds a directed link from the source to the target page
-    in the page_links table.
+    in the page_links table. Use a BulkWriter of PAGE_LINK_INSERT to insert
+    many links.
     """
-    conn = sqlite3.connect(DB_NAME)
-    cur = conn.cursor()
-    cur.execute(
-        """
-        INSERT OR IGNORE INTO page_links
-        (source_page_id, target_page_id) VALUES (?, ?)
-        """, (source_page_id, target_page_id)
-        )
-    conn.commit()
+    with get_cursor() as cur:
+        cur.execute(PAGE_LINK_INSERT, (source_page_id, target_page_id))
 
 
-def get_page_links_data(lang_code: str) -> list:
+def insert_dump_links(rows: list):
     """
-    Get the source/target page links data and join the page names
-    for visualization.
+    Stage page links by target name, to be resolved to page ids by
+    resolve_dump_links once all the pages are saved.
+
+    Args:
+        rows (list): List of (source_page_id, target_name, lang_code) tuples.
+    """
+    with get_cursor() as cur:
+        cur.executemany(
+            """
+            INSERT INTO dump_links (source_page_id, target_name, lang_code)
+            VALUES (?, ?, ?)
+            """, rows
+            )
+
+
+def resolve_dump_links(lang_code: str) -> int:
+    """
+    Insert the staged links whose target page (or redirect target) is in
+    the pages table into page_links, and empty the staging table.
 
     Returns:
-        A list of tuples, for example:
-            (source_page_id, source_page_name, source_page_sim_score,
-             target_page_id, target_page_name)
+        int: The number of page links inserted.
     """
-    conn = sqlite3.connect(DB_NAME)
-    cur = conn.cursor()
-    cur.execute(
+    with get_cursor() as cur:
+        cur.execute(
+            """
+            INSERT OR IGNORE INTO page_links (source_page_id, target_page_id)
+            SELECT dl.source_page_id, p.id
+            FROM dump_links AS dl
+            LEFT JOIN page_redirects AS r
+            ON r.lang_code = dl.lang_code AND r.title = dl.target_name
+            JOIN pages AS p
+            ON p.lang_code = dl.lang_code
+            AND p.name = COALESCE(r.target, dl.target_name)
+            WHERE dl.lang_code = ? AND dl.source_page_id != p.id
+            """, (lang_code,)
+            )
+        n_links = cur.rowcount
+        cur.execute("DELETE FROM dump_links WHERE lang_code = ?",
+                    (lang_code,))
+    logger.info(f"Resolved {n_links} page links from dump_links table")
+    return n_links
+
+
+def page_links_data_chunks(lang_code: str,
+                           chunk_size: int = READ_CHUNK_ROWS):
+    """Read the rows of get_page_links_data in chunks, see read_chunks."""
+    return read_chunks(
         """
         SELECT pl.source_page_id, s_pages.name, s_pages.sim_score,
         pl.target_page_id, t_pages.name
@@ -306,16 +991,38 @@ def get_page_links_data(lang_code: str) -> list:
         LEFT JOIN pages AS s_pages ON pl.source_page_id = s_pages.id
         LEFT JOIN pages AS t_pages ON pl.target_page_id = t_pages.id
         WHERE s_pages.lang_code = ?
-        """, (lang_code,)
+        """, (lang_code,), chunk_size
         )
-    page_links = cur.fetchall()
+
+
+def get_page_links_data(lang_code: str) -> list:
+    """
+    Get the source/target page links data and join the page names
+    for visualization.
+
+    Returns:
+        A list of tuples, for example:
+            (source_page_id, source_page_name, source_page_sim_score,
+             target_page_id, target_page_name)
+    """
+    with page_links_data_chunks(lang_code) as (_, chunks):
+        page_links = [row for rows in chunks for row in rows]
     logger.info(f"Read {len(page_links)} page_links from page_links table")
     return page_links
 
 
 # paragraph_corpus
 
-def insert_paragraph(page_id: int, paragraph: str, embedding: bytes, position: int):
+# Rows: (page_id, text, embedding, position, embedding_dtype)
+PARAGRAPH_INSERT = """
+    INSERT OR IGNORE INTO paragraph_corpus
+    (page_id, text, embedding, position, embedding_dtype)
+    VALUES (?, ?, ?, ?, ?)
+    """
+
+
+def insert_paragraph(page_id: int, paragraph: str, embedding: bytes, position: int,
+                     embedding_dtype: str = 'float32'):
     """
     Insert a paragraph and its embedding into the paragraph_corpus table.
 
@@ -324,19 +1031,42 @@ def insert_paragraph(page_id: int, paragraph: str, embedding: bytes, position: i
         paragraph (str): The text of the paragraph.
         embedding (bytes): The paragraph embedding as a BLOB.
         position (int): The position of the paragraph within the page.
+        embedding_dtype (str): The embedding format, see quantization.py.
 
     This inserts a record into the paragraph_corpus table if not already
-    present, based on the unique (page_id, text) constraint.
+    present, based on the unique (page_id, text) constraint. Use a
+    BulkWriter of PARAGRAPH_INSERT to insert many paragraphs.
     """
-    conn = sqlite3.connect(DB_NAME)
-    cur = conn.cursor()
-    cur.execute(
+    with get_cursor() as cur:
+        cur.execute(PARAGRAPH_INSERT,
+                    (page_id, paragraph, embedding, position, embedding_dtype))
+
+
+def insert_paragraphs_bulk(rows: list, embedding_dtype: str = 'float32'):
+    """
+    Insert many paragraphs and their embeddings in one transaction.
+
+    Args:
+        rows (list): List of (page_id, paragraph, embedding, position)
+            tuples.
+        embedding_dtype (str): The embeddings format, see quantization.py.
+    """
+    with get_cursor() as cur:
+        cur.executemany(PARAGRAPH_INSERT,
+                        [(*row, embedding_dtype) for row in rows])
+
+
+def paragraph_embeddings_chunks(chunk_size: int = READ_CHUNK_ROWS):
+    """
+    Read the rows of get_paragraph_embeddings in chunks, see read_chunks
+    and quantization.load_matrix_chunks.
+    """
+    return read_chunks(
         """
-        INSERT OR IGNORE INTO paragraph_corpus
-        (page_id, text, embedding, position) VALUES (?, ?, ?, ?)
-        """, (page_id, paragraph, embedding, position)
+        SELECT embedding, embedding_dtype FROM paragraph_corpus
+        ORDER BY id
+        """, (), chunk_size
         )
-    conn.commit()
 
 
 def get_paragraph_embeddings() -> list:
@@ -344,43 +1074,140 @@ def get_paragraph_embeddings() -> list:
     Retrieve all paragraph embeddings from the paragraph_corpus table.
 
     Returns:
-        list: A list of tuples, where each tuple contains a single element
-        representing the paragraph embedding as stored in the database.
+        list: A list of (embedding, embedding_dtype) tuples, with the
+        paragraph embedding as stored in the database.
     """
-    conn = sqlite3.connect(DB_NAME)
-    cur = conn.cursor()
-    cur.execute(
-        """
-        SELECT embedding FROM paragraph_corpus
+    with paragraph_embeddings_chunks() as (_, chunks):
+        return [row for rows in chunks for row in rows]
+
+
+def get_embedding_dtype() -> str:
+    """
+    Return the dtype the paragraph embeddings are stored in, or 'float32'
+    if they are stored in several dtypes (see quantization.load_matrix).
+    """
+    with get_cursor() as cur:
+        cur.execute(
+            """
+            SELECT DISTINCT COALESCE(embedding_dtype, 'float32')
+            FROM paragraph_corpus
+            """
+            )
+        dtypes = [row[0] for row in cur.fetchall()]
+    return dtypes[0] if len(dtypes) == 1 else 'float32'
+
+
+def paragraph_embedding_rows_chunks(min_id: int = 0, max_id: int = None,
+                                    chunk_size: int = READ_CHUNK_ROWS):
+    """
+    Read the rows of get_paragraph_embedding_rows in chunks,
+    see read_chunks.
+    """
+    return read_chunks(
         """
+        SELECT id, embedding, embedding_dtype FROM paragraph_corpus
+        WHERE id > ? AND (? IS NULL OR id <= ?)
+        ORDER BY id
+        """, (min_id, max_id, max_id), chunk_size
         )
-    return cur.fetchall()
 
 
-def get_paragraph_corpus() -> list:
+def get_paragraph_embedding_rows(min_id: int = 0,
+                                 max_id: int = None) -> list:
     """
-    Retrieve the full paragraph corpus including page and language info.
+    Retrieve the paragraph embeddings with their ids, by ascending id.
+
+    Args:
+        min_id (int): Only the paragraphs with a greater id.
+        max_id (int): Only the paragraphs with this id or a lower one,
+            or all.
 
     Returns:
-        list: Each tuple contains
-            (paragraph_corpus.id, page_id, page name, paragraph text,
-            position, lang_code). One tuple per paragraph in the corpus.
+        list: A list of (id, embedding, embedding_dtype) tuples.
     """
-    conn = sqlite3.connect(DB_NAME)
-    cur = conn.cursor()
-    cur.execute(
+    with paragraph_embedding_rows_chunks(min_id, max_id) as (_, chunks):
+        rows = [row for rows in chunks for row in rows]
+    return rows
+
+
+PARAGRAPH_EMBEDDING_UPDATE = """
+    UPDATE paragraph_corpus SET embedding = ?, embedding_dtype = ?
+    WHERE id = ?
+    """
+
+
+def paragraph_corpus_chunks(chunk_size: int = READ_CHUNK_ROWS):
+    """Read the rows of get_paragraph_corpus in chunks, see read_chunks."""
+    return read_chunks(
         """
         SELECT paragraph_corpus.id, page_id, pages.name,
         text, position, pages.lang_code
         FROM paragraph_corpus
         LEFT JOIN pages ON paragraph_corpus.page_id = pages.id
-        """
+        ORDER BY paragraph_corpus.id
+        """, (), chunk_size
         )
-    corpus = cur.fetchall()
+
+
+def get_paragraph_corpus() -> list:
+    """
+    Retrieve the full paragraph corpus including page and language info.
+
+    Returns:
+        list: Each tuple contains
+            (paragraph_corpus.id, page_id, page name, paragraph text,
+            position, lang_code). One tuple per paragraph in the corpus,
+            by ascending id.
+    """
+    with paragraph_corpus_chunks() as (_, chunks):
+        corpus = [row for rows in chunks for row in rows]
     logger.info(f"Read paragraphs with {len(corpus)} rows")
     return corpus
 
 
+def get_paragraph_rows(page_id: int) -> list:
+    """
+    Retrieve the paragraphs of a page.
+
+    Returns:
+        list: List of (paragraph_corpus.id, text, position) tuples.
+    """
+    with get_cursor() as cur:
+        cur.execute(
+            """
+            SELECT id, text, position FROM paragraph_corpus
+            WHERE page_id = ?
+            """, (page_id,)
+            )
+        rows = cur.fetchall()
+    return rows
+
+
+def delete_paragraphs(paragraph_ids: list):
+    """Delete paragraphs from the paragraph_corpus table by id."""
+    with get_cursor() as cur:
+        cur.executemany(
+            """
+            DELETE FROM paragraph_corpus WHERE id = ?
+            """, [(i,) for i in paragraph_ids]
+            )
+
+
+def update_paragraph_positions(positions: list):
+    """
+    Update the position of paragraphs.
+
+    Args:
+        positions (list): List of (paragraph_corpus.id, position) tuples.
+    """
+    with get_cursor() as cur:
+        cur.executemany(
+            """
+            UPDATE paragraph_corpus SET position = ? WHERE id = ?
+            """, [(position, i) for i, position in positions]
+            )
+
+
 def get_paragraphs_by_page_id(page_id: int) -> str:
     """
     Retrieve the concatenated paragraph text for a given page_id.
@@ -392,17 +1219,322 @@ def get_paragraphs_by_page_id(page_id: int) -> str:
         str or None: All paragraphs (joined by '\n') for the specified page_id,
         or None if no paragraphs are found.
     """
-    conn = sqlite3.connect(DB_NAME)
-    cur = conn.cursor()
-    cur.execute(
-        """
-        SELECT text, position
-        FROM paragraph_corpus
-        WHERE page_id = ?
-        """, (page_id,)
-        )
-    pgfs = cur.fetchall()
+    with get_cursor() as cur:
+        cur.execute(
+            """
+            SELECT text, position
+            FROM paragraph_corpus
+            WHERE page_id = ?
+            """, (page_id,)
+            )
+        pgfs = cur.fetchall()
     pgfs = [i[0] for i in sorted(pgfs, key=lambda i: i[1])]
     if pgfs:
         return "\n".join(pgfs)
     return None
+
+
+def fts_query(text: str) -> str:
+    """
+    Return the FTS5 query matching the paragraphs with any word of a text,
+    each word quoted, so that the text needs no FTS5 syntax.
+    """
+    return ' OR '.join(f'"{word}"' for word in re.findall(r'\w+', text))
+
+
+def search_paragraph_text(query: str, limit: int) -> list:
+    """
+    Retrieve the paragraphs matching the words of a query from the
+    paragraph_fts full-text index, by descending BM25 relevance.
+
+    Args:
+        query (str): The query text, see fts_query.
+        limit (int): Number of paragraphs to return.
+
+    Returns:
+        list: List of (paragraph_corpus.id, score) tuples, the score is the
+        BM25 relevance (greater is better).
+    """
+    match = fts_query(query)
+    if not match:
+        return []
+    with get_cursor() as cur:
+        cur.execute(
+            """
+            SELECT rowid, -bm25(paragraph_fts)
+            FROM paragraph_fts
+            WHERE paragraph_fts MATCH ?
+            ORDER BY rank
+            LIMIT ?
+            """, (match, limit)
+            )
+        rows = cur.fetchall()
+    return rows
+
+
+# export
+
+# Rows of the exported tables by ascending id, with the lang_code they are
+# partitioned by, see export.py
+EXPORT_QUERIES = {
+    "pages": """
+        SELECT id, name, url, crawled_at, sim_score, revision_id, lang_code
+        FROM pages
+        WHERE id > ? AND id <= ?
+        ORDER BY id
+        """,
+    "paragraph_corpus": """
+        SELECT pc.id, pc.page_id, pc.text, pc.position, pc.embedding,
+        pc.embedding_dtype, p.lang_code
+        FROM paragraph_corpus AS pc
+        LEFT JOIN pages AS p ON p.id = pc.page_id
+        WHERE pc.id > ? AND pc.id <= ?
+        ORDER BY pc.id
+        """,
+    "page_links": """
+        SELECT pl.id, pl.source_page_id, pl.target_page_id, p.lang_code
+        FROM page_links AS pl
+        LEFT JOIN pages AS p ON p.id = pl.source_page_id
+        WHERE pl.id > ? AND pl.id <= ?
+        ORDER BY pl.id
+        """,
+    "page_autonyms": """
+        SELECT id, source_page_id, autonym, autonym_page_id, lang_code
+        FROM page_autonyms
+        WHERE id > ? AND id <= ?
+        ORDER BY id
+        """,
+    }
+
+
+def get_max_id(table: str) -> int:
+    """Return the greatest id of a table, 0 if it is empty."""
+    with get_cursor() as cur:
+        cur.execute(f"SELECT COALESCE(MAX(id), 0) FROM {table}")
+        return cur.fetchone()[0]
+
+
+def export_rows_chunks(table: str, min_id: int, max_id: int,
+                       chunk_size: int = READ_CHUNK_ROWS):
+    """
+    Read the rows of an exported table with ids in (min_id, max_id] in
+    chunks, see EXPORT_QUERIES and read_chunks.
+    """
+    return read_chunks(EXPORT_QUERIES[table], (min_id, max_id), chunk_size)
+
+
+# crawl_frontier
+
+def push_frontier(page_names: list, lang_code: str, priority: float,
+                  source_page_id: int):
+    """
+    Add discovered page names to the crawl frontier.
+
+    Page names already in the pages table are skipped. If a page name is
+    already in the frontier, it keeps the highest priority it was pushed with.
+
+    Args:
+        page_names (list): The discovered page names.
+        lang_code (str): Language code of the page names.
+        priority (float): The crawl priority, e.g. the source page sim_score.
+        source_page_id (int): The id of the page linking to the page names.
+    """
+    with get_cursor() as cur:
+        cur.executemany(
+            """
+            INSERT INTO crawl_frontier
+            (name, lang_code, priority, source_page_id, discovered_at)
+            SELECT ?, ?, ?, ?, ?
+            WHERE NOT EXISTS (
+                SELECT 1 FROM pages
+                WHERE pages.name = ? AND pages.lang_code = ?
+                )
+            ON CONFLICT(name, lang_code) DO UPDATE
+            SET priority = excluded.priority,
+                source_page_id = excluded.source_page_id
+            WHERE excluded.priority > crawl_frontier.priority
+            """, [(name, lang_code, priority, source_page_id,
+                   current_datetime_str, name, lang_code)
+                  for name in page_names]
+            )
+
+
+def claim_frontier(lang_code: str, n: int, worker_id: str,
+                   lease_seconds: float) -> list:
+    """
+    Claim the n highest-priority page names of the frontier that are not
+    in the pages table yet and not leased by another worker.
+
+    The page names are leased to worker_id for lease_seconds (see
+    claim_leases), so that concurrent workers never get the same page names.
+    The claimed page names stay in the frontier until complete_frontier is
+    called, and return to the other workers if the lease expires first.
+
+    Returns:
+        list: List of (name, priority) tuples, highest priority first.
+    """
+    now = time.time()
+    with get_cursor() as cur:
+        cur.execute("BEGIN IMMEDIATE")
+        cur.execute(
+            """
+            SELECT name, priority FROM crawl_frontier AS f
+            WHERE lang_code = ?
+            AND NOT EXISTS (
+                SELECT 1 FROM pages
+                WHERE pages.name = f.name AND pages.lang_code = f.lang_code
+                )
+            AND NOT EXISTS (
+                SELECT 1 FROM leases
+                WHERE leases.key = 'frontier:' || f.lang_code || ':' || f.name
+                AND leases.expires_at > ?
+                )
+            ORDER BY priority DESC
+            LIMIT ?
+            """, (lang_code, now, n)
+            )
+        entries = cur.fetchall()
+        cur.executemany(
+            """
+            INSERT OR REPLACE INTO leases (key, worker_id, expires_at)
+            VALUES (?, ?, ?)
+            """, [(f"frontier:{lang_code}:{name}", worker_id,
+                   now + lease_seconds)
+                  for name, _ in entries]
+            )
+    return entries
+
+
+def complete_frontier(page_names: list, lang_code: str, worker_id: str):
+    """
+    Remove processed page names from the frontier and release their leases.
+    """
+    with get_cursor() as cur:
+        cur.executemany(
+            """
+            DELETE FROM crawl_frontier WHERE name = ? AND lang_code = ?
+            """, [(name, lang_code) for name in page_names]
+            )
+        cur.executemany(
+            """
+            DELETE FROM leases WHERE key = ? AND worker_id = ?
+            """, [(f"frontier:{lang_code}:{name}", worker_id)
+                  for name in page_names]
+            )
+
+
+def get_frontier_size(lang_code: str) -> int:
+    """Return the number of page names in the frontier for a lang code."""
+    with get_cursor() as cur:
+        cur.execute(
+            """
+            SELECT COUNT(*) FROM crawl_frontier WHERE lang_code = ?
+            """, (lang_code,)
+            )
+        size = cur.fetchone()[0]
+    return size
+
+
+# known_titles and page_redirects
+
+def get_known_titles(lang_code: str) -> set:
+    """
+    Retrieve the canonical titles of the saved pages for a lang code.
+
+    The known_titles table is filled from the pages table the first time,
+    for databases created before it existed.
+    """
+    with get_cursor() as cur:
+        cur.execute(
+            """
+            SELECT EXISTS (SELECT 1 FROM known_titles WHERE lang_code = ?)
+            """, (lang_code,)
+            )
+        if not cur.fetchone()[0]:
+            cur.execute(
+                """
+                INSERT OR IGNORE INTO known_titles (lang_code, title)
+                SELECT lang_code, canonical_title(name) FROM pages
+                WHERE lang_code = ?
+                """, (lang_code,)
+                )
+        cur.execute(
+            """
+            SELECT title FROM known_titles WHERE lang_code = ?
+            """, (lang_code,)
+            )
+        titles = set(i[0] for i in cur.fetchall())
+    logger.info(f"{len(titles)} known titles for {lang_code}")
+    return titles
+
+
+def get_redirects(lang_code: str) -> dict:
+    """Retrieve the cached redirects (title -> target) for a lang code."""
+    with get_cursor() as cur:
+        cur.execute(
+            """
+            SELECT title, target FROM page_redirects WHERE lang_code = ?
+            """, (lang_code,)
+            )
+        redirects = dict(cur.fetchall())
+    return redirects
+
+
+def insert_redirect(lang_code: str, title: str, target: str):
+    """Cache a redirect from title to target, both canonicalized."""
+    with get_cursor() as cur:
+        cur.execute(
+            """
+            INSERT OR REPLACE INTO page_redirects (lang_code, title, target)
+            VALUES (?, ?, ?)
+            """, (lang_code, canonical_title(title), canonical_title(target))
+            )
+
+
+# leases
+
+def claim_leases(keys: list, worker_id: str, lease_seconds: float) -> list:
+    """
+    Claim work items for a worker.
+
+    Each key (e.g. 'autonyms:42') is leased to worker_id for lease_seconds,
+    unless another worker holds an unexpired lease on it. Claims are atomic,
+    so concurrent workers, in this or other processes or boxes sharing the
+    database, never get the same key.
+
+    Returns:
+        list: The keys claimed by worker_id.
+    """
+    now = time.time()
+    with get_cursor() as cur:
+        cur.execute("BEGIN IMMEDIATE")
+        # expired leases are free, drop them
+        cur.execute("DELETE FROM leases WHERE expires_at <= ?", (now,))
+        cur.executemany(
+            """
+            INSERT INTO leases (key, worker_id, expires_at) VALUES (?, ?, ?)
+            ON CONFLICT(key) DO UPDATE
+            SET expires_at = excluded.expires_at
+            WHERE leases.worker_id = excluded.worker_id
+            """, [(key, worker_id, now + lease_seconds) for key in keys]
+            )
+        claimed = []
+        for key in keys:
+            cur.execute(
+                """
+                SELECT 1 FROM leases WHERE key = ? AND worker_id = ?
+                """, (key, worker_id)
+                )
+            if cur.fetchone():
+                claimed.append(key)
+    return claimed
+
+
+def heartbeat_leases(worker_id: str, lease_seconds: float):
+    """Extend all the leases of a worker by lease_seconds from now."""
+    with get_cursor() as cur:
+        cur.execute(
+            """
+            UPDATE leases SET expires_at = ? WHERE worker_id = ?
+            """, (time.time() + lease_seconds, worker_id)
+            )
@@ -0,0 +1,344 @@
+"""
+Streaming ingestion of Wikimedia dumps.
+
+Reads a local dump file article by article, runs every article through the
+same paragraph and link extraction as WikiPage, keeps the articles similar
+enough to the seed page, and writes them to the pages, paragraph_corpus and
+page_links tables in bulk. Memory stays constant regardless of dump size:
+articles are processed in batches, and links are staged in the dump_links
+table and resolved with one set-based join at the end.
+
+Supported dumps:
+    - Wikimedia Enterprise HTML dumps (NDJSON in .tar.gz), e.g.
+      enwiki-NS0-20240601-ENTERPRISE-HTML.json.tar.gz
+    - pages-articles XML dumps (.xml.bz2), e.g.
+      enwiki-20240601-pages-articles.xml.bz2
+    - langlinks SQL dumps (.sql.gz) with the page SQL dump that maps their
+      page ids to titles, e.g. enwiki-20240601-langlinks.sql.gz and
+      enwiki-20240601-page.sql.gz. The language links of the known pages are
+      cached in the language_links table and page_autonyms is filled from
+      them, without any request.
+
+Usage:
+    python dumps.py enwiki-NS0-ENTERPRISE-HTML.json.tar.gz --lang-code en
+    python dumps.py enwiki-pages-articles.xml.bz2 --lang-code en
+    python dumps.py enwiki-langlinks.sql.gz --page-dump enwiki-page.sql.gz \\
+        --lang-code en
+"""
+import argparse
+import bz2
+import gzip
+import json
+import re
+import tarfile
+import time
+import xml.etree.ElementTree as ET
+from __init__ import logger, config
+from extract import (ExtractedPage, extract_page, get_internal_page_name,
+                     is_valid_paragraph, NO_SHORTDESCRIPTION)
+from titles import canonical_title, html_url
+from quantization import to_blob
+import db_utils as db
+
+
+SIM_THRESHOLD = config["SIM_THRESHOLD"]
+
+
+class DumpArticle:
+    """An article read from a dump."""
+    def __init__(self, title: str, lang_code: str, extracted: ExtractedPage,
+                 revision_id: int = None):
+        self.title = canonical_title(title)
+        self.lang_code = lang_code
+        self.extracted = extracted
+        self.revision_id = revision_id
+
+
+def iter_enterprise_html(path: str, lang_code: str):
+    """
+    Stream the articles of a Wikimedia Enterprise HTML dump (.tar.gz of
+    NDJSON files), skipping the non-article namespaces.
+    """
+    with tarfile.open(path, mode='r|gz') as tar:
+        for member in tar:
+            f = tar.extractfile(member)
+            if f is None:
+                continue
+            for line in f:
+                article = json.loads(line)
+                if article.get('namespace', {}).get('identifier', 0) != 0:
+                    continue
+                html = article.get('article_body', {}).get('html', '')
+                revision_id = article.get('version', {}).get('identifier')
+                yield DumpArticle(article['name'], lang_code,
+                                  extract_page(html), revision_id)
+
+
+# wikitext markup removed before the paragraphs are extracted
+WIKITEXT_REMOVE = [
+    re.compile(r'<!--.*?-->', re.S),
+    re.compile(r'<ref[^>/]*/>', re.S),
+    re.compile(r'<ref[^>]*>.*?</ref>', re.S),
+    re.compile(r'<(math|gallery|timeline|syntaxhighlight)[^>]*>.*?</\1>',
+               re.S),
+    re.compile(r'\{\|.*?\|\}', re.S),
+    ]
+WIKITEXT_LINK = re.compile(r'\[\[([^\[\]|]*)(?:\|([^\[\]]*))?\]\]')
+WIKITEXT_EXTERNAL_LINK = re.compile(r'\[https?://[^\s\]]+\s?([^\]]*)\]')
+WIKITEXT_TAG = re.compile(r'<[^>]+>')
+WIKITEXT_QUOTES = re.compile(r"'{2,}")
+
+
+def strip_templates(text: str) -> str:
+    """Remove the (nested) {{templates}} from wikitext."""
+    out = []
+    depth = 0
+    i = 0
+    while i < len(text):
+        pair = text[i:i + 2]
+        if pair == '{{':
+            depth += 1
+            i += 2
+        elif pair == '}}' and depth:
+            depth -= 1
+            i += 2
+        else:
+            if not depth:
+                out.append(text[i])
+            i += 1
+    return ''.join(out)
+
+
+def extract_wikitext(wikitext: str) -> ExtractedPage:
+    """
+    Extract the paragraphs and internal page names from wikitext, with the
+    same paragraph constraints and link filters as the html extraction.
+    """
+    text = strip_templates(wikitext)
+    for pattern in WIKITEXT_REMOVE:
+        text = pattern.sub('', text)
+    paragraphs = []
+    hrefs = {}
+    for block in re.split(r'\n\s*\n', text):
+        block = block.strip()
+        # skip headings, lists, tables, files and categories
+        if not block or block[0] in '=*#:;|!{' or block.startswith('[[') \
+                and ':' in block[:block.find(']]')]:
+            continue
+        for target, _ in WIKITEXT_LINK.findall(block):
+            href = './' + target.strip().replace(' ', '_')
+            page_name = get_internal_page_name(href)
+            if page_name is not None:
+                hrefs[page_name] = None
+        block = WIKITEXT_LINK.sub(lambda m: m.group(2) or m.group(1), block)
+        block = WIKITEXT_EXTERNAL_LINK.sub(r'\1', block)
+        block = WIKITEXT_TAG.sub('', block)
+        block = WIKITEXT_QUOTES.sub('', block)
+        block = ' '.join(block.split())
+        if is_valid_paragraph(block):
+            paragraphs.append(block)
+    return ExtractedPage(None, paragraphs, list(hrefs), NO_SHORTDESCRIPTION)
+
+
+def iter_xml_articles(path: str, lang_code: str):
+    """
+    Stream the articles of a pages-articles XML dump (.xml.bz2 or .xml),
+    skipping redirects and the non-article namespaces.
+    """
+    opener = bz2.open if path.endswith('.bz2') else open
+    with opener(path, 'rb') as f:
+        context = ET.iterparse(f, events=('start', 'end'))
+        _, root = next(context)
+        ns = root.tag[:root.tag.index('}') + 1] if '}' in root.tag else ''
+        for event, elem in context:
+            if event != 'end' or elem.tag != f'{ns}page':
+                continue
+            if elem.findtext(f'{ns}ns') == '0' \
+                    and elem.find(f'{ns}redirect') is None:
+                revision = elem.find(f'{ns}revision')
+                wikitext = revision.findtext(f'{ns}text') or ''
+                revision_id = revision.findtext(f'{ns}id')
+                yield DumpArticle(elem.findtext(f'{ns}title'), lang_code,
+                                  extract_wikitext(wikitext),
+                                  int(revision_id) if revision_id else None)
+            # free the parsed pages, keeping memory constant
+            root.clear()
+
+
+def iter_dump(path: str, lang_code: str):
+    """Stream the articles of a dump, choosing the reader by file name."""
+    if path.endswith('.tar.gz') or path.endswith('.tgz'):
+        return iter_enterprise_html(path, lang_code)
+    return iter_xml_articles(path, lang_code)
+
+
+# a row of an INSERT statement, and a field of a row
+SQL_ROW = re.compile(r"\(((?:[^()']|'(?:[^'\\]|\\.)*')*)\)")
+SQL_FIELD = re.compile(r"'((?:[^'\\]|\\.)*)'|([^,]+)")
+SQL_ESCAPE = re.compile(r"\\(.)")
+
+
+def iter_sql_rows(path: str, table: str):
+    """
+    Stream the rows of the INSERT statements for table in a MySQL dump
+    (.sql.gz), as tuples of strings.
+    """
+    prefix = f'INSERT INTO `{table}` VALUES '
+    with gzip.open(path, 'rt', encoding='utf-8', errors='replace') as f:
+        for line in f:
+            if not line.startswith(prefix):
+                continue
+            for row in SQL_ROW.finditer(line, len(prefix)):
+                yield tuple(
+                    SQL_ESCAPE.sub(r'\1', quoted) if unquoted == '' else
+                    unquoted
+                    for quoted, unquoted in SQL_FIELD.findall(row.group(1)))
+
+
+def ingest_langlinks(langlinks_path: str, page_path: str, lang_code: str,
+                     autonym_lang_codes: list, batch_size: int = 10000):
+    """
+    Cache the language links of the known pages from a langlinks dump and
+    fill the page_autonyms table.
+
+    The page dump is streamed first to map the page ids of the known titles,
+    so memory is bounded by the number of known pages, not the dump size.
+    """
+    known_titles = db.get_known_titles(lang_code)
+    page_titles = {}
+    for page_id, namespace, title, *_ in iter_sql_rows(page_path, 'page'):
+        if namespace == '0':
+            title = canonical_title(title)
+            if title in known_titles:
+                page_titles[page_id] = title
+    logger.info(f'Mapped {len(page_titles)} known pages from {page_path}')
+
+    n = 0
+    rows = []
+    for page_id, target_lang_code, target_title in iter_sql_rows(
+            langlinks_path, 'langlinks'):
+        if page_id in page_titles and target_lang_code in autonym_lang_codes:
+            rows.append((lang_code, page_titles[page_id], target_lang_code,
+                         canonical_title(target_title)))
+        if len(rows) >= batch_size:
+            db.insert_language_links(rows)
+            n += len(rows)
+            rows = []
+    db.insert_language_links(rows)
+    n += len(rows)
+    logger.info(f'Cached {n} language links from {langlinks_path}')
+    db.fill_autonyms(lang_code, float(SIM_THRESHOLD), autonym_lang_codes)
+
+
+class DumpIngester:
+    """
+    Ingests a dump into the database.
+
+    - seed_embedding: The seed page embedding, as computed by the Crawler.
+    - batch_size (int): Number of articles scored and written per batch.
+    - sim_threshold (float): Minimum similarity to the seed to keep a page.
+
+    Usage:
+        crawler = Crawler(lang_code='en')
+        DumpIngester(crawler.seed_embedding).ingest(path, 'en')
+    """
+    def __init__(self, seed_embedding, batch_size: int = 256,
+                 sim_threshold: float = SIM_THRESHOLD):
+        self.seed_embedding = seed_embedding
+        self.batch_size = batch_size
+        self.sim_threshold = float(sim_threshold)
+
+    def ingest(self, path: str, lang_code: str):
+        """Stream the dump at path and write the similar articles."""
+        logger.info(f'Ingesting {path}')
+        start = time.perf_counter()
+        n_read = n_saved = 0
+        batch = []
+        for article in iter_dump(path, lang_code):
+            n_read += 1
+            if not article.extracted.paragraphs:
+                continue
+            batch.append(article)
+            if len(batch) >= self.batch_size:
+                n_saved += self.save_batch(batch)
+                batch = []
+                logger.info(f'Read {n_read} articles, saved {n_saved}')
+        if batch:
+            n_saved += self.save_batch(batch)
+        n_links = db.resolve_dump_links(lang_code)
+        logger.info(f'Ingested {n_saved} of {n_read} articles and {n_links} '
+                    f'page links in {time.perf_counter() - start:.0f} s')
+
+    def save_batch(self, articles: list) -> int:
+        """
+        Score a batch of articles against the seed and write the similar
+        ones with their paragraphs, embeddings and links.
+
+        Returns:
+            int: The number of articles saved.
+        """
+        from wiki_graph import encode_paragraphs, page_similarity_score
+
+        # encode the paragraphs of the whole batch once, for the page scores
+        # and the paragraph corpus
+        embeddings = encode_paragraphs(
+            [text for a in articles for text in a.extracted.paragraphs])
+        scored = []
+        start = 0
+        for a in articles:
+            end = start + len(a.extracted.paragraphs)
+            sim_score = page_similarity_score(embeddings[start:end],
+                                              self.seed_embedding)
+            if sim_score >= self.sim_threshold:
+                scored.append((a, sim_score, embeddings[start:end]))
+            start = end
+        if not scored:
+            return 0
+
+        page_ids = db.insert_pages_bulk(
+            [(a.title, a.lang_code, html_url(a.title, a.lang_code), s,
+              a.revision_id) for a, s, _ in scored])
+
+        db.insert_paragraphs_bulk(
+            [(page_ids[a.title], text, to_blob(e, 'float32'), position)
+             for a, _, article_embeddings in scored
+             for position, (text, e)
+             in enumerate(zip(a.extracted.paragraphs, article_embeddings))])
+
+        db.insert_dump_links(
+            [(page_ids[a.title], canonical_title(name), a.lang_code)
+             for a, _, _ in scored
+             for name in a.extracted.internal_page_names])
+        return len(scored)
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("path", help="Enterprise HTML .tar.gz, XML .bz2 or "
+                    "langlinks .sql.gz dump")
+    ap.add_argument("--lang-code", required=True)
+    ap.add_argument("--page-dump", help="page .sql.gz dump, required with "
+                    "a langlinks dump")
+    ap.add_argument("--batch-size", type=int, default=256)
+    args = ap.parse_args()
+
+    db.create_tables()
+    if args.path.endswith('.sql.gz'):
+        if not args.page_dump:
+            ap.error("--page-dump is required with a langlinks dump")
+        autonym_lang_codes = [l for l in config["LANG_CODES"]
+                              if l != args.lang_code]
+        ingest_langlinks(args.path, args.page_dump, args.lang_code,
+                         autonym_lang_codes)
+        return
+
+    from wiki_graph import Crawler
+
+    crawler = Crawler(lang_code=args.lang_code)
+    ingester = DumpIngester(crawler.seed_embedding,
+                            batch_size=args.batch_size)
+    ingester.ingest(args.path, args.lang_code)
+
+
+if __name__ == "__main__":
+    main()
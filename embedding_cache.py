@@ -0,0 +1,189 @@
+"""
+Content-hash cache of the text embeddings.
+
+Embeddings are keyed by (model name, encode method, hash of the normalized
+text) and stored in a separate SQLite file (EMBEDDING_CACHE_DB), with an
+in-memory LRU of EMBEDDING_CACHE_SIZE entries in front of it. Repeated text,
+such as boilerplate paragraphs, the seed page and unchanged pages, is encoded
+only once across runs.
+
+The CachedEncoder wraps a SentenceTransformer and exposes the same encode,
+encode_query and encode_document methods; only the texts missing from the
+cache are passed to the model, in one call.
+
+Usage:
+    encoder = CachedEncoder(model, EmbeddingCache(model_name=SBERT_MODEL_NAME))
+    embeddings = encoder.encode(paragraphs)
+    encoder.cache.get_info()
+"""
+import hashlib
+import sqlite3
+from collections import OrderedDict
+from contextlib import closing
+import numpy as np
+from __init__ import logger, config
+
+
+EMBEDDING_CACHE_DB = config["EMBEDDING_CACHE_DB"]
+EMBEDDING_CACHE_SIZE = config["EMBEDDING_CACHE_SIZE"]
+
+# Maximum number of variables per SQLite query
+MAX_VARIABLES = 500
+
+
+def normalize_text(text: str) -> str:
+    """Collapse the whitespace of a text."""
+    return ' '.join(text.split())
+
+
+def text_hash(text: str) -> str:
+    """Return the sha256 hex digest of the normalized text."""
+    return hashlib.sha256(normalize_text(text).encode('utf-8')).hexdigest()
+
+
+class EmbeddingCache:
+    """
+    Disk cache of embeddings with an in-memory LRU in front of it.
+
+    - path (str): The SQLite file.
+    - model_name (str): The model the embeddings were computed with.
+    - maxsize (int): Number of embeddings kept in memory.
+    - hits, misses (int): Lookup counters, hits include memory and disk hits.
+    """
+    def __init__(self, path: str = EMBEDDING_CACHE_DB, model_name: str = '',
+                 maxsize: int = EMBEDDING_CACHE_SIZE):
+        self.path = path
+        self.model_name = model_name
+        self.maxsize = maxsize
+        self.lru = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.create_table()
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.path, timeout=30)
+
+    def create_table(self):
+        """Create the embeddings table."""
+        with closing(self._connect()) as conn, conn:
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS embeddings (
+                    model TEXT NOT NULL,
+                    kind TEXT NOT NULL,
+                    text_hash TEXT NOT NULL,
+                    embedding BLOB,
+                    PRIMARY KEY (model, kind, text_hash)
+                    ) WITHOUT ROWID
+                """
+                )
+
+    def _remember(self, key: tuple, embedding: np.ndarray):
+        self.lru[key] = embedding
+        self.lru.move_to_end(key)
+        if len(self.lru) > self.maxsize:
+            self.lru.popitem(last=False)
+
+    def get_many(self, kind: str, hashes: list) -> dict:
+        """Return the cached embeddings of the text hashes, by hash."""
+        found = {}
+        missing = []
+        for h in hashes:
+            key = (kind, h)
+            if key in self.lru:
+                self.lru.move_to_end(key)
+                found[h] = self.lru[key]
+            else:
+                missing.append(h)
+        if missing:
+            with closing(self._connect()) as conn:
+                for i in range(0, len(missing), MAX_VARIABLES):
+                    chunk = missing[i:i + MAX_VARIABLES]
+                    rows = conn.execute(
+                        f"""
+                        SELECT text_hash, embedding FROM embeddings
+                        WHERE model = ? AND kind = ?
+                        AND text_hash IN ({','.join('?' * len(chunk))})
+                        """, (self.model_name, kind, *chunk)
+                        ).fetchall()
+                    for h, blob in rows:
+                        embedding = np.frombuffer(blob, dtype=np.float32)
+                        self._remember((kind, h), embedding)
+                        found[h] = embedding
+        self.hits += sum(1 for h in hashes if h in found)
+        self.misses += sum(1 for h in hashes if h not in found)
+        return found
+
+    def put_many(self, kind: str, embeddings: dict):
+        """Cache embeddings by text hash."""
+        for h, embedding in embeddings.items():
+            self._remember((kind, h), embedding)
+        with closing(self._connect()) as conn, conn:
+            conn.executemany(
+                """
+                INSERT OR REPLACE INTO embeddings
+                (model, kind, text_hash, embedding) VALUES (?, ?, ?, ?)
+                """, [(self.model_name, kind, h, embedding.tobytes())
+                      for h, embedding in embeddings.items()]
+                )
+
+    def get_info(self) -> dict:
+        """Return the hit/miss counters and the number of cached embeddings."""
+        with closing(self._connect()) as conn:
+            count = conn.execute(
+                """
+                SELECT COUNT(*) FROM embeddings WHERE model = ?
+                """, (self.model_name,)
+                ).fetchone()[0]
+        lookups = self.hits + self.misses
+        info = {"hits": self.hits, "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "memory": len(self.lru), "disk": count}
+        logger.info(f"Embedding cache {self.path}: {info}")
+        return info
+
+
+class CachedEncoder:
+    """
+    SentenceTransformer wrapper that consults the EmbeddingCache before
+    encoding. encode, encode_query and encode_document take a text or a list
+    of texts, like the model methods, and return float32 numpy arrays.
+    Other attributes are those of the model.
+    """
+    def __init__(self, model, cache: EmbeddingCache):
+        self.model = model
+        self.cache = cache
+
+    def encode(self, texts, **kwargs) -> np.ndarray:
+        return self._encode('encode', texts, **kwargs)
+
+    def encode_query(self, texts, **kwargs) -> np.ndarray:
+        return self._encode('encode_query', texts, **kwargs)
+
+    def encode_document(self, texts, **kwargs) -> np.ndarray:
+        return self._encode('encode_document', texts, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.model, name)
+
+    def _encode(self, kind: str, texts, **kwargs) -> np.ndarray:
+        single = isinstance(texts, str)
+        if single:
+            texts = [texts]
+        hashes = [text_hash(text) for text in texts]
+        found = self.cache.get_many(kind, hashes)
+        # encode each missing text once, even if repeated in texts
+        missing = {}
+        for h, text in zip(hashes, texts):
+            if h not in found:
+                missing.setdefault(h, text)
+        if missing:
+            embeddings = getattr(self.model, kind)(list(missing.values()),
+                                                   **kwargs)
+            encoded = {h: np.asarray(e, dtype=np.float32)
+                       for h, e in zip(missing, embeddings)}
+            self.cache.put_many(kind, encoded)
+            found.update(encoded)
+        embeddings = np.vstack([found[h] for h in hashes]) if hashes \
+            else np.empty((0, 0), dtype=np.float32)
+        return embeddings[0] if single else embeddings
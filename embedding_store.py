@@ -0,0 +1,391 @@
+"""
+Memory-mapped sidecar of the paragraph embeddings.
+
+The embeddings of paragraph_corpus are mirrored, keyed by paragraph id, in
+.npy files of the directory EMBEDDING_STORE_DIR (by default
+<DB_NAME>.embeddings next to the database):
+    - ids.npy: the paragraph ids, ascending.
+    - codes.npy: the (n, dim) embeddings in their stored format.
+    - scales.npy: the per-row scales of int8 embeddings.
+    - exact_ids.npy, exact.npy: the float32 embeddings of the paragraphs
+      stored quantized, by ascending id, read only for the candidates that
+      are rescored (see quantization.rescore).
+The files are opened with np.load(mmap_mode='r') in O(1), their pages are
+read on demand, and several search processes share them through the page
+cache instead of each one holding a copy of the matrix.
+
+sync() brings the store up to date with the paragraph ids of the corpus:
+the paragraphs inserted since the last sync (ids only grow, the table is
+AUTOINCREMENT) are appended to the files in place, and the files are
+rewritten when paragraphs were deleted (e.g. by the Recrawler).
+
+The paragraphs are inserted with float32 embeddings, and sync() converts
+the new ones to EMBEDDING_DTYPE in the database (see _convert): with a
+quantized EMBEDDING_DTYPE and a RESCORE_FACTOR, their float32 embeddings
+move to exact.npy. quantize() converts all the stored embeddings.
+
+Usage:
+    codes, scales = EmbeddingStore().sync(paragraph_ids)
+    exact = store.exact_rows(candidate_paragraph_ids)
+"""
+import fcntl
+import os
+from contextlib import contextmanager
+import numpy as np
+from numpy.lib import format as npy
+from __init__ import logger, config
+import db_utils as db
+from quantization import (EMBEDDING_DTYPE, RESCORE_FACTOR, dequantize,
+                          from_blob, load_matrix, load_matrix_chunks,
+                          to_blob)
+
+
+EMBEDDING_STORE_DIR = config["EMBEDDING_STORE_DIR"]
+
+# Rows copied at a time when the files are rewritten
+COPY_ROWS = 65536
+
+
+@contextmanager
+def lock_dir(path: str):
+    """Hold the lock of a directory, across processes."""
+    os.makedirs(path, exist_ok=True)
+    with open(os.path.join(path, 'lock'), 'w') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def append_npy(path: str, array: np.ndarray, n_rows: int):
+    """
+    Write rows to a .npy file after its first n_rows rows, in place.
+
+    The data is written before the header is updated, so an interrupted
+    append leaves the file with its previous shape. The rows past n_rows
+    left by an interrupted append are overwritten.
+    """
+    if not os.path.exists(path):
+        np.save(path, array)
+        return
+    with open(path, 'r+b') as f:
+        version = npy.read_magic(f)
+        read_header = getattr(npy, 'read_array_header_%d_%d' % version)
+        shape, fortran_order, dtype = read_header(f)
+        offset = f.tell()
+        if dtype != array.dtype or shape[1:] != array.shape[1:]:
+            raise ValueError(f'Cannot append {array.dtype} {array.shape} '
+                             f'rows to {path} ({dtype} {shape})')
+        f.seek(offset + n_rows * dtype.itemsize * int(np.prod(shape[1:])))
+        f.write(np.ascontiguousarray(array).tobytes())
+        f.truncate()
+        f.flush()
+        f.seek(0)
+        header = {'descr': npy.dtype_to_descr(dtype),
+                  'fortran_order': fortran_order,
+                  'shape': (n_rows + len(array), *shape[1:])}
+        getattr(npy, 'write_array_header_%d_%d' % version)(f, header)
+        # np.save leaves room in the header for the shape to grow
+        if f.tell() != offset:
+            raise ValueError(f'The header of {path} cannot grow in place')
+
+
+class EmbeddingStore:
+    """
+    Memory-mapped paragraph embeddings keyed by paragraph id.
+
+    - path (str): The directory of the .npy files.
+    """
+    def __init__(self, path: str = None):
+        self.path = path or EMBEDDING_STORE_DIR or f'{db.DB_NAME}.embeddings'
+        self.exact_ids = np.empty(0, dtype=np.int64)
+        self.exact = None
+
+    def _file(self, name: str) -> str:
+        return os.path.join(self.path, f'{name}.npy')
+
+    def _lock(self):
+        """Hold the lock of the store, across processes."""
+        return lock_dir(self.path)
+
+    def open(self) -> tuple:
+        """
+        Memory-map the store.
+
+        Returns:
+            tuple: (ids, codes, scales), scales is None except for int8.
+            The arrays are empty if the store does not exist.
+        """
+        if not os.path.exists(self._file('ids')):
+            return (np.empty(0, dtype=np.int64),
+                    np.empty((0, 0), dtype=np.float32), None)
+        # ids.npy is written last, the other files may have extra rows
+        ids = np.load(self._file('ids'), mmap_mode='r')
+        codes = np.load(self._file('codes'), mmap_mode='r')[:len(ids)]
+        scales = None
+        if os.path.exists(self._file('scales')):
+            scales = np.load(self._file('scales'), mmap_mode='r')[:len(ids)]
+        return ids, codes, scales
+
+    def open_exact(self) -> tuple:
+        """
+        Memory-map the float32 embeddings of the quantized paragraphs.
+
+        Returns:
+            tuple: (exact_ids, exact), exact is None if there are none.
+        """
+        if not os.path.exists(self._file('exact_ids')):
+            return np.empty(0, dtype=np.int64), None
+        # exact_ids.npy is written last
+        exact_ids = np.load(self._file('exact_ids'), mmap_mode='r')
+        exact = np.load(self._file('exact'), mmap_mode='r')[:len(exact_ids)]
+        return exact_ids, exact
+
+    def exact_rows(self, paragraph_ids) -> np.ndarray:
+        """
+        Read the float32 embeddings of paragraphs from exact.npy, as of the
+        last sync (or of the first call).
+
+        Returns:
+            np.ndarray: The (len(paragraph_ids), dim) embeddings, or None if
+            some of the paragraphs have none.
+        """
+        paragraph_ids = np.asarray(paragraph_ids, dtype=np.int64)
+        if self.exact is None:
+            self.exact_ids, self.exact = self.open_exact()
+        if self.exact is None:
+            return None
+        rows = np.searchsorted(self.exact_ids, paragraph_ids)
+        rows[rows == len(self.exact_ids)] = 0
+        if not np.array_equal(self.exact_ids[rows], paragraph_ids):
+            return None
+        return np.asarray(self.exact[rows])
+
+    def append_exact(self, paragraph_ids: np.ndarray, exact: np.ndarray):
+        """Append float32 embeddings with greater ids to exact.npy."""
+        os.makedirs(self.path, exist_ok=True)
+        exact_ids = self.open_exact()[0]
+        new = paragraph_ids > (exact_ids[-1] if len(exact_ids) else 0)
+        append_npy(self._file('exact'), exact[new].astype(np.float32),
+                   len(exact_ids))
+        append_npy(self._file('exact_ids'), paragraph_ids[new], len(exact_ids))
+
+    def _remove_files(self):
+        for name in ('ids', 'codes', 'scales'):
+            if os.path.exists(self._file(name)):
+                os.remove(self._file(name))
+
+    def quantize(self, dtype: str) -> int:
+        """
+        Convert all the stored embeddings to dtype (see _convert), and
+        delete the store but exact.npy, it is rebuilt by the next sync.
+
+        Returns:
+            int: The number of embeddings converted.
+        """
+        with self._lock():
+            n = self._convert(dtype)
+            if n:
+                self._remove_files()
+        return n
+
+    def _append(self, rows: list) -> bool:
+        """
+        Append (id, embedding, embedding_dtype) rows with greater ids than
+        the stored ones to a non-empty store.
+
+        Returns:
+            bool: False if the rows cannot be appended in the dtype of the
+            store, which must then be rebuilt.
+        """
+        ids, codes, scales = self.open()
+        new_codes, new_scales = load_matrix([(blob, dtype)
+                                             for _, blob, dtype in rows])
+        if new_codes.shape[1] != codes.shape[1]:
+            return False
+        if new_codes.dtype != codes.dtype:
+            if codes.dtype != np.float32:
+                return False
+            new_codes, new_scales = dequantize(new_codes, new_scales), None
+        new_ids = np.array([paragraph_id for paragraph_id, _, _ in rows],
+                           dtype=np.int64)
+        append_npy(self._file('codes'), new_codes, len(ids))
+        if new_scales is not None:
+            append_npy(self._file('scales'), new_scales, len(ids))
+        append_npy(self._file('ids'), new_ids, len(ids))
+        return True
+
+    def _rewrite(self, arrays: dict, keep: np.ndarray):
+        """
+        Rewrite the files of arrays with the rows of the keep mask only,
+        the last one (the ids) is replaced last.
+        """
+        n = int(keep.sum())
+        for name, array in arrays.items():
+            tmp = os.path.join(self.path, f'{name}.tmp.npy')
+            out = npy.open_memmap(tmp, mode='w+', dtype=array.dtype,
+                                  shape=(n, *array.shape[1:]))
+            i = 0
+            for start in range(0, len(array), COPY_ROWS):
+                chunk = array[start:start + COPY_ROWS][
+                    keep[start:start + COPY_ROWS]]
+                out[i:i + len(chunk)] = chunk
+                i += len(chunk)
+            out.flush()
+            del out
+        # the open memory maps keep the replaced files
+        for name in arrays:
+            os.replace(os.path.join(self.path, f'{name}.tmp.npy'),
+                       self._file(name))
+
+    def _delete_exact(self, paragraph_ids: np.ndarray, max_id: int):
+        """Rewrite exact.npy without the paragraphs deleted from the corpus."""
+        exact_ids, exact = self.open_exact()
+        known = exact_ids[:np.searchsorted(exact_ids, max_id, side='right')]
+        deleted = ~np.isin(known, paragraph_ids, assume_unique=True)
+        if deleted.any():
+            keep = np.ones(len(exact_ids), dtype=bool)
+            keep[:len(known)] = ~deleted
+            self._rewrite({'exact': exact, 'exact_ids': exact_ids}, keep)
+
+    def _append_chunks(self, min_id: int, max_id: int) -> bool:
+        """
+        Append the paragraphs with ids in (min_id, max_id], one chunk at
+        a time.
+
+        Returns:
+            bool: False if the store must be rebuilt, see _append.
+        """
+        with db.paragraph_embedding_rows_chunks(min_id, max_id) \
+                as (n_rows, chunks):
+            for rows in chunks:
+                if not self._append(rows):
+                    return False
+        logger.info(f'Appended {n_rows} embeddings to the embedding store')
+        return True
+
+    def _rebuild(self, max_id: int):
+        """
+        Write the store of the paragraphs with ids up to max_id: the files
+        are preallocated from the row count and filled one chunk at a time.
+        """
+        self._remove_files()
+        dtype = db.get_embedding_dtype()
+
+        def tmp_file(name):
+            return os.path.join(self.path, f'{name}.tmp.npy')
+
+        def empty(name, shape, dtype):
+            return npy.open_memmap(tmp_file(name), mode='w+', dtype=dtype,
+                                   shape=shape)
+
+        with db.paragraph_embedding_rows_chunks(max_id=max_id) \
+                as (n_rows, chunks):
+            if not n_rows:
+                return
+            ids = empty('ids', (n_rows,), np.int64)
+
+            def blobs():
+                i = 0
+                for rows in chunks:
+                    ids[i:i + len(rows)] = [row[0] for row in rows]
+                    i += len(rows)
+                    yield [(blob, dtype_) for _, blob, dtype_ in rows]
+
+            arrays = dict(zip(('codes', 'scales'),
+                              load_matrix_chunks(n_rows, blobs(), dtype,
+                                                 empty)))
+        arrays['ids'] = ids
+        # ids.npy is replaced last
+        for name in ('codes', 'scales', 'ids'):
+            if arrays[name] is not None:
+                arrays[name].flush()
+                os.replace(tmp_file(name), self._file(name))
+        logger.info(f'Rebuilt the embedding store {self.path} '
+                    f'with {n_rows} {dtype} embeddings')
+
+    def _convert(self, dtype: str, min_id: int = 0, max_id: int = None,
+                float32_only: bool = False) -> int:
+        """
+        Convert the stored embeddings of the paragraphs with ids in
+        (min_id, max_id] (only the float32 ones if float32_only) to dtype,
+        one chunk at a time. The float32 embeddings converted to a
+        quantized dtype are appended to exact.npy first, if RESCORE_FACTOR.
+        Called under the lock of the store, see quantize and sync.
+
+        Returns:
+            int: The number of embeddings converted.
+        """
+        n = 0
+        with db.paragraph_embedding_rows_chunks(min_id, max_id) \
+                as (_, chunks), \
+                db.BulkWriter(db.PARAGRAPH_EMBEDDING_UPDATE) as writer:
+            for rows in chunks:
+                rows = [(paragraph_id, blob, dtype_ or 'float32')
+                        for paragraph_id, blob, dtype_ in rows]
+                rows = [(paragraph_id, from_blob(blob, dtype_), dtype_)
+                        for paragraph_id, blob, dtype_ in rows
+                        if dtype_ != dtype
+                        and (dtype_ == 'float32' or not float32_only)]
+                if not rows:
+                    continue
+                exact = [(paragraph_id, embedding)
+                         for paragraph_id, embedding, dtype_ in rows
+                         if dtype_ == 'float32']
+                if exact and dtype != 'float32' and RESCORE_FACTOR:
+                    self.append_exact(
+                        np.array([i for i, _ in exact], dtype=np.int64),
+                        np.vstack([embedding for _, embedding in exact]))
+                writer.add_many([(to_blob(embedding, dtype), dtype,
+                                  paragraph_id)
+                                 for paragraph_id, embedding, _ in rows])
+                n += len(rows)
+        if n:
+            logger.info(f'Converted {n} embeddings to {dtype}')
+        return n
+
+    def sync(self, paragraph_ids) -> tuple:
+        """
+        Bring the store up to date with the corpus and memory-map it.
+
+        Args:
+            paragraph_ids: The ascending ids of the corpus paragraphs.
+
+        Returns:
+            tuple: (codes, scales), row i holds the embedding of
+            paragraph_ids[i].
+        """
+        paragraph_ids = np.asarray(paragraph_ids, dtype=np.int64)
+        max_id = int(paragraph_ids[-1]) if len(paragraph_ids) else 0
+        with self._lock():
+            ids = self.open()[0]
+            # ids above max_id were appended by a process with a newer corpus
+            known = ids[:np.searchsorted(ids, max_id, side='right')]
+            deleted = ~np.isin(known, paragraph_ids, assume_unique=True)
+            if deleted.any():
+                keep = np.ones(len(ids), dtype=bool)
+                keep[:len(known)] = ~deleted
+                _, codes, scales = self.open()
+                arrays = {'codes': codes}
+                if scales is not None:
+                    arrays['scales'] = scales
+                arrays['ids'] = ids
+                self._rewrite(arrays, keep)
+                logger.info(f'Deleted {int(deleted.sum())} embeddings '
+                            f'from the embedding store')
+            self._delete_exact(paragraph_ids, max_id)
+            last_id = int(ids[-1]) if len(ids) else 0
+            if max_id > last_id:
+                if EMBEDDING_DTYPE != 'float32':
+                    self._convert(EMBEDDING_DTYPE, last_id, max_id,
+                                 float32_only=True)
+                if not len(ids) or not self._append_chunks(last_id, max_id):
+                    self._rebuild(max_id)
+            ids, codes, scales = self.open()
+            self.exact_ids, self.exact = self.open_exact()
+        n = np.searchsorted(ids, max_id, side='right')
+        if not np.array_equal(ids[:n], paragraph_ids):
+            raise RuntimeError('The paragraph corpus changed while loading '
+                               'the embeddings, load it again')
+        return codes[:n], None if scales is None else scales[:n]
@@ -0,0 +1,197 @@
+"""
+Lazy loading of the sentence embedding model.
+
+sentence-transformers (and torch) are imported and the SBERT model is loaded
+on the first call to get_model(), not when the modules using it are
+imported, so commands that do not encode text start fast.
+
+The model runs on one of the ENCODER_BACKENDS, set with ENCODER_BACKEND in
+config.ini:
+    - 'torch' (default): the PyTorch SentenceTransformer.
+    - 'onnx': an ONNX Runtime export of the model on the CPU.
+    - 'onnx-int8': the ONNX export with int8 dynamic quantization
+      (ENCODER_QUANTIZATION: 'avx2', 'avx512', 'avx512_vnni' or 'arm64'),
+      exported once to a directory of ENCODER_DIR.
+The ONNX backends need `pip install sentence-transformers[onnx]`.
+
+ENCODER_THREADS and ENCODER_INTEROP_THREADS set the intra-op and inter-op
+thread pools of the backend (0 keeps the library default).
+
+The embeddings of a backend are compatible with those of 'torch' when the
+cosine distance of every embedding to the torch one is at most
+TOLERANCES[backend]; check it with check_compatibility() or
+`python bench.py encoder`.
+
+Usage:
+    embeddings = get_model().encode(paragraphs)
+"""
+import os
+import time
+import numpy as np
+from __init__ import logger, config
+from embedding_cache import CachedEncoder, EmbeddingCache
+
+
+SBERT_MODEL_NAME = config["SBERT_MODEL_NAME"]
+ENCODER_BACKEND = config["ENCODER_BACKEND"]
+ENCODER_THREADS = config["ENCODER_THREADS"]
+ENCODER_INTEROP_THREADS = config["ENCODER_INTEROP_THREADS"]
+ENCODER_QUANTIZATION = config["ENCODER_QUANTIZATION"]
+ENCODER_DIR = config["ENCODER_DIR"]
+
+ENCODER_BACKENDS = ('torch', 'onnx', 'onnx-int8')
+
+# Maximum cosine distance to the torch embedding of the same text
+TOLERANCES = {'torch': 0.0, 'onnx': 1e-4, 'onnx-int8': 2e-2}
+
+_model = None
+# Embedding caches by cache model name, see get_cache
+_caches = {}
+
+
+def check_backend(backend: str):
+    if backend not in ENCODER_BACKENDS:
+        raise ValueError(f'Unknown encoder backend {backend}, '
+                         f'use one of {", ".join(ENCODER_BACKENDS)}')
+
+
+def cache_model_name(backend: str = ENCODER_BACKEND) -> str:
+    """
+    Return the model name the embeddings of a backend are cached under:
+    the backends do not share cached embeddings.
+    """
+    if backend == 'torch':
+        return SBERT_MODEL_NAME
+    return f'{SBERT_MODEL_NAME}:{backend}'
+
+
+def set_torch_threads(threads: int, interop_threads: int):
+    import torch
+
+    if threads:
+        torch.set_num_threads(threads)
+    if interop_threads:
+        try:
+            torch.set_num_interop_threads(interop_threads)
+        except RuntimeError as e:
+            # can only be set once, before any inter-op parallel work
+            logger.warning(f'Could not set the inter-op threads: {e}')
+
+
+def onnx_model_kwargs(threads: int, interop_threads: int) -> dict:
+    """Return the ONNX Runtime session settings of the backend."""
+    import onnxruntime as ort
+
+    options = ort.SessionOptions()
+    if threads:
+        options.intra_op_num_threads = threads
+    if interop_threads:
+        options.inter_op_num_threads = interop_threads
+        options.execution_mode = ort.ExecutionMode.ORT_PARALLEL
+    return {'provider': 'CPUExecutionProvider', 'session_options': options}
+
+
+def export_dir() -> str:
+    """Return the directory of the ONNX exports of the model."""
+    return os.path.join(ENCODER_DIR, SBERT_MODEL_NAME.replace('/', '__'))
+
+
+def export_quantized_onnx(model_kwargs: dict) -> str:
+    """
+    Export the model to ONNX with int8 dynamic quantization, once.
+
+    Returns:
+        str: The file name of the quantized model in export_dir().
+    """
+    from sentence_transformers import (SentenceTransformer,
+                                       export_dynamic_quantized_onnx_model)
+
+    path = export_dir()
+    file_name = f'model_qint8_{ENCODER_QUANTIZATION}.onnx'
+    if not os.path.exists(os.path.join(path, 'onnx', file_name)):
+        logger.info(f'Exporting {SBERT_MODEL_NAME} to {path} with '
+                    f'int8 quantization ({ENCODER_QUANTIZATION})')
+        model = SentenceTransformer(SBERT_MODEL_NAME, backend='onnx',
+                                    model_kwargs=model_kwargs)
+        model.save(path)
+        export_dynamic_quantized_onnx_model(model, ENCODER_QUANTIZATION, path)
+    return os.path.join('onnx', file_name)
+
+
+def load_encoder(backend: str = ENCODER_BACKEND,
+                 threads: int = ENCODER_THREADS,
+                 interop_threads: int = ENCODER_INTEROP_THREADS):
+    """
+    Load the SentenceTransformer of SBERT_MODEL_NAME on a backend,
+    without the embedding cache.
+    """
+    check_backend(backend)
+    start = time.perf_counter()
+    from sentence_transformers import SentenceTransformer
+
+    set_torch_threads(threads, interop_threads)
+    if backend == 'torch':
+        model = SentenceTransformer(SBERT_MODEL_NAME)
+    else:
+        model_kwargs = onnx_model_kwargs(threads, interop_threads)
+        if backend == 'onnx-int8':
+            model_kwargs['file_name'] = export_quantized_onnx(model_kwargs)
+            model = SentenceTransformer(export_dir(), backend='onnx',
+                                        model_kwargs=model_kwargs)
+        else:
+            model = SentenceTransformer(SBERT_MODEL_NAME, backend='onnx',
+                                        model_kwargs=model_kwargs)
+    logger.info(f'Loaded {SBERT_MODEL_NAME} ({backend}, threads '
+                f'{threads or "default"}/{interop_threads or "default"}) '
+                f'in {time.perf_counter() - start:.1f} s')
+    return model
+
+
+def get_cache(backend: str = ENCODER_BACKEND) -> EmbeddingCache:
+    """
+    Return the embedding cache of a backend, created on first use and
+    shared by the model and the encoder pools of this process, so that
+    their hit/miss counters add up (see get_caches).
+    """
+    model_name = cache_model_name(backend)
+    if model_name not in _caches:
+        _caches[model_name] = EmbeddingCache(model_name=model_name)
+    return _caches[model_name]
+
+
+def get_caches() -> list:
+    """Return the embedding caches used by this process."""
+    return list(_caches.values())
+
+
+def get_model() -> CachedEncoder:
+    """Return the SBERT model behind the embedding cache, loaded once."""
+    global _model
+    if _model is None:
+        _model = CachedEncoder(load_encoder(), get_cache())
+    return _model
+
+
+def cosine_distances(reference: np.ndarray,
+                     embeddings: np.ndarray) -> np.ndarray:
+    """Return the row-wise cosine distances of two embedding matrices."""
+    reference = np.asarray(reference, dtype=np.float32)
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    norms = (np.linalg.norm(reference, axis=1)
+             * np.linalg.norm(embeddings, axis=1))
+    norms[norms == 0] = 1.0
+    return 1 - (reference * embeddings).sum(axis=1) / norms
+
+
+def check_compatibility(reference: np.ndarray, embeddings: np.ndarray,
+                        backend: str) -> bool:
+    """
+    Check that the embeddings of a backend are within TOLERANCES[backend]
+    of the torch embeddings of the same texts.
+    """
+    distance = float(cosine_distances(reference, embeddings).max())
+    compatible = distance <= TOLERANCES[backend]
+    logger.info(f'{backend}: max cosine distance to torch {distance:.2e}, '
+                f'tolerance {TOLERANCES[backend]:.0e}, '
+                f'compatible: {compatible}')
+    return compatible
@@ -0,0 +1,192 @@
+"""
+Multi-process encoding of paragraph batches.
+
+A pool of ENCODER_POOL_SIZE worker processes (spawned, each with its own
+copy of the model on ENCODER_BACKEND and ENCODER_POOL_THREADS intra-op
+threads) consumes batches of texts from a task queue and sends their
+embeddings back on a result queue. The parent process looks the texts up in
+the embedding cache, sends only the missing ones, and is the single writer
+of the results.
+
+On Ctrl-C (or any error) the workers are terminated; the workers ignore
+SIGINT themselves, so that only the parent handles it.
+
+Usage:
+    with EncoderPool() as pool:
+        for i, embeddings in pool.encode_batches(batches):
+            save(batches[i], embeddings)
+"""
+import multiprocessing
+import os
+import queue
+import signal
+import traceback
+import numpy as np
+from __init__ import logger, config
+from embedding_cache import text_hash
+from encoder import (ENCODER_BACKEND, ENCODER_INTEROP_THREADS, get_cache,
+                     load_encoder)
+
+
+ENCODER_POOL_SIZE = config["ENCODER_POOL_SIZE"]
+ENCODER_POOL_THREADS = config["ENCODER_POOL_THREADS"]
+EMBED_BATCH_SIZE = config["EMBED_BATCH_SIZE"]
+
+# Batches queued per worker
+BATCHES_PER_WORKER = 2
+# Seconds between checks that the workers are alive
+POLL_SECONDS = 1.0
+# Seconds to wait for the workers to exit before terminating them
+JOIN_SECONDS = 10.0
+
+
+def _worker(tasks, results, backend: str, threads: int,
+            interop_threads: int, batch_size: int):
+    """Encode the batches of the task queue until a None task."""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    try:
+        model = load_encoder(backend, threads, interop_threads)
+    except Exception:
+        results.put((None, None, traceback.format_exc()))
+        return
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        i, texts = task
+        try:
+            embeddings = model.encode(texts, batch_size=batch_size)
+            results.put((i, np.asarray(embeddings, dtype=np.float32), None))
+        except Exception:
+            results.put((i, None, traceback.format_exc()))
+
+
+class EncoderPool:
+    """
+    Pool of encoder worker processes.
+
+    - size (int): Number of worker processes.
+    - threads (int): Intra-op threads per worker, by default the cpu count
+      divided by the pool size.
+    - backend (str): The encoder backend of the workers.
+    - batch_size (int): Batch size of the model.
+    - cache (EmbeddingCache): The cache consulted before encoding, shared
+      with the model of this process (see encoder.get_cache).
+    """
+    def __init__(self, size: int = ENCODER_POOL_SIZE,
+                 threads: int = ENCODER_POOL_THREADS,
+                 backend: str = ENCODER_BACKEND,
+                 batch_size: int = EMBED_BATCH_SIZE):
+        self.size = max(1, size)
+        self.threads = threads or max(1, (os.cpu_count() or 1) // self.size)
+        self.backend = backend
+        self.batch_size = batch_size
+        self.cache = get_cache(backend)
+        self.processes = []
+        self.tasks = None
+        self.results = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            if exc_type is KeyboardInterrupt:
+                logger.warning('Interrupted, stopping the encoder pool')
+            self.terminate()
+
+    def start(self):
+        """Start the worker processes."""
+        ctx = multiprocessing.get_context('spawn')
+        self.tasks = ctx.Queue()
+        self.results = ctx.Queue()
+        self.processes = [
+            ctx.Process(target=_worker,
+                        args=(self.tasks, self.results, self.backend,
+                              self.threads, ENCODER_INTEROP_THREADS,
+                              self.batch_size),
+                        daemon=True)
+            for _ in range(self.size)]
+        for process in self.processes:
+            process.start()
+        logger.info(f'Started {self.size} encoder workers ({self.backend}, '
+                    f'{self.threads} threads each)')
+
+    def close(self):
+        """Stop the workers once they are done with the queued batches."""
+        for _ in self.processes:
+            self.tasks.put(None)
+        for process in self.processes:
+            process.join(JOIN_SECONDS)
+        self.terminate()
+
+    def terminate(self):
+        """Stop the workers now."""
+        for process in self.processes:
+            if process.is_alive():
+                process.terminate()
+        for process in self.processes:
+            process.join()
+        if self.tasks is not None:
+            self.tasks.cancel_join_thread()
+            self.results.cancel_join_thread()
+        self.processes = []
+
+    def _get_result(self) -> tuple:
+        while True:
+            try:
+                i, embeddings, error = self.results.get(timeout=POLL_SECONDS)
+            except queue.Empty:
+                if not all(p.is_alive() for p in self.processes):
+                    raise RuntimeError('An encoder worker died')
+                continue
+            if error is not None:
+                raise RuntimeError(f'Encoder worker failed:\n{error}')
+            return i, embeddings
+
+    def encode_batches(self, batches: list):
+        """
+        Encode batches of texts in the workers.
+
+        Args:
+            batches (list): List of lists of texts.
+
+        Yields:
+            tuple: (batch index, embeddings), in the order the batches are
+            encoded. Batches found in the cache are yielded first.
+        """
+        pending = {}
+        for i, texts in enumerate(batches):
+            hashes = [text_hash(text) for text in texts]
+            found = self.cache.get_many('encode', hashes)
+            missing = {}
+            for h, text in zip(hashes, texts):
+                if h not in found:
+                    missing.setdefault(h, text)
+            if missing:
+                pending[i] = (hashes, found, missing)
+            else:
+                yield i, np.vstack([found[h] for h in hashes])
+
+        queued = iter(list(pending))
+        in_flight = 0
+        for i in queued:
+            self.tasks.put((i, list(pending[i][2].values())))
+            in_flight += 1
+            if in_flight == self.size * BATCHES_PER_WORKER:
+                break
+        while in_flight:
+            i, embeddings = self._get_result()
+            in_flight -= 1
+            next_i = next(queued, None)
+            if next_i is not None:
+                self.tasks.put((next_i, list(pending[next_i][2].values())))
+                in_flight += 1
+            hashes, found, missing = pending.pop(i)
+            encoded = dict(zip(missing, embeddings))
+            self.cache.put_many('encode', encoded)
+            found.update(encoded)
+            yield i, np.vstack([found[h] for h in hashes])
@@ -0,0 +1,232 @@
+"""
+Parquet export of the corpus, the embeddings and the link graph.
+
+The pages, paragraph_corpus, page_links and page_autonyms tables are
+exported to Parquet datasets under EXPORT_DIR (one directory per table),
+partitioned by lang_code (lang_code=en/, ...). The lang_code of a paragraph
+or a link is that of its (source) page. The paragraph embeddings are
+exported as float32, in a fixed-size list column, whatever their stored
+format.
+
+The export is incremental: the greatest exported id of every table (its
+high-water mark) is kept in EXPORT_DIR/_state.json, and the next export
+appends the rows with greater ids as new files. Rows updated in place
+(e.g. the scores of recrawled pages) or deleted since their export are not
+followed; export with full=True (`python cli.py export --full`) to rewrite
+the datasets.
+
+The loader reads a dataset back through Arrow, from memory-mapped files;
+embedding_matrix() views the embeddings as a numpy matrix without copying
+them when the table is a single chunk.
+
+Needs `pip install pyarrow`.
+
+Usage:
+    export_tables()
+    table = load_table('paragraph_corpus', lang_code='en')
+    embeddings = embedding_matrix(table)
+"""
+import json
+import os
+import shutil
+import numpy as np
+from __init__ import logger, config
+import db_utils as db
+from quantization import dequantize, load_matrix
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.dataset as ds
+    import pyarrow.parquet as pq
+    from pyarrow import fs
+except ImportError:
+    pa = None
+
+
+EXPORT_DIR = config["EXPORT_DIR"]
+
+EXPORT_TABLES = ('pages', 'paragraph_corpus', 'page_links', 'page_autonyms')
+
+# Rows per Parquet row group
+ROW_GROUP_SIZE = 65536
+# Partition name of the rows without lang_code, as read by Arrow
+NULL_PARTITION = '__HIVE_DEFAULT_PARTITION__'
+
+
+def check_pyarrow():
+    if pa is None:
+        raise ImportError('The Parquet export needs pyarrow: '
+                          'pip install pyarrow')
+
+
+def _schema(table: str, dim: int = 0) -> 'pa.Schema':
+    """Return the schema of the rows of db.EXPORT_QUERIES[table]."""
+    fields = {
+        'pages': [
+            ('id', pa.int64()), ('name', pa.string()), ('url', pa.string()),
+            ('crawled_at', pa.string()), ('sim_score', pa.float64()),
+            ('revision_id', pa.int64())],
+        'paragraph_corpus': [
+            ('id', pa.int64()), ('page_id', pa.int64()),
+            ('text', pa.string()), ('position', pa.int64()),
+            ('embedding', pa.list_(pa.float32(), dim))],
+        'page_links': [
+            ('id', pa.int64()), ('source_page_id', pa.int64()),
+            ('target_page_id', pa.int64())],
+        'page_autonyms': [
+            ('id', pa.int64()), ('source_page_id', pa.int64()),
+            ('autonym', pa.string()), ('autonym_page_id', pa.int64())],
+        }[table]
+    return pa.schema(fields + [('lang_code', pa.string())])
+
+
+def _record_batch(table: str, rows: list) -> 'pa.RecordBatch':
+    """Convert a chunk of rows of db.EXPORT_QUERIES[table]."""
+    columns = [list(column) for column in zip(*rows)]
+    if table == 'paragraph_corpus':
+        # id, page_id, text, position, embedding, embedding_dtype, lang_code
+        embeddings = dequantize(*load_matrix(list(zip(columns[4],
+                                                      columns[5]))))
+        dim = embeddings.shape[1]
+        embedding = pa.FixedSizeListArray.from_arrays(
+            pa.array(embeddings.ravel(), type=pa.float32()), dim)
+        schema = _schema(table, dim)
+        arrays = [pa.array(column, type=field.type) for column, field
+                  in zip(columns[:4], schema)]
+        arrays += [embedding, pa.array(columns[6], type=pa.string())]
+        return pa.RecordBatch.from_arrays(arrays, schema=schema)
+    schema = _schema(table)
+    return pa.RecordBatch.from_arrays(
+        [pa.array(column, type=field.type)
+         for column, field in zip(columns, schema)],
+        schema=schema)
+
+
+def read_state(path: str = EXPORT_DIR) -> dict:
+    """Return the high-water marks of the exported tables."""
+    state_path = os.path.join(path, '_state.json')
+    if not os.path.exists(state_path):
+        return {}
+    with open(state_path) as f:
+        return json.load(f)
+
+
+def write_state(state: dict, path: str = EXPORT_DIR):
+    os.makedirs(path, exist_ok=True)
+    state_path = os.path.join(path, '_state.json')
+    with open(state_path + '.tmp', 'w') as f:
+        json.dump(state, f, indent=2)
+    os.replace(state_path + '.tmp', state_path)
+
+
+def export_table(table: str, min_id: int, max_id: int,
+                 path: str = EXPORT_DIR) -> int:
+    """
+    Append the rows of a table with ids in (min_id, max_id] to its dataset.
+
+    Returns:
+        int: The number of rows exported.
+    """
+    check_pyarrow()
+    file_name = f'part-{min_id + 1}-{max_id}.parquet'
+    # One file per partition, written under a name the readers ignore
+    # and renamed once complete
+    writers = {}
+    try:
+        with db.export_rows_chunks(table, min_id, max_id) \
+                as (n_rows, chunks):
+            for rows in chunks:
+                batch = _record_batch(table, rows)
+                lang_codes = batch.column('lang_code')
+                batch = batch.select(batch.schema.names[:-1])
+                for lang_code in pc.unique(lang_codes).to_pylist():
+                    if lang_code is None:
+                        mask = pc.is_null(lang_codes)
+                    else:
+                        mask = pc.equal(lang_codes, lang_code)
+                    if lang_code not in writers:
+                        directory = os.path.join(
+                            path, table,
+                            f'lang_code={lang_code or NULL_PARTITION}')
+                        os.makedirs(directory, exist_ok=True)
+                        writers[lang_code] = (directory, pq.ParquetWriter(
+                            os.path.join(directory, f'_{file_name}'),
+                            batch.schema))
+                    writers[lang_code][1].write_batch(
+                        batch.filter(mask), row_group_size=ROW_GROUP_SIZE)
+    finally:
+        for _, writer in writers.values():
+            writer.close()
+    for directory, _ in writers.values():
+        os.replace(os.path.join(directory, f'_{file_name}'),
+                   os.path.join(directory, file_name))
+    return n_rows
+
+
+def export_tables(full: bool = False, path: str = EXPORT_DIR) -> dict:
+    """
+    Export the rows added to the EXPORT_TABLES since the last export.
+
+    Args:
+        full (bool): Rewrite the datasets from scratch.
+        path (str): The export directory.
+
+    Returns:
+        dict: The number of rows exported per table.
+    """
+    check_pyarrow()
+    state = read_state(path)
+    exported = {}
+    for table in EXPORT_TABLES:
+        if full:
+            shutil.rmtree(os.path.join(path, table), ignore_errors=True)
+            state.pop(table, None)
+        min_id = state.get(table, 0)
+        max_id = db.get_max_id(table)
+        exported[table] = 0
+        if max_id > min_id:
+            exported[table] = export_table(table, min_id, max_id, path)
+            state[table] = max_id
+        write_state(state, path)
+        logger.info(f'Exported {exported[table]} rows of {table} to {path} '
+                    f'(high-water mark {state.get(table, 0)})')
+    return exported
+
+
+def load_table(table: str, lang_code: str = None, columns: list = None,
+               path: str = EXPORT_DIR) -> 'pa.Table':
+    """
+    Read an exported dataset from memory-mapped files.
+
+    Args:
+        table (str): One of the EXPORT_TABLES.
+        lang_code (str): Read only this partition, or all.
+        columns (list): Read only these columns, or all.
+        path (str): The export directory.
+
+    Returns:
+        pa.Table: The rows of the dataset, with its lang_code column.
+    """
+    check_pyarrow()
+    dataset = ds.dataset(os.path.join(path, table), format='parquet',
+                         partitioning='hive',
+                         filesystem=fs.LocalFileSystem(use_mmap=True))
+    filter_ = ds.field('lang_code') == lang_code if lang_code else None
+    return dataset.to_table(columns=columns, filter=filter_)
+
+
+def embedding_matrix(table: 'pa.Table') -> np.ndarray:
+    """
+    Return the embedding column of a paragraph_corpus table as a (n, dim)
+    float32 matrix, a view of the Arrow buffer if the column is a single
+    chunk.
+    """
+    column = table.column('embedding')
+    dim = column.type.list_size
+    if column.num_chunks == 1:
+        values = column.chunk(0).flatten()
+    else:
+        values = pa.concat_arrays([chunk.flatten()
+                                   for chunk in column.chunks])
+    return values.to_numpy(zero_copy_only=False).reshape(-1, dim)
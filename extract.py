@@ -0,0 +1,261 @@
+"""
+Single-pass extraction of the page content from the Wikipedia HTML.
+
+extract_page() walks the HTML once and returns the page title, the
+paragraphs, the internal page names linked from the paragraphs and the short
+description together, as an ExtractedPage.
+
+Backends:
+    - 'selectolax': selectolax (lexbor) parser, if installed.
+    - 'lxml': lxml.html parser, if installed.
+    - 'html.parser': streaming parser built on the standard library.
+    - 'bs4': BeautifulSoup with html.parser (the reference implementation).
+
+The default backend (HTML_BACKEND in config.ini, 'auto') is the fastest one
+installed.
+"""
+from html.parser import HTMLParser
+from __init__ import config
+
+try:
+    from selectolax.lexbor import LexborHTMLParser
+except ImportError:
+    LexborHTMLParser = None
+
+try:
+    import lxml.html
+except ImportError:
+    lxml = None
+
+
+HTML_BACKEND = config["HTML_BACKEND"]
+
+# Paragraph constraints: minimum words and alphabetic characters ratio.
+MIN_WORDS = 5
+MIN_ALPHA_RATIO = .75
+
+# List of characters or words to ignore when collecting page names
+EXCLUDE = ['#', '%', ':', '=', 'File:', 'Help:', 'List_of']
+
+NO_SHORTDESCRIPTION = 'no_shortdescription'
+
+
+class ExtractedPage:
+    """
+    The content extracted from a page.
+
+    - title (str): The text of the <title> element, or None.
+    - paragraphs (list): Text of the paragraphs passing the constraints.
+    - internal_page_names (list): Unique internal page names linked from
+      <a> tags in <p> elements.
+    - shortdescription (str): The short description.
+    """
+    def __init__(self, title, paragraphs, internal_page_names,
+                 shortdescription):
+        self.title = title
+        self.paragraphs = paragraphs
+        self.internal_page_names = internal_page_names
+        self.shortdescription = shortdescription
+
+    def __repr__(self):
+        return (f"<ExtractedPage {self.title}: "
+                f"{len(self.paragraphs)} paragraphs, "
+                f"{len(self.internal_page_names)} links>")
+
+
+def get_alpha_ratio(string: str) -> float:
+    """Calculate the ratio of alphabetic characters in a string."""
+    return sum(map(str.isalpha, string)) / len(string)
+
+
+def is_valid_paragraph(text: str) -> bool:
+    """Minimum words: 5. Alphabetic characters ratio: 75%."""
+    return len(text.split()) > MIN_WORDS \
+        and get_alpha_ratio(text) > MIN_ALPHA_RATIO
+
+
+def get_internal_page_name(href):
+    """Return the page name of an internal link href, or None."""
+    if href and href.startswith('.') \
+            and not any(e in href for e in EXCLUDE):
+        return href[2:]
+    return None
+
+
+def _has_class(class_attr, name: str) -> bool:
+    return class_attr is not None and name in class_attr.split()
+
+
+class _StreamingExtractor(HTMLParser):
+    """HTMLParser that collects the page content in one pass."""
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.title = None
+        self.texts = []
+        self.hrefs = {}
+        self.shortdescription = None
+        # indexes into self.texts of the open <p> elements
+        self._open_p = []
+        self._in_title = False
+        self._title_parts = []
+        self._sd_depth = 0
+        self._sd_parts = None
+
+    def handle_starttag(self, tag, attrs):
+        if tag == 'p':
+            self._open_p.append(len(self.texts))
+            self.texts.append([])
+        elif tag == 'a' and self._open_p:
+            page_name = get_internal_page_name(dict(attrs).get('href'))
+            if page_name is not None:
+                self.hrefs[page_name] = None
+        elif tag == 'div':
+            if self._sd_depth:
+                self._sd_depth += 1
+            elif self.shortdescription is None and self._sd_parts is None \
+                    and _has_class(dict(attrs).get('class'),
+                                   'shortdescription'):
+                self._sd_depth = 1
+                self._sd_parts = []
+        elif tag == 'title' and self.title is None:
+            self._in_title = True
+
+    def handle_endtag(self, tag):
+        if tag == 'p' and self._open_p:
+            self._open_p.pop()
+        elif tag == 'div' and self._sd_depth:
+            self._sd_depth -= 1
+            if self._sd_depth == 0:
+                self.shortdescription = ''.join(self._sd_parts)
+        elif tag == 'title' and self._in_title:
+            self._in_title = False
+            self.title = ''.join(self._title_parts)
+
+    def handle_data(self, data):
+        for i in self._open_p:
+            self.texts[i].append(data)
+        if self._sd_depth:
+            self._sd_parts.append(data)
+        if self._in_title:
+            self._title_parts.append(data)
+
+
+def _extract_html_parser(html: str) -> ExtractedPage:
+    parser = _StreamingExtractor()
+    parser.feed(html)
+    parser.close()
+    paragraphs = [text for text in map(''.join, parser.texts)
+                  if is_valid_paragraph(text)]
+    return ExtractedPage(parser.title, paragraphs, list(parser.hrefs),
+                         parser.shortdescription or NO_SHORTDESCRIPTION)
+
+
+def _extract_lxml(html: str) -> ExtractedPage:
+    if not html.strip():
+        return ExtractedPage(None, [], [], NO_SHORTDESCRIPTION)
+    root = lxml.html.document_fromstring(html)
+    title = None
+    paragraphs = []
+    hrefs = {}
+    shortdescription = None
+    for el in root.iter('p', 'div', 'title'):
+        tag = el.tag
+        if tag == 'p':
+            text = el.text_content()
+            if is_valid_paragraph(text):
+                paragraphs.append(text)
+            for a in el.iter('a'):
+                page_name = get_internal_page_name(a.get('href'))
+                if page_name is not None:
+                    hrefs[page_name] = None
+        elif tag == 'div':
+            if shortdescription is None \
+                    and _has_class(el.get('class'), 'shortdescription'):
+                shortdescription = el.text_content()
+        elif title is None:
+            title = el.text_content()
+    return ExtractedPage(title, paragraphs, list(hrefs),
+                         shortdescription or NO_SHORTDESCRIPTION)
+
+
+def _extract_selectolax(html: str) -> ExtractedPage:
+    tree = LexborHTMLParser(html)
+    title = None
+    paragraphs = []
+    hrefs = {}
+    shortdescription = None
+    for node in tree.css('title, p, div.shortdescription'):
+        tag = node.tag
+        if tag == 'p':
+            text = node.text(deep=True)
+            if is_valid_paragraph(text):
+                paragraphs.append(text)
+            for a in node.css('a'):
+                page_name = get_internal_page_name(a.attributes.get('href'))
+                if page_name is not None:
+                    hrefs[page_name] = None
+        elif tag == 'div':
+            if shortdescription is None:
+                shortdescription = node.text(deep=True)
+        elif title is None:
+            title = node.text(deep=True)
+    return ExtractedPage(title, paragraphs, list(hrefs),
+                         shortdescription or NO_SHORTDESCRIPTION)
+
+
+def _extract_bs4(html: str) -> ExtractedPage:
+    import bs4
+    soup = bs4.BeautifulSoup(html, features="html.parser")
+    paragraphs = []
+    for p in soup.find_all('p'):
+        p_text = p.text
+        if is_valid_paragraph(p_text):
+            paragraphs.append(p_text)
+    hrefs = set()
+    for p in soup.find_all('p'):
+        for a in p.find_all('a'):
+            page_name = get_internal_page_name(a.get('href'))
+            if page_name is not None:
+                hrefs.add(page_name)
+    try:
+        shortdescription = soup.find('div', class_='shortdescription').text
+    except AttributeError:
+        shortdescription = NO_SHORTDESCRIPTION
+    title = soup.title.string if soup.title else None
+    return ExtractedPage(title, paragraphs, list(hrefs), shortdescription)
+
+
+BACKENDS = {
+    'selectolax': _extract_selectolax,
+    'lxml': _extract_lxml,
+    'html.parser': _extract_html_parser,
+    'bs4': _extract_bs4,
+    }
+
+
+def available_backends() -> list:
+    """Return the names of the installed backends, fastest first."""
+    backends = []
+    if LexborHTMLParser is not None:
+        backends.append('selectolax')
+    if lxml is not None:
+        backends.append('lxml')
+    backends += ['html.parser', 'bs4']
+    return backends
+
+
+def extract_page(html: str, backend: str = HTML_BACKEND) -> ExtractedPage:
+    """
+    Extract the title, paragraphs, internal page names and short description
+    from the page html in a single pass.
+
+    Args:
+        html (str): The page html.
+        backend (str): One of BACKENDS, or 'auto' for the fastest installed.
+    """
+    if backend == 'auto':
+        backend = available_backends()[0]
+    if backend not in available_backends():
+        raise ValueError(f'HTML backend {backend} is not available, '
+                         f'use one of {available_backends()}')
+    return BACKENDS[backend](html)
@@ -0,0 +1,273 @@
+"""
+Concurrent page fetching.
+
+The Fetcher downloads batches of Wikipedia pages with asyncio, keeping at most
+FETCH_CONCURRENCY requests in flight per language edition, and yields the
+results as they complete, so the crawl and build loops are no longer bound by
+serial network latency.
+
+All requests go through the transport selected in config.ini, which can
+record and replay them, see transport.py.
+
+Downloaded pages are kept in the PageStore and revalidated with conditional
+requests, see page_store.py.
+
+The crawler, corpus and graph builds share one fetcher, see get_fetcher.
+
+Usage:
+    with Fetcher() as fetcher:
+        for page_name, lang_code, html in fetcher.fetch_html(items):
+            ...
+"""
+import asyncio
+import atexit
+import os
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+import requests
+from __init__ import logger, config
+from titles import canonical_title, html_url, languages_url, bare_url
+from page_store import PageStore, PAGE_STORE_OFFLINE
+from transport import RecordTransport, get_transport
+
+
+FETCH_CONCURRENCY = config["FETCH_CONCURRENCY"]
+LANG_CODES = config["LANG_CODES"]
+TIMEOUT = 180
+
+_page_store = None
+_fetcher = None
+
+
+def get_page_store() -> PageStore:
+    """Return the shared PageStore, creating it on first use."""
+    global _page_store
+    if _page_store is None:
+        _page_store = PageStore()
+    return _page_store
+
+
+def get(url: str, session=None, extra_headers=None) -> requests.Response:
+    """Send a GET request to the Wikimedia API with the app headers."""
+    from __init__ import headers
+    request_headers = {**headers, **(extra_headers or {})}
+    return get_transport().get(url, request_headers, TIMEOUT, session)
+
+
+def fetch_page_html(page_name: str, lang_code: str, session=None,
+                    revalidate: bool = False) -> str:
+    """
+    Return the page HTML from the page store, or download it.
+
+    A stored page is returned as is while it is fresh (or in offline mode),
+    unless revalidate is set, and revalidated with its ETag otherwise:
+    a 304 response keeps the stored
+    copy, a 200 response replaces it. Pages are stored under their canonical
+    title. When recording, every page is downloaded so that it is archived.
+    Returns an empty string on network errors.
+    """
+    title = canonical_title(page_name)
+    store = get_page_store()
+    stored = store.get(lang_code, title)
+    recording = isinstance(get_transport(), RecordTransport)
+    if stored is not None and (PAGE_STORE_OFFLINE
+                               or (stored.is_fresh() and not revalidate
+                                   and not recording)):
+        return stored.html
+    if PAGE_STORE_OFFLINE:
+        logger.info(f'{lang_code}:{page_name} not in page store (offline)')
+        return ''
+
+    extra_headers = {}
+    if stored is not None and stored.etag:
+        extra_headers['If-None-Match'] = stored.etag
+    try:
+        response = get(html_url(page_name, lang_code), session, extra_headers)
+    except (requests.exceptions.ConnectionError,
+            requests.exceptions.ReadTimeout) as e:
+        logger.info(str(e))
+        return stored.html if stored is not None else ''
+
+    if response.status_code == 304 and stored is not None:
+        store.touch(lang_code, title)
+        return stored.html
+    if response.status_code == 200:
+        store.put(lang_code, title, response.text,
+                  response.headers.get('ETag'))
+    return response.text
+
+
+def fetch_page_languages(page_name: str, lang_code: str,
+                         session=None) -> list:
+    """Download the page language links, or return [] on network errors."""
+    try:
+        response = get(languages_url(page_name, lang_code), session)
+        return response.json()
+    except (requests.exceptions.ConnectionError,
+            requests.exceptions.ReadTimeout,
+            requests.exceptions.JSONDecodeError) as e:
+        logger.info(str(e))
+        return []
+
+
+def fetch_latest_revision(page_name: str, lang_code: str, session=None):
+    """
+    Return the id of the latest revision of a page, from the small page
+    metadata response, or None on errors.
+    """
+    try:
+        response = get(bare_url(page_name, lang_code), session)
+        return response.json()['latest']['id']
+    except (requests.exceptions.ConnectionError,
+            requests.exceptions.ReadTimeout,
+            requests.exceptions.JSONDecodeError,
+            KeyError, TypeError) as e:
+        logger.info(f'{lang_code}:{page_name}: {e}')
+        return None
+
+
+class Fetcher:
+    """
+    Fetch Wikipedia pages concurrently.
+
+    Requests are run in a thread pool driven by an asyncio event loop.
+    A semaphore per language edition caps the requests in flight for each
+    edition, and results are yielded in completion order, not input order.
+
+    - concurrency (int): Maximum concurrent requests per language edition.
+    """
+    def __init__(self, concurrency: int = FETCH_CONCURRENCY):
+        self.concurrency = concurrency
+        pool_size = concurrency * max(len(LANG_CODES), 1)
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size,
+                                                pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.executor = ThreadPoolExecutor(max_workers=pool_size)
+        self.pid = os.getpid()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def close(self):
+        """Stop the thread pool and close the HTTP connections."""
+        self.executor.shutdown(wait=True)
+        self.session.close()
+
+    def _get_html(self, page_name: str, lang_code: str,
+                  revalidate: bool = False) -> str:
+        return fetch_page_html(page_name, lang_code, self.session, revalidate)
+
+    def _get_latest_revision(self, page_name: str, lang_code: str):
+        return fetch_latest_revision(page_name, lang_code, self.session)
+
+    def _get_languages(self, page_name: str, lang_code: str) -> list:
+        return fetch_page_languages(page_name, lang_code, self.session)
+
+    async def _afetch(self, func, items):
+        """
+        Run func(page_name, lang_code) for each item and yield
+        (page_name, lang_code, result) tuples as they complete.
+        """
+        loop = asyncio.get_running_loop()
+        semaphores = {}
+
+        async def run(page_name, lang_code):
+            if lang_code not in semaphores:
+                semaphores[lang_code] = asyncio.Semaphore(self.concurrency)
+            async with semaphores[lang_code]:
+                result = await loop.run_in_executor(
+                    self.executor, func, page_name, lang_code)
+            return page_name, lang_code, result
+
+        tasks = [asyncio.ensure_future(run(page_name, lang_code))
+                 for page_name, lang_code in items]
+        try:
+            for task in asyncio.as_completed(tasks):
+                yield await task
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    def _iterate(self, agen):
+        """Drive an async generator from synchronous code."""
+        loop = asyncio.new_event_loop()
+        try:
+            while True:
+                try:
+                    yield loop.run_until_complete(agen.__anext__())
+                except StopAsyncIteration:
+                    break
+        finally:
+            loop.run_until_complete(agen.aclose())
+            loop.close()
+
+    def fetch_html(self, items, revalidate: bool = False):
+        """
+        Download the HTML of a batch of pages.
+
+        Args:
+            items: Iterable of (page_name, lang_code) tuples.
+            revalidate (bool): Revalidate the stored pages even if fresh.
+
+        Yields:
+            tuple: (page_name, lang_code, html) in completion order.
+        """
+        items = list(items)
+        logger.info(f'Fetching {len(items)} pages')
+        func = partial(self._get_html, revalidate=revalidate)
+        yield from self._iterate(self._afetch(func, items))
+
+    def fetch_latest_revisions(self, items):
+        """
+        Get the latest revision id of a batch of pages.
+
+        Args:
+            items: Iterable of (page_name, lang_code) tuples.
+
+        Yields:
+            tuple: (page_name, lang_code, revision_id) in completion order.
+        """
+        items = list(items)
+        logger.info(f'Fetching latest revisions of {len(items)} pages')
+        yield from self._iterate(
+            self._afetch(self._get_latest_revision, items))
+
+    def fetch_languages(self, items):
+        """
+        Download the language links of a batch of pages.
+
+        Args:
+            items: Iterable of (page_name, lang_code) tuples.
+
+        Yields:
+            tuple: (page_name, lang_code, languages) in completion order.
+        """
+        items = list(items)
+        logger.info(f'Fetching languages of {len(items)} pages')
+        yield from self._iterate(self._afetch(self._get_languages, items))
+
+
+def get_fetcher() -> Fetcher:
+    """
+    Return the Fetcher shared by this process, creating it on first use
+    (and again in a forked child, which has none of its threads).
+    """
+    global _fetcher
+    if _fetcher is None or _fetcher.pid != os.getpid():
+        _fetcher = Fetcher()
+    return _fetcher
+
+
+def close_fetcher():
+    """Close the shared Fetcher, if it was created by this process."""
+    global _fetcher
+    if _fetcher is not None and _fetcher.pid == os.getpid():
+        _fetcher.close()
+    _fetcher = None
+
+
+atexit.register(close_fetcher)
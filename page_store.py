@@ -0,0 +1,176 @@
+"""
+Persistent store of the raw page HTML.
+
+Pages are stored compressed in a separate SQLite file (PAGE_STORE_DB), keyed
+by (lang_code, title), together with the response ETag and the revision id
+parsed from it. Stored pages are served without a request while they are
+younger than PAGE_STORE_TTL seconds, and revalidated with a conditional
+request (If-None-Match) afterwards, so unchanged pages are never downloaded
+twice. With PAGE_STORE_OFFLINE, stored pages are always served and missing
+pages are not requested.
+
+Compression uses zstandard when it is installed and zlib otherwise.
+"""
+import re
+import sqlite3
+import time
+import zlib
+from contextlib import closing
+from __init__ import logger, config
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+PAGE_STORE_DB = config["PAGE_STORE_DB"]
+PAGE_STORE_TTL = config["PAGE_STORE_TTL"]
+PAGE_STORE_OFFLINE = config["PAGE_STORE_OFFLINE"]
+
+
+def compress(html: str) -> tuple:
+    """Compress the html text and return a (codec, blob) tuple."""
+    data = html.encode('utf-8')
+    if zstandard is not None:
+        return 'zstd', zstandard.ZstdCompressor(level=10).compress(data)
+    return 'zlib', zlib.compress(data, 6)
+
+
+def decompress(codec: str, blob: bytes) -> str:
+    """Decompress a blob stored with the given codec."""
+    if codec == 'zstd':
+        data = zstandard.ZstdDecompressor().decompress(blob)
+    else:
+        data = zlib.decompress(blob)
+    return data.decode('utf-8')
+
+
+def parse_revision_id(etag: str):
+    """
+    Parse the revision id from a Wikimedia ETag, for example
+    'W/"1234567890/0a1b2c3d-..."' -> 1234567890.
+    """
+    if not etag:
+        return None
+    match = re.search(r'"?(\d+)/', etag)
+    if match:
+        return int(match.group(1))
+    return None
+
+
+class StoredPage:
+    """A page read from the store."""
+    def __init__(self, html: str, etag: str, revision_id: int,
+                 checked_at: float):
+        self.html = html
+        self.etag = etag
+        self.revision_id = revision_id
+        self.checked_at = checked_at
+
+    def is_fresh(self, ttl: int = PAGE_STORE_TTL) -> bool:
+        """Return True if the page was checked less than ttl seconds ago."""
+        return time.time() - self.checked_at < ttl
+
+
+class PageStore:
+    """
+    Compressed raw-HTML page store.
+
+    Usage:
+        store = PageStore()
+        stored = store.get('en', 'London')
+        store.put('en', 'London', html, etag)
+    """
+    def __init__(self, path: str = PAGE_STORE_DB):
+        self.path = path
+        self.create_table()
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.path, timeout=30)
+
+    def create_table(self):
+        """Create the page_html table."""
+        with closing(self._connect()) as conn, conn:
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS page_html (
+                    lang_code TEXT NOT NULL,
+                    title TEXT NOT NULL,
+                    revision_id INTEGER,
+                    etag TEXT,
+                    codec TEXT,
+                    html BLOB,
+                    checked_at REAL,
+                    PRIMARY KEY (lang_code, title)
+                    )
+                """
+                )
+
+    def get(self, lang_code: str, title: str):
+        """Return the StoredPage for (lang_code, title), or None."""
+        with closing(self._connect()) as conn:
+            row = conn.execute(
+                """
+                SELECT codec, html, etag, revision_id, checked_at
+                FROM page_html
+                WHERE lang_code = ? AND title = ?
+                """, (lang_code, title)
+                ).fetchone()
+        if row is None:
+            return None
+        codec, blob, etag, revision_id, checked_at = row
+        return StoredPage(decompress(codec, blob), etag, revision_id,
+                          checked_at)
+
+    def put(self, lang_code: str, title: str, html: str, etag: str = None):
+        """Store the page html and its ETag."""
+        codec, blob = compress(html)
+        with closing(self._connect()) as conn, conn:
+            conn.execute(
+                """
+                INSERT OR REPLACE INTO page_html
+                (lang_code, title, revision_id, etag, codec, html, checked_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+                """, (lang_code, title, parse_revision_id(etag), etag,
+                      codec, blob, time.time())
+                )
+
+    def touch(self, lang_code: str, title: str):
+        """Mark a stored page as revalidated now."""
+        with closing(self._connect()) as conn, conn:
+            conn.execute(
+                """
+                UPDATE page_html SET checked_at = ?
+                WHERE lang_code = ? AND title = ?
+                """, (time.time(), lang_code, title)
+                )
+
+    def iter_pages(self, lang_code: str = None, limit: int = -1):
+        """
+        Yield (lang_code, title, html) for the stored pages,
+        optionally filtered by lang_code.
+        """
+        with closing(self._connect()) as conn:
+            cur = conn.execute(
+                """
+                SELECT lang_code, title, codec, html FROM page_html
+                WHERE ? IS NULL OR lang_code = ?
+                LIMIT ?
+                """, (lang_code, lang_code, limit)
+                )
+            for lang_code_, title, codec, blob in cur:
+                yield lang_code_, title, decompress(codec, blob)
+
+    def get_info(self) -> dict:
+        """Return the number of stored pages and their compressed size."""
+        with closing(self._connect()) as conn:
+            count, size = conn.execute(
+                """
+                SELECT COUNT(*), COALESCE(SUM(LENGTH(html)), 0)
+                FROM page_html
+                """
+                ).fetchone()
+        info = {"pages": count, "compressed_bytes": size}
+        logger.info(f"Page store {self.path}: {info}")
+        return info
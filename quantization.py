@@ -0,0 +1,189 @@
+"""
+Compact storage and search of the paragraph embeddings.
+
+Embeddings are stored in paragraph_corpus.embedding in the format set with
+EMBEDDING_DTYPE in config.ini, recorded per row in embedding_dtype:
+    - 'float32' (default): 4 bytes per dimension.
+    - 'float16': 2 bytes per dimension.
+    - 'int8': scalar quantization with a per-vector scale, 1 byte per
+      dimension plus a float32 scale (max(|x|) / 127) in front.
+
+The corpus matrix is kept in memory in the stored format and searched in
+chunks, without materializing it as float32. The top-k candidates can then be
+rescored exactly with float32 embeddings (RESCORE_FACTOR in config.ini), see
+embedding_store.py for where they are kept.
+"""
+import numpy as np
+from __init__ import config
+
+
+EMBEDDING_DTYPE = config["EMBEDDING_DTYPE"]
+RESCORE_FACTOR = config["RESCORE_FACTOR"]
+
+EMBEDDING_DTYPES = ('float32', 'float16', 'int8')
+
+# Rows dequantized at a time during search
+CHUNK_SIZE = 65536
+
+
+def check_dtype(dtype: str):
+    if dtype not in EMBEDDING_DTYPES:
+        raise ValueError(f'Unknown embedding dtype {dtype}, '
+                         f'use one of {", ".join(EMBEDDING_DTYPES)}')
+
+
+def quantize(embeddings: np.ndarray, dtype: str = EMBEDDING_DTYPE) -> tuple:
+    """
+    Quantize a (n, dim) float matrix.
+
+    Returns:
+        tuple: (codes, scales), scales is None except for int8.
+    """
+    check_dtype(dtype)
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    if dtype == 'int8':
+        scales = np.abs(embeddings).max(axis=1) / 127
+        scales[scales == 0] = 1.0
+        codes = np.rint(embeddings / scales[:, None]).astype(np.int8)
+        return codes, scales.astype(np.float32)
+    return embeddings.astype(dtype), None
+
+
+def dequantize(codes: np.ndarray, scales: np.ndarray = None) -> np.ndarray:
+    """Return the float32 matrix of quantized codes."""
+    matrix = codes.astype(np.float32)
+    if scales is not None:
+        matrix *= scales[:, None]
+    return matrix
+
+
+def to_blob(embedding, dtype: str = EMBEDDING_DTYPE) -> bytes:
+    """Serialize one embedding in the given dtype."""
+    codes, scales = quantize(np.asarray(embedding)[None, :], dtype)
+    if scales is not None:
+        return scales.tobytes() + codes.tobytes()
+    return codes.tobytes()
+
+
+def from_blob(blob: bytes, dtype: str = 'float32') -> np.ndarray:
+    """Deserialize one embedding as float32."""
+    dtype = dtype or 'float32'
+    if dtype == 'int8':
+        scale = np.frombuffer(blob[:4], dtype=np.float32)[0]
+        return np.frombuffer(blob[4:], dtype=np.int8) * scale
+    return np.frombuffer(blob, dtype=dtype).astype(np.float32)
+
+
+def load_matrix(rows: list) -> tuple:
+    """
+    Stack stored embeddings into a matrix in their stored format.
+
+    Args:
+        rows (list): List of (blob, dtype) tuples.
+
+    Returns:
+        tuple: (codes, scales). Rows stored in different dtypes are
+        loaded as float32.
+    """
+    dtypes = set(dtype or 'float32' for _, dtype in rows)
+    if len(dtypes) != 1:
+        return np.vstack([from_blob(blob, dtype) for blob, dtype in rows]), None
+    dtype = dtypes.pop()
+    if dtype == 'int8':
+        scales = np.array([np.frombuffer(blob[:4], dtype=np.float32)[0]
+                           for blob, _ in rows], dtype=np.float32)
+        codes = np.vstack([np.frombuffer(blob[4:], dtype=np.int8)
+                           for blob, _ in rows])
+        return codes, scales
+    return np.vstack([np.frombuffer(blob, dtype=dtype) for blob, _ in rows]), \
+        None
+
+
+def load_matrix_chunks(n_rows: int, chunks, dtype: str,
+                       empty=None) -> tuple:
+    """
+    Fill a preallocated matrix with stored embeddings read in chunks, so
+    that only one chunk is held in memory besides the matrix.
+
+    Args:
+        n_rows (int): The number of embeddings, e.g. from a COUNT(*).
+        chunks: Iterable of lists of (blob, dtype) tuples.
+        dtype (str): The dtype of the matrix, the embeddings stored in
+            another dtype are converted.
+        empty: The allocator of the arrays, called as
+            empty(name, shape, dtype) with name 'codes' or 'scales';
+            np.empty by default.
+
+    Returns:
+        tuple: (codes, scales), scales is None except for int8.
+    """
+    check_dtype(dtype)
+    if empty is None:
+        empty = lambda name, shape, dtype: np.empty(shape, dtype=dtype)
+    codes = scales = None
+    i = 0
+    for rows in chunks:
+        chunk_codes, chunk_scales = load_matrix(rows)
+        if chunk_codes.dtype != np.dtype(dtype):
+            chunk_codes, chunk_scales = quantize(
+                dequantize(chunk_codes, chunk_scales), dtype)
+        if codes is None:
+            codes = empty('codes', (n_rows, chunk_codes.shape[1]), dtype)
+            if dtype == 'int8':
+                scales = empty('scales', (n_rows,), np.float32)
+        codes[i:i + len(rows)] = chunk_codes
+        if scales is not None:
+            scales[i:i + len(rows)] = chunk_scales
+        i += len(rows)
+    if codes is None:
+        return np.empty((0, 0), dtype=dtype), None
+    return codes, scales
+
+
+def cosine_scores(codes: np.ndarray, scales: np.ndarray,
+                  query: np.ndarray) -> np.ndarray:
+    """Cosine similarity of the query to every row, computed in chunks."""
+    query = np.asarray(query, dtype=np.float32).ravel()
+    query = query / (np.linalg.norm(query) or 1.0)
+    scores = np.empty(len(codes), dtype=np.float32)
+    for i in range(0, len(codes), CHUNK_SIZE):
+        chunk = dequantize(codes[i:i + CHUNK_SIZE],
+                           None if scales is None else scales[i:i + CHUNK_SIZE])
+        norms = np.linalg.norm(chunk, axis=1)
+        norms[norms == 0] = 1.0
+        scores[i:i + CHUNK_SIZE] = chunk @ query / norms
+    return scores
+
+
+def top_k(scores: np.ndarray, k: int) -> tuple:
+    """Return the (scores, indices) of the k highest scores, descending."""
+    k = min(k, len(scores))
+    if k == 0:
+        return scores[:0], np.array([], dtype=np.int64)
+    indices = np.argpartition(-scores, k - 1)[:k]
+    indices = indices[np.argsort(-scores[indices])]
+    return scores[indices], indices
+
+
+def search(codes: np.ndarray, scales: np.ndarray, query: np.ndarray,
+           k: int) -> tuple:
+    """Return the (scores, indices) of the k rows most similar to query."""
+    return top_k(cosine_scores(codes, scales, query), k)
+
+
+def rescore(query: np.ndarray, candidates: np.ndarray,
+            embeddings: np.ndarray, k: int) -> tuple:
+    """
+    Rescore candidate rows with their exact float32 embeddings.
+
+    Args:
+        query (np.ndarray): The query embedding.
+        candidates (np.ndarray): The candidate row indices.
+        embeddings (np.ndarray): The float32 embeddings of the candidates.
+        k (int): Number of rows to return.
+
+    Returns:
+        tuple: (scores, indices) of the k best candidates, descending.
+    """
+    scores, order = search(embeddings, None, query, k)
+    return scores, candidates[order]
@@ -1,8 +1,25 @@
 """Unit tests for the wiki-ent project."""
 
+import gzip
+import wiki_graph
 from wiki_graph import WikiPage as wp
-from wiki_graph import CorpusManager, CorpusBitexts, Crawler
-from db_utils import get_db_info
+from wiki_graph import (CorpusManager, CorpusBitexts, Crawler, Recrawler,
+                        page_similarity_score, reciprocal_rank_fusion)
+import db_utils
+from db_utils import (BulkWriter, PAGE_LINK_INSERT, get_connection,
+                      get_cursor, get_db_info)
+from fetcher import Fetcher, close_fetcher, get_fetcher
+from page_store import PageStore, parse_revision_id
+from extract import extract_page, available_backends
+from transport import (ArchivedResponse, Archive, RecordTransport,
+                       ReplayTransport)
+from titles import TitleIndex, canonical_title
+from dumps import extract_wikitext, iter_sql_rows
+from embedding_cache import CachedEncoder, EmbeddingCache
+from quantization import from_blob, load_matrix, search, to_blob
+from encoder import check_compatibility, load_encoder
+from encoder_pool import EncoderPool
+from embedding_store import EmbeddingStore
 
 
 def base_test(page_name, lang_code):
@@ -20,6 +37,31 @@ def base_test(page_name, lang_code):
     assert wiki_page.get_languages() is not None
 
 
+class StubModel:
+    """
+    Encoder stand-in that records the texts it encodes, with embeddings
+    computed from the texts.
+    """
+    def __init__(self):
+        self.encoded = []
+
+    def encode(self, texts, batch_size=None, **kwargs):
+        import numpy as np
+        self.encoded.append(list(texts))
+        return np.array([[len(text), sum(map(ord, text)) % 97, 1.0, 0.5]
+                         for text in texts], dtype=np.float32)
+
+    def encode_query(self, text, **kwargs):
+        return self.encode([text])[0]
+
+    def similarity(self, a, b):
+        import numpy as np
+        a, b = np.atleast_2d(a), np.atleast_2d(b)
+        a = a / np.linalg.norm(a, axis=1, keepdims=True)
+        b = b / np.linalg.norm(b, axis=1, keepdims=True)
+        return a @ b.T
+
+
 # Tests for the supported languages.
 
 
@@ -47,6 +89,300 @@ def test_wiki_page_it(page_name="Londra", lang_code="it"):
     base_test(page_name, lang_code)
 
 
+def test_fetcher():
+    """
+    Test that the Fetcher downloads a batch of pages concurrently
+    and yields one parsed WikiPage per requested page.
+    """
+    items = [("London", "en"), ("Londres", "es"), ("Londra", "it")]
+    with Fetcher(concurrency=2) as fetcher:
+        pages = list(wp.iter_pages(items, fetcher))
+    assert len(pages) == len(items)
+    assert set((p.page_name, p.lang_code) for p in pages) == set(items)
+    for page in pages:
+        assert len(page.paragraphs) > 0
+
+
+def test_shared_fetcher():
+    """
+    Test that the fetcher is shared until it is closed, and that closing
+    it stops its thread pool.
+    """
+    import pytest
+    fetcher = get_fetcher()
+    assert get_fetcher() is fetcher
+    close_fetcher()
+    with pytest.raises(RuntimeError):
+        fetcher.executor.submit(print)
+    assert get_fetcher() is not fetcher
+
+
+def test_page_store(tmp_path):
+    """
+    Test that the PageStore round-trips compressed html and parses the
+    revision id from the ETag.
+    """
+    store = PageStore(str(tmp_path / "page_store.db"))
+    assert store.get("en", "London") is None
+    html = "<p>London is the capital of England.</p>" * 100
+    store.put("en", "London", html, 'W/"1234/abcd"')
+    stored = store.get("en", "London")
+    assert stored.html == html
+    assert stored.revision_id == 1234
+    assert stored.is_fresh()
+    assert parse_revision_id(None) is None
+    assert store.get_info()["pages"] == 1
+
+
+def test_extract_backends():
+    """
+    Test that every installed extraction backend extracts the same content
+    as the bs4 reference.
+    """
+    html = (
+        '<html><head><title>London</title></head><body>'
+        '<div class="shortdescription">Capital of England</div>'
+        '<p>London is the <a href="./Capital_city">capital</a> and largest '
+        'city of <a href="./England">England</a> and the UK.'
+        '<a href="./File:London.jpg">file</a><a href="#cite">[1]</a></p>'
+        '<p>Too short.</p></body></html>'
+        )
+    reference = extract_page(html, 'bs4')
+    assert reference.title == 'London'
+    assert len(reference.paragraphs) == 1
+    assert sorted(reference.internal_page_names) == ['Capital_city', 'England']
+    assert reference.shortdescription == 'Capital of England'
+    for backend in available_backends():
+        extracted = extract_page(html, backend)
+        assert extracted.title == reference.title
+        assert extracted.paragraphs == reference.paragraphs
+        assert sorted(extracted.internal_page_names) == \
+            sorted(reference.internal_page_names)
+        assert extracted.shortdescription == reference.shortdescription
+
+
+def test_replay_transport(tmp_path):
+    """
+    Test that the replay transport serves archived responses, answers
+    conditional requests with 304 and unknown urls with 404.
+    """
+    archive = Archive(str(tmp_path / "archive.db"))
+    url = "https://api.wikimedia.org/core/v1/wikipedia/en/page/London/html"
+    response = ArchivedResponse(url, 200, {"ETag": 'W/"1/a"'}, b"<p>London</p>")
+    archive.save(url, response)
+    transport = ReplayTransport(archive, latency=0)
+    assert transport.get(url, {}, 10).text == "<p>London</p>"
+    assert transport.get(url, {"If-None-Match": 'W/"1/a"'}, 10).status_code \
+        == 304
+    assert transport.get(url + "x", {}, 10).status_code == 404
+
+
+def test_record_replay_transport(tmp_path, monkeypatch):
+    """
+    Test that a page already in the page store is recorded with its body,
+    not as a 304, and replayed from the archive into an empty page store.
+    """
+    import fetcher
+    import transport
+    etag = 'W/"1/a"'
+
+    class Session:
+        def __init__(self):
+            self.headers = []
+
+        def get(self, url, headers, timeout):
+            self.headers.append(headers)
+            if headers.get("If-None-Match") == etag:
+                return ArchivedResponse(url, 304, {"ETag": etag}, b"")
+            return ArchivedResponse(url, 200, {"ETag": etag}, b"<p>London</p>")
+
+    store = PageStore(str(tmp_path / "page_store.db"))
+    store.put("en", "London", "<p>London</p>", etag)
+    archive = Archive(str(tmp_path / "archive.db"))
+    session = Session()
+    monkeypatch.setattr(fetcher, "_page_store", store)
+    monkeypatch.setattr(transport, "_transport", RecordTransport(archive))
+    assert fetcher.fetch_page_html("London", "en", session) == "<p>London</p>"
+    assert len(session.headers) == 1
+    assert "If-None-Match" not in session.headers[0]
+
+    monkeypatch.setattr(fetcher, "_page_store",
+                        PageStore(str(tmp_path / "empty.db")))
+    monkeypatch.setattr(transport, "_transport", ReplayTransport(archive, 0))
+    assert fetcher.fetch_page_html("London", "en") == "<p>London</p>"
+
+
+def test_title_index():
+    """
+    Test that title variants and redirects resolve to one canonical title.
+    """
+    assert canonical_title("./new%20york#History") == "New_york"
+    assert canonical_title("Foo bar") == canonical_title("Foo_bar")
+    titles = TitleIndex({"United_Kingdom"}, {"UK": "United_Kingdom"})
+    assert "UK" in titles
+    assert "United Kingdom" in titles
+    assert titles.filter_new(["UK", "Paris", "paris", "./Rome"]) == \
+        ["Paris", "Rome"]
+
+
+def test_title_urls(tmp_path, monkeypatch):
+    """
+    Test that titles with '?', '/' and '%' build URLs with one path segment
+    for the title, and that the saved page urls are migrated to them.
+    """
+    from urllib.parse import unquote, urlsplit
+    from titles import API_URL, bare_url, html_url, languages_url
+    for href in ("./Who%3F_(song)", "./AC/DC", "./100%25_(album)"):
+        title = canonical_title(href)
+        for url, suffix in ((html_url(title, "en"), "/html"),
+                            (bare_url(title, "en"), "/bare"),
+                            (languages_url(title, "en"), "/links/language")):
+            split = urlsplit(Archive._key(url))
+            assert split.query == ""
+            prefix = urlsplit(API_URL).path + "/en/page/"
+            assert split.path.startswith(prefix)
+            assert split.path.endswith(suffix)
+            segment = split.path[len(prefix):-len(suffix)]
+            assert "/" not in segment and unquote(segment) == title
+    monkeypatch.setattr(db_utils, 'DB_NAME', str(tmp_path / 'test.db'))
+    db_utils.create_tables()
+    page_id = db_utils.insert_page_metadata(
+        "AC/DC", "en", f"{API_URL}/en/page/AC/DC/html", 0.9)
+    with get_cursor() as cur:
+        db_utils._quote_page_urls(cur)
+    # the page is not saved again under its new url
+    assert db_utils.insert_page_metadata(
+        "AC/DC", "en", html_url("AC/DC", "en"), 0.9) == page_id
+
+
+def test_extract_wikitext():
+    """
+    Test that the paragraphs and links are extracted from dump wikitext.
+    """
+    wikitext = (
+        "{{Infobox city|name={{lang|en|London}}}}\n"
+        "'''London''' is the capital of [[England]] and the "
+        "[[United Kingdom|UK]].<ref>Source</ref>\n\n"
+        "== History ==\n\n"
+        "[[File:London.jpg|thumb]]\n\n"
+        "* A list item with a [[Link]] in it\n"
+        )
+    page = extract_wikitext(wikitext)
+    assert page.paragraphs == \
+        ["London is the capital of England and the UK."]
+    assert page.internal_page_names == ["England", "United_Kingdom"]
+
+
+def test_iter_sql_rows(tmp_path):
+    """
+    Test that the rows of a langlinks SQL dump are parsed with escapes.
+    """
+    path = str(tmp_path / "langlinks.sql.gz")
+    with gzip.open(path, "wt") as f:
+        f.write("INSERT INTO `langlinks` VALUES "
+                "(1,'es','Londres'),(2,'fr','L\\'Étoile, Paris');\n")
+    assert list(iter_sql_rows(path, "langlinks")) == \
+        [("1", "es", "Londres"), ("2", "fr", "L'Étoile, Paris")]
+
+
+def test_embedding_cache(tmp_path):
+    """
+    Test that repeated texts are encoded once, across encoders sharing the
+    cache file, and that the hits and misses are counted.
+    """
+    class Model:
+        texts = []
+
+        def encode(self, texts, **kwargs):
+            self.texts += texts
+            return [[float(len(text)), 1.0] for text in texts]
+
+    model = Model()
+    path = str(tmp_path / "embedding_cache.db")
+    encoder = CachedEncoder(model, EmbeddingCache(path, "model", maxsize=1))
+    embeddings = encoder.encode(["London is big", "Paris", "London  is big"])
+    assert embeddings.shape == (3, 2)
+    assert model.texts == ["London is big", "Paris"]
+    encoder = CachedEncoder(model, EmbeddingCache(path, "model"))
+    assert encoder.encode("Paris")[0] == 5.0
+    assert model.texts == ["London is big", "Paris"]
+    assert encoder.cache.get_info()["hits"] == 1
+
+
+def test_quantization():
+    """
+    Test that the embeddings survive a round trip through every stored
+    format, and that the quantized search finds the nearest paragraph.
+    """
+    import numpy as np
+
+    rng = np.random.default_rng(0)
+    embeddings = rng.normal(size=(100, 32)).astype(np.float32)
+    for dtype, tolerance in [("float32", 0), ("float16", 1e-2),
+                             ("int8", 5e-2)]:
+        blobs = [(to_blob(e, dtype), dtype) for e in embeddings]
+        assert np.allclose(from_blob(*blobs[0]), embeddings[0],
+                           atol=tolerance)
+        codes, scales = load_matrix(blobs)
+        assert len(codes) == 100
+        scores, indices = search(codes, scales, embeddings[42], 3)
+        assert indices[0] == 42 and scores[0] > 0.99
+
+
+def test_encoder_compatibility():
+    """
+    Test the tolerance check of the encoder backends against torch.
+    """
+    import numpy as np
+
+    rng = np.random.default_rng(0)
+    reference = rng.normal(size=(10, 32)).astype(np.float32)
+    assert check_compatibility(reference, reference * 2, "onnx")
+    noisy = reference + rng.normal(scale=0.05, size=reference.shape)
+    assert check_compatibility(reference, noisy, "onnx-int8")
+    assert not check_compatibility(reference, noisy, "onnx")
+    assert not check_compatibility(reference, -reference, "onnx-int8")
+
+
+def test_encoder_pool(tmp_path):
+    """
+    Test that the encoder pool returns every batch, with the embeddings of
+    the model, and serves repeated batches from the cache.
+    """
+    import numpy as np
+
+    batches = [["London is big", "Paris"], ["Madrid"], ["London is big"]]
+    pool = EncoderPool(size=2, batch_size=2)
+    pool.cache = EmbeddingCache(str(tmp_path / "cache.db"), "model")
+    with pool:
+        encoded = dict(pool.encode_batches(batches))
+    assert sorted(encoded) == [0, 1, 2]
+    expected = load_encoder("torch").encode(batches[0])
+    assert np.allclose(encoded[0], expected, atol=1e-5)
+    assert np.allclose(encoded[2][0], encoded[0][0])
+
+
+def test_shared_embedding_cache(tmp_path, monkeypatch, caplog):
+    """
+    Test that the encoder pools share the embedding cache of the process,
+    whose counters the cli reports without loading the model.
+    """
+    import logging
+    import cli
+    import encoder
+    monkeypatch.setattr(encoder, "_caches", {})
+    cache = EmbeddingCache(str(tmp_path / "cache.db"),
+                           encoder.cache_model_name("torch"))
+    encoder._caches[cache.model_name] = cache
+    assert EncoderPool(size=2, backend="torch").cache is cache
+    assert encoder.get_cache("torch") is cache
+    assert encoder.get_caches() == [cache]
+    cache.get_many("document", ["a"])
+    with caplog.at_level(logging.INFO):
+        cli.log_cache_info()
+    assert "'misses': 1" in caplog.text
+
+
 def test_db_info():
     """
     Test that get_db_info returns valid database info and expected tables.
@@ -59,6 +395,476 @@ def test_db_info():
     assert 'paragraph_corpus' in info
     assert 'page_links' in info
     assert 'page_autonyms' in info
+    assert 'crawl_frontier' in info
+    assert 'leases' in info
+
+
+def test_db_connections():
+    """
+    Test that the helpers share one WAL connection per thread.
+    """
+    import threading
+
+    with get_cursor() as cur:
+        assert cur.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+    assert get_connection() is get_connection()
+    connections = []
+    thread = threading.Thread(
+        target=lambda: connections.append(get_connection()))
+    thread.start()
+    thread.join()
+    assert connections[0] is not get_connection()
+
+
+def test_bulk_writer(tmp_path, monkeypatch):
+    """
+    Test that the BulkWriter writes every max_rows rows and the rest on exit.
+    """
+    monkeypatch.setattr(db_utils, 'DB_NAME', str(tmp_path / 'test.db'))
+    db_utils.create_tables()
+    with BulkWriter(PAGE_LINK_INSERT, max_rows=3, max_ms=60000) as writer:
+        for i in range(7):
+            writer.add((i, i + 1))
+        assert writer.n_rows == 6
+        assert len(writer.rows) == 1
+    with get_cursor() as cur:
+        assert cur.execute("SELECT COUNT(*) FROM page_links").fetchone()[0] == 7
+
+
+def test_schema_migrations(tmp_path, monkeypatch):
+    """
+    Test that create_tables applies the migrations once, and that the
+    unprocessed pages queries skip the processed pages.
+    """
+    monkeypatch.setattr(db_utils, 'DB_NAME', str(tmp_path / 'test.db'))
+    db_utils.create_tables()
+    db_utils.create_tables()
+    with get_cursor() as cur:
+        assert db_utils.get_schema_version(cur) == len(db_utils.MIGRATIONS)
+    built = db_utils.insert_page_metadata('Built', 'en', 'built', 0.9)
+    new = db_utils.insert_page_metadata('New', 'en', 'new', 0.9)
+    db_utils.insert_page_metadata('Far', 'en', 'far', 0.1)
+    db_utils.insert_paragraph(built, 'text', b'', 0)
+    db_utils.insert_page_link(new, built)
+    assert [p[0] for p in db_utils.get_unbuilt_pages(0.5, 'en')] == [new]
+    assert [p[0] for p in db_utils.get_unlinked_pages(0.5, 'en')] == [built]
+
+
+def test_embedding_store(tmp_path, monkeypatch):
+    """
+    Test that the embedding store follows the appended and deleted
+    paragraphs, aligned with the paragraph ids.
+    """
+    import numpy as np
+
+    monkeypatch.setattr(db_utils, 'DB_NAME', str(tmp_path / 'test.db'))
+    db_utils.create_tables()
+    page_id = db_utils.insert_page_metadata('Page', 'en', 'url', 0.9)
+    embeddings = np.random.default_rng(0).normal(size=(6, 8))
+    embeddings = embeddings.astype(np.float32)
+
+    def insert(start, stop):
+        db_utils.insert_paragraphs_bulk(
+            [(page_id, f'paragraph {i}', to_blob(embeddings[i], 'float32'), i)
+             for i in range(start, stop)])
+
+    def paragraph_ids():
+        return [row[0] for row in db_utils.get_paragraph_corpus()]
+
+    store = EmbeddingStore(str(tmp_path / 'embeddings'))
+    insert(0, 4)
+    codes, scales = store.sync(paragraph_ids())
+    assert isinstance(codes, np.memmap)
+    assert np.array_equal(codes, embeddings[:4])
+    insert(4, 6)
+    db_utils.delete_paragraphs(paragraph_ids()[1:2])
+    codes, scales = store.sync(paragraph_ids())
+    assert np.array_equal(codes, embeddings[[0, 2, 3, 4, 5]])
+    assert scales is None
+
+
+def test_embedding_store_exact(tmp_path, monkeypatch):
+    """
+    Test that the sync converts the new float32 embeddings to the quantized
+    EMBEDDING_DTYPE and keeps their float32 embeddings for rescoring.
+    """
+    import numpy as np
+    import embedding_store
+
+    monkeypatch.setattr(db_utils, 'DB_NAME', str(tmp_path / 'test.db'))
+    monkeypatch.setattr(embedding_store, 'EMBEDDING_DTYPE', 'int8')
+    monkeypatch.setattr(embedding_store, 'RESCORE_FACTOR', 4)
+    db_utils.create_tables()
+    page_id = db_utils.insert_page_metadata('Page', 'en', 'url', 0.9)
+    embeddings = np.random.default_rng(0).normal(size=(6, 8))
+    embeddings = embeddings.astype(np.float32)
+
+    def insert(start, stop):
+        db_utils.insert_paragraphs_bulk(
+            [(page_id, f'paragraph {i}', to_blob(embeddings[i], 'float32'), i)
+             for i in range(start, stop)])
+
+    def paragraph_ids():
+        return [row[0] for row in db_utils.get_paragraph_corpus()]
+
+    store = EmbeddingStore(str(tmp_path / 'embeddings'))
+    insert(0, 4)
+    codes, scales = store.sync(paragraph_ids())
+    assert codes.dtype == np.int8 and scales is not None
+    assert {row[2] for row in db_utils.get_paragraph_embedding_rows()} \
+        == {'int8'}
+    assert np.array_equal(store.exact_rows([4, 1]), embeddings[[3, 0]])
+    insert(4, 6)
+    db_utils.delete_paragraphs([2])
+    store.sync(paragraph_ids())
+    assert store.exact_rows([2]) is None
+    assert np.array_equal(store.exact_rows([1, 3, 6]), embeddings[[0, 2, 5]])
+    # the quantized embeddings are converted, the float32 ones kept
+    assert store.quantize('float16') == 5
+    codes, _ = store.sync(paragraph_ids())
+    assert codes.dtype == np.float16
+    assert np.array_equal(store.exact_rows([6]), embeddings[[5]])
+    # a new store creates its directory
+    new = EmbeddingStore(str(tmp_path / 'new'))
+    new.append_exact(np.array([1]), embeddings[:1])
+    assert np.array_equal(new.exact_rows([1]), embeddings[:1])
+    assert EmbeddingStore(str(tmp_path / 'other')).quantize('int8') == 5
+
+
+def test_read_chunks(tmp_path, monkeypatch):
+    """
+    Test that the chunked readers count the rows and fill preallocated
+    arrays in place.
+    """
+    import numpy as np
+    from quantization import load_matrix_chunks
+    from wiki_graph import read_dataframe
+
+    monkeypatch.setattr(db_utils, 'DB_NAME', str(tmp_path / 'test.db'))
+    db_utils.create_tables()
+    page_id = db_utils.insert_page_metadata('Page', 'en', 'url', 0.9)
+    embeddings = np.random.default_rng(0).normal(size=(10, 8))
+    db_utils.insert_paragraphs_bulk(
+        [(page_id, f'paragraph {i}', to_blob(embedding, 'int8'), i)
+         for i, embedding in enumerate(embeddings)], 'int8')
+    with db_utils.paragraph_corpus_chunks(chunk_size=4) as (n_rows, chunks):
+        assert n_rows == 10
+        assert [len(rows) for rows in chunks] == [4, 4, 2]
+    with db_utils.paragraph_embeddings_chunks(chunk_size=4) \
+            as (n_rows, chunks):
+        codes, scales = load_matrix_chunks(n_rows, chunks, 'int8')
+    assert codes.shape == (10, 8) and scales.shape == (10,)
+    assert np.allclose(codes * scales[:, None], embeddings, atol=0.05)
+    df = read_dataframe(db_utils.paragraph_corpus_chunks(chunk_size=3),
+                        ['paragraph_id', 'page_id', 'page_name', 'text',
+                         'position', 'lang_code'])
+    assert df['position'].tolist() == list(range(10))
+    assert df['paragraph_id'].dtype == np.int64
+    # the rows written meanwhile are not read, the count still holds
+    with db_utils.paragraph_corpus_chunks(chunk_size=4) as (n_rows, chunks):
+        n = 0
+        for i, rows in enumerate(chunks):
+            db_utils.insert_paragraphs_bulk(
+                [(page_id, f'new paragraph {i}', b'', 10 + i)])
+            n += len(rows)
+    assert n == n_rows == 10
+    assert len(db_utils.get_paragraph_corpus()) == 13
+
+
+def test_export(tmp_path, monkeypatch):
+    """
+    Test that the export appends the new rows by high-water mark, and that
+    the loader reads them back by partition.
+    """
+    import numpy as np
+    import pytest
+    pytest.importorskip('pyarrow')
+    from export import embedding_matrix, export_tables, load_table
+
+    monkeypatch.setattr(db_utils, 'DB_NAME', str(tmp_path / 'test.db'))
+    db_utils.create_tables()
+    en = db_utils.insert_page_metadata('Page', 'en', 'en_url', 0.9)
+    es = db_utils.insert_page_metadata('Página', 'es', 'es_url', 0.9)
+    embeddings = np.random.default_rng(0).normal(size=(3, 8))
+    for i, page_id in enumerate((en, es, en)):
+        db_utils.insert_paragraph(page_id, f'paragraph {i}',
+                                  to_blob(embeddings[i], 'float32'), i)
+        if i == 1:
+            path = str(tmp_path / 'export')
+            assert export_tables(path=path)['paragraph_corpus'] == 2
+    assert export_tables(path=path) == {'pages': 0, 'paragraph_corpus': 1,
+                                        'page_links': 0, 'page_autonyms': 0}
+    table = load_table('paragraph_corpus', lang_code='en', path=path)
+    table = table.sort_by('id')
+    assert table.column('text').to_pylist() == ['paragraph 0', 'paragraph 2']
+    assert np.allclose(embedding_matrix(table), embeddings[[0, 2]])
+    assert load_table('pages', path=path).num_rows == 2
+
+
+def test_paragraph_fts(tmp_path, monkeypatch):
+    """
+    Test that the full-text index follows the paragraph inserts, updates
+    and deletes, and the reciprocal rank fusion of two rankings.
+    """
+    monkeypatch.setattr(db_utils, 'DB_NAME', str(tmp_path / 'test.db'))
+    db_utils.create_tables()
+    page_id = db_utils.insert_page_metadata('Page', 'en', 'url', 0.9)
+    db_utils.insert_paragraphs_bulk([
+        (page_id, 'The Tower Bridge crosses the Thames.', b'', 0),
+        (page_id, 'London Bridge is falling down.', b'', 1),
+        (page_id, 'Big Ben is a clock tower.', b'', 2)])
+    rows = db_utils.search_paragraph_text('bridge "thames', 10)
+    assert [i for i, _ in rows] == [1, 2]
+    assert rows[0][1] > rows[1][1]
+    assert db_utils.search_paragraph_text('!?', 10) == []
+    db_utils.delete_paragraphs([1])
+    with get_cursor() as cur:
+        cur.execute("UPDATE paragraph_corpus SET text = 'Elizabeth Tower' "
+                    "WHERE id = 3")
+    assert [i for i, _ in db_utils.search_paragraph_text('tower', 10)] == [3]
+    assert db_utils.search_paragraph_text('clock', 10) == []
+    scores, indices = reciprocal_rank_fusion([[3, 1, 2], [1, 5]], k=60)
+    assert indices.tolist() == [1, 3, 5, 2]
+    assert scores[0] == 1 / 62 + 1 / 61
+
+
+def test_ann_index(tmp_path):
+    """
+    Test that the ANN index finds the nearest paragraphs, and follows the
+    paragraphs appended and deleted across reloads.
+    """
+    import numpy as np
+    import pytest
+    pytest.importorskip('hnswlib')
+    from ann_index import AnnIndex
+
+    embeddings = np.random.default_rng(0).normal(size=(300, 16))
+    embeddings = embeddings.astype(np.float32)
+    ids = np.arange(1, 301)
+    index = AnnIndex(path=str(tmp_path))
+    index.sync(ids[:200], embeddings[:200])
+    _, found = index.search(embeddings[10], 5)
+    assert found[0] == 11
+    _, truth = search(embeddings[:200], None, embeddings[10], 5)
+    assert set(found) == set(truth + 1)
+    # the paragraphs 11 and 12 were deleted, 201 to 300 appended
+    keep = np.r_[0:10, 12:300]
+    index = AnnIndex(path=str(tmp_path))
+    index.sync(ids[keep], embeddings[keep])
+    assert index.max_id == 300
+    assert index.deleted.tolist() == [11, 12]
+    _, found = index.search(embeddings[10], 5)
+    assert 11 not in found and 12 not in found
+    assert index.search(embeddings[250], 1)[1].tolist() == [251]
+
+
+def test_update_paragraphs(tmp_path, monkeypatch):
+    """
+    Test that a recrawl deletes the removed paragraphs, moves the moved
+    ones and embeds only the added ones.
+    """
+    monkeypatch.setattr(db_utils, 'DB_NAME', str(tmp_path / 'test.db'))
+    model = StubModel()
+    monkeypatch.setattr(wiki_graph, 'get_model', lambda: model)
+    db_utils.create_tables()
+    page_id = db_utils.insert_page_metadata('Page', 'en', 'url', 0.9)
+    db_utils.insert_paragraphs_bulk([(page_id, text, b'', position)
+                                     for position, text in enumerate('abc')])
+    ids = {text: i for i, text, _ in db_utils.get_paragraph_rows(page_id)}
+    # b removed, c and a moved, d added, a repeated
+    assert Recrawler.update_paragraphs(page_id, ['c', 'a', 'd', 'a']) == 1
+    assert model.encoded == [['d']]
+    rows = sorted(db_utils.get_paragraph_rows(page_id), key=lambda r: r[2])
+    assert [(text, position) for _, text, position in rows] == \
+        [('c', 0), ('a', 1), ('d', 2)]
+    assert rows[0][0] == ids['c'] and rows[1][0] == ids['a']
+    # unchanged paragraphs are not encoded again
+    assert Recrawler.update_paragraphs(page_id, ['c', 'a', 'd']) == 0
+    assert model.encoded == [['d']]
+    assert Recrawler.update_paragraphs(page_id + 1, ['e']) == 0
+    # rows with a repeated text are matched one to one, the extra deleted
+    calls = []
+    monkeypatch.setattr(db_utils, 'get_paragraph_rows',
+                        lambda page_id: [(1, 'a', 0), (2, 'a', 1)])
+    monkeypatch.setattr(db_utils, 'delete_paragraphs',
+                        lambda ids: calls.append(('delete', ids)))
+    monkeypatch.setattr(db_utils, 'update_paragraph_positions',
+                        lambda positions: calls.append(('move', positions)))
+    assert Recrawler.update_paragraphs(page_id, ['a']) == 0
+    assert calls == [('delete', [2]), ('move', [])]
+
+
+def test_page_similarity_score(monkeypatch):
+    """
+    Test the centroid, mean and top_k page scores on paragraph embeddings
+    with known similarities to the seed (1, 0 and 0.6).
+    """
+    import numpy as np
+    import pytest
+    monkeypatch.setattr(wiki_graph, 'get_model', StubModel)
+    embeddings = np.array([[1, 0], [0, 1], [3, 4]], dtype=np.float32)
+    seed = np.array([1, 0], dtype=np.float32)
+    centroid = 4 / 3 / np.hypot(4 / 3, 5 / 3)
+    assert page_similarity_score(embeddings, seed, 'centroid') == \
+        pytest.approx(centroid)
+    assert page_similarity_score(embeddings, seed, 'mean') == \
+        pytest.approx(1.6 / 3)
+    assert page_similarity_score(embeddings, seed, 'top_k', top_k=2) == \
+        pytest.approx(0.8)
+    assert page_similarity_score(embeddings, seed, 'top_k', top_k=5) == \
+        pytest.approx(1.6 / 3)
+    for method in ('centroid', 'mean', 'top_k'):
+        assert page_similarity_score(np.empty((0, 2)), seed, method) == 0.0
+    with pytest.raises(ValueError):
+        page_similarity_score(embeddings, seed, 'max')
+
+
+def test_save_scored_page(tmp_path, monkeypatch):
+    """
+    Test that a page above the threshold is saved with its paragraph
+    embeddings when it is scored, and that the corpus build does not
+    encode it again; a page below the threshold has no paragraphs saved.
+    """
+    import numpy as np
+    monkeypatch.setattr(db_utils, 'DB_NAME', str(tmp_path / 'test.db'))
+    model = StubModel()
+    monkeypatch.setattr(wiki_graph, 'get_model', lambda: model)
+    db_utils.create_tables()
+    paragraphs = ['London is the capital and largest city of England. ' * 2,
+                  'The city stands on the River Thames in the south. ' * 2]
+    html = ''.join(f'<p>{paragraph}</p>' for paragraph in paragraphs)
+    cr = Crawler.__new__(Crawler)
+    cr.lang_code = 'en'
+    cr.sim_threshold = 0.9
+    cr.seed_embedding = np.array([0, 0, 1, 0.5], dtype=np.float32)
+    with db_utils.BulkWriter(db_utils.PARAGRAPH_INSERT) as writer:
+        cr.paragraph_writer = writer
+        below = wiki_graph.WikiPage('London', 'en', html=html)
+        assert below.paragraphs == paragraphs
+        assert cr.save_scored_page(below) < 0.9
+        cr.seed_embedding = np.mean(model.encode(paragraphs), axis=0)
+        wp = wiki_graph.WikiPage('Thames', 'en', html=html)
+        assert cr.save_scored_page(wp) >= 0.9
+    assert db_utils.get_paragraph_rows(below.page_id) == []
+    rows = sorted(db_utils.get_paragraph_rows(wp.page_id), key=lambda r: r[2])
+    assert [text for _, text, _ in rows] == wp.paragraphs
+    encoded = len(model.encoded)
+    cm = CorpusManager()
+    cm.lang_codes = ['en']
+    cm.sim_threshold = 0.9
+    cm.pool_size = 1
+    cm._build()
+    assert len(model.encoded) == encoded
+
+
+def test_leases(tmp_path, monkeypatch):
+    """
+    Test that two workers cannot claim the same key, that a worker renews
+    its own leases and that an expired lease can be claimed again.
+    """
+    monkeypatch.setattr(db_utils, 'DB_NAME', str(tmp_path / 'test.db'))
+    db_utils.create_tables()
+    assert db_utils.claim_leases(['a', 'b'], 'w1', 60) == ['a', 'b']
+    assert db_utils.claim_leases(['b', 'c'], 'w2', 60) == ['c']
+    assert db_utils.claim_leases(['a', 'c'], 'w1', 60) == ['a']
+    # w2 lets its lease on c expire
+    db_utils.heartbeat_leases('w2', 0)
+    assert db_utils.claim_leases(['b', 'c'], 'w1', 60) == ['b', 'c']
+    assert db_utils.claim_leases(['c'], 'w2', 60) == []
+
+
+def test_crawl_frontier(tmp_path, monkeypatch):
+    """
+    Test that the frontier is claimed by priority, skips the titles already
+    fetched, persists across calls, and that a crawl run processes at most
+    max_pages pages.
+    """
+    monkeypatch.setattr(db_utils, 'DB_NAME', str(tmp_path / 'test.db'))
+    db_utils.create_tables()
+    page_id = db_utils.insert_page_metadata('Seed', 'en', 'url/Seed', 1.0)
+    db_utils.insert_page_metadata('Fetched', 'en', 'url/Fetched', 0.5)
+    db_utils.push_frontier(['Low', 'Fetched'], 'en', 0.2, page_id)
+    db_utils.push_frontier(['High'], 'en', 0.9, page_id)
+    db_utils.push_frontier(['Low', 'Mid'], 'en', 0.5, page_id)
+    db_utils.push_frontier(['Low'], 'en', 0.7, page_id)
+    db_utils.push_frontier(['High'], 'en', 0.1, page_id)
+    assert db_utils.get_frontier_size('en') == 3
+    assert db_utils.claim_frontier('en', 2, 'w1', 60) == \
+        [('High', 0.9), ('Low', 0.7)]
+    # the claimed entries stay in the frontier, leased to w1
+    assert db_utils.claim_frontier('en', 5, 'w2', 60) == [('Mid', 0.5)]
+    db_utils.complete_frontier(['High'], 'en', 'w1')
+    db_utils.insert_page_metadata('Mid', 'en', 'url/Mid', 0.5)
+    assert db_utils.get_frontier_size('en') == 2
+    assert db_utils.claim_frontier('en', 5, 'w3', 60) == []
+
+    for i in range(7):
+        db_utils.push_frontier([f'Page {i}'], 'en', 0.8 - i / 100, page_id)
+    processed = []
+
+    class Fetcher:
+        def fetch_html(self, items):
+            return [(page_name, lang_code, '') for page_name, lang_code
+                    in items]
+
+    cr = Crawler.__new__(Crawler)
+    cr.lang_code = 'en'
+    cr.max_pages = 5
+    cr.max_new_pages = 2
+    cr.worker_id = 'w4'
+    cr.lease_seconds = 60
+    cr.fetcher = Fetcher()
+    cr.process_new_page = lambda page_name, html: processed.append(page_name)
+    cr.crawl_source_lang_pages()
+    assert processed == [f'Page {i}' for i in range(5)]
+    assert db_utils.get_frontier_size('en') == 4
+
+
+def test_build_batches(tmp_path, monkeypatch):
+    """
+    Test that the corpus build encodes the paragraphs of all the pages in
+    batches of embed_batch_size sorted by length, and stores every
+    paragraph with its own embedding at its original position.
+    """
+    import numpy as np
+    monkeypatch.setattr(db_utils, 'DB_NAME', str(tmp_path / 'test.db'))
+    model = StubModel()
+    monkeypatch.setattr(wiki_graph, 'get_model', lambda: model)
+    db_utils.create_tables()
+    sentence = 'The river runs through the city of London. '
+    pages = {'London': [sentence * n for n in (3, 1, 4)],
+             'Thames': [sentence * n for n in (5, 2)]}
+    page_ids = {name: db_utils.insert_page_metadata(name, 'en', f'url/{name}',
+                                                    0.9)
+                for name in pages}
+
+    class Fetcher:
+        def fetch_html(self, items, revalidate=False):
+            for page_name, lang_code in items:
+                html = ''.join(f'<p>{text}</p>' for text in pages[page_name])
+                yield page_name, lang_code, html
+
+    cm = CorpusManager()
+    cm.lang_codes = ['en']
+    cm.sim_threshold = 0.5
+    cm.pool_size = 1
+    cm.embed_batch_size = 2
+    cm.fetcher = Fetcher()
+    cm._build()
+    assert [len(batch) for batch in model.encoded] == [2, 2, 1]
+    texts = [text for batch in model.encoded for text in batch]
+    assert texts == sorted(texts, key=len)
+    embeddings = {paragraph_id: from_blob(blob, dtype)
+                  for paragraph_id, blob, dtype
+                  in db_utils.get_paragraph_embedding_rows()}
+    for name, paragraphs in pages.items():
+        rows = sorted(db_utils.get_paragraph_rows(page_ids[name]),
+                      key=lambda row: row[2])
+        assert [text.strip() for _, text, _ in rows] == \
+            [text.strip() for text in paragraphs]
+        for paragraph_id, text, _ in rows:
+            assert np.array_equal(embeddings[paragraph_id],
+                                  model.encode([text])[0])
 
 
 def test_crawler():
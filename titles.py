@@ -0,0 +1,115 @@
+"""
+Page title canonicalization and the index of known titles.
+
+Titles reach the crawler in several forms: 'Foo_bar', 'Foo bar',
+'./Foo_bar', percent-encoded 'Caf%C3%A9', 'foo_bar#History', or as the
+name of a redirect to another page. canonical_title() maps all the spelling
+variants to one form, and the TitleIndex resolves redirects with the
+page_redirects cache, so that a page is fetched and saved only once.
+
+The Wikimedia API URLs of a page are built here from its title, with the
+title percent-encoded (html_url, languages_url, bare_url). The module has
+no dependencies, so that db_utils can use it without loading requests.
+"""
+import re
+from urllib.parse import quote, unquote
+
+
+API_URL = 'https://api.wikimedia.org/core/v1/wikipedia'
+
+
+def canonical_title(title: str) -> str:
+    """
+    Return the canonical form of a page title: percent-decoded, without
+    the './' prefix and the '#fragment', with underscores instead of spaces
+    and an uppercase first letter, for example:
+
+    './new%20york#History' -> 'New_york'
+    """
+    title = unquote(title)
+    if title.startswith('./'):
+        title = title[2:]
+    title = title.split('#', 1)[0]
+    title = re.sub(r'[\s_]+', '_', title).strip('_')
+    return title[:1].upper() + title[1:]
+
+
+def quote_title(page_name: str) -> str:
+    """
+    Percent-encode a page name for a URL path segment, including '/', '?'
+    and '%', which canonical (decoded) titles can contain.
+    """
+    return quote(page_name, safe='')
+
+
+def html_url(page_name: str, lang_code: str) -> str:
+    """Format the page HTML URL with the language code and page name."""
+    return f'{API_URL}/{lang_code}/page/{quote_title(page_name)}/html'
+
+
+def languages_url(page_name: str, lang_code: str) -> str:
+    """Format the page languages URL with the language code and page name."""
+    return (f'{API_URL}/{lang_code}/page/{quote_title(page_name)}'
+            f'/links/language')
+
+
+def bare_url(page_name: str, lang_code: str) -> str:
+    """Format the page metadata URL with the language code and page name."""
+    return f'{API_URL}/{lang_code}/page/{quote_title(page_name)}/bare'
+
+
+class TitleIndex:
+    """
+    In-memory hash set of the canonical titles saved in the pages table
+    for a language, with the redirect cache in front of it.
+    Membership tests are O(1).
+
+    The index is persisted in the known_titles table, which is kept in sync
+    by db.insert_page_metadata, and loaded once per crawler.
+
+    - titles (set): Canonical titles, e.g. from db.get_known_titles.
+    - redirects (dict): Canonical title -> canonical redirect target,
+      e.g. from db.get_redirects.
+
+    Usage:
+        titles = TitleIndex(db.get_known_titles('en'), db.get_redirects('en'))
+        new_titles = titles.filter_new(page_names)
+    """
+    def __init__(self, titles: set = None, redirects: dict = None):
+        self.titles = titles if titles is not None else set()
+        self.redirects = redirects if redirects is not None else {}
+
+    def resolve(self, title: str) -> str:
+        """Return the canonical title of the page that title points to."""
+        title = canonical_title(title)
+        seen = set()
+        while title in self.redirects and title not in seen:
+            seen.add(title)
+            title = self.redirects[title]
+        return title
+
+    def add_redirect(self, title: str, target: str):
+        """Cache a redirect."""
+        self.redirects[canonical_title(title)] = canonical_title(target)
+
+    def add(self, title: str):
+        """Add a title to the index."""
+        self.titles.add(self.resolve(title))
+
+    def __contains__(self, title: str) -> bool:
+        return self.resolve(title) in self.titles
+
+    def __len__(self) -> int:
+        return len(self.titles)
+
+    def filter_new(self, titles) -> list:
+        """
+        Return the resolved canonical titles that are not in the index,
+        without duplicates, in their input order.
+        """
+        new_titles = {}
+        for title in titles:
+            title = self.resolve(title)
+            if title and title not in self.titles:
+                new_titles[title] = None
+        return list(new_titles)
@@ -0,0 +1,180 @@
+"""
+Pluggable HTTP transport for the Wikimedia API requests.
+
+The transport is selected with TRANSPORT in config.ini:
+    - 'live' (default): send the requests to the API.
+    - 'record': send the requests to the API and save the responses in the
+      TRANSPORT_ARCHIVE file. Conditional headers are dropped and the
+      page store is bypassed, so every response is archived with its body.
+    - 'replay': serve the responses from TRANSPORT_ARCHIVE without network
+      access or an access token, after REPLAY_LATENCY seconds of artificial
+      latency per request. Unknown urls get a 404 response.
+
+Recording a crawl once and replaying it makes the crawler, corpus and graph
+builds reproducible and lets them be profiled without live Wikipedia.
+"""
+import json
+import sqlite3
+import time
+import zlib
+from contextlib import closing
+import requests
+from requests.structures import CaseInsensitiveDict
+from __init__ import logger, config
+
+
+TRANSPORT = config["TRANSPORT"]
+TRANSPORT_ARCHIVE = config["TRANSPORT_ARCHIVE"]
+REPLAY_LATENCY = config["REPLAY_LATENCY"]
+
+CONDITIONAL_HEADERS = {'if-none-match', 'if-modified-since'}
+
+
+class ArchivedResponse:
+    """A response served from the archive, with the used requests API."""
+    def __init__(self, url: str, status_code: int, headers: dict,
+                 content: bytes):
+        self.url = url
+        self.status_code = status_code
+        self.headers = CaseInsensitiveDict(headers)
+        self.content = content
+
+    @property
+    def text(self) -> str:
+        return self.content.decode('utf-8')
+
+    def json(self):
+        try:
+            return json.loads(self.content)
+        except ValueError as e:
+            raise requests.exceptions.JSONDecodeError(str(e), self.text, 0)
+
+
+class LiveTransport:
+    """Send the requests to the API."""
+    def get(self, url: str, headers: dict, timeout: float, session=None):
+        session = session or requests
+        return session.get(url, headers=headers, timeout=timeout)
+
+
+class Archive:
+    """
+    SQLite archive of responses, keyed by the requested url.
+    The url after redirects is kept as the response url.
+    """
+    def __init__(self, path: str = TRANSPORT_ARCHIVE):
+        self.path = path
+        with closing(self._connect()) as conn, conn:
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS responses (
+                    url TEXT PRIMARY KEY,
+                    response_url TEXT,
+                    status_code INTEGER,
+                    headers TEXT,
+                    content BLOB,
+                    recorded_at REAL
+                    )
+                """
+                )
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.path, timeout=30)
+
+    @staticmethod
+    def _key(url: str) -> str:
+        """The url as sent by requests (percent-encoded)."""
+        return requests.Request('GET', url).prepare().url
+
+    def save(self, url: str, response):
+        """Save a response under its request url."""
+        with closing(self._connect()) as conn, conn:
+            conn.execute(
+                """
+                INSERT OR REPLACE INTO responses
+                (url, response_url, status_code, headers, content, recorded_at)
+                VALUES (?, ?, ?, ?, ?, ?)
+                """, (self._key(url), response.url, response.status_code,
+                      json.dumps(dict(response.headers)),
+                      zlib.compress(response.content), time.time())
+                )
+
+    def load(self, url: str):
+        """Return the ArchivedResponse for url, or None."""
+        with closing(self._connect()) as conn:
+            row = conn.execute(
+                """
+                SELECT response_url, status_code, headers, content
+                FROM responses
+                WHERE url = ?
+                """, (self._key(url),)
+                ).fetchone()
+        if row is None:
+            return None
+        response_url, status_code, headers, content = row
+        return ArchivedResponse(response_url, status_code,
+                                json.loads(headers), zlib.decompress(content))
+
+
+class RecordTransport(LiveTransport):
+    """Send the requests to the API and archive the responses."""
+    def __init__(self, archive: Archive):
+        self.archive = archive
+
+    def get(self, url: str, headers: dict, timeout: float, session=None):
+        # a 304 response has no body to replay
+        headers = {name: value for name, value in headers.items()
+                   if name.lower() not in CONDITIONAL_HEADERS}
+        response = super().get(url, headers, timeout, session)
+        if response.status_code != 304:
+            self.archive.save(url, response)
+        return response
+
+
+class ReplayTransport:
+    """Serve the archived responses with artificial latency."""
+    def __init__(self, archive: Archive, latency: float = REPLAY_LATENCY):
+        self.archive = archive
+        self.latency = latency
+
+    def get(self, url: str, headers: dict, timeout: float, session=None):
+        if self.latency:
+            time.sleep(self.latency)
+        response = self.archive.load(url)
+        if response is None:
+            logger.info(f'{url} not in archive')
+            return ArchivedResponse(url, 404, {}, b'{}')
+        etag = response.headers.get('ETag')
+        if etag and headers.get('If-None-Match') == etag:
+            return ArchivedResponse(url, 304, response.headers, b'')
+        return response
+
+
+_transport = None
+
+
+def get_transport():
+    """Return the transport selected in config.ini, created on first use."""
+    global _transport
+    if _transport is None:
+        _transport = make_transport(TRANSPORT)
+    return _transport
+
+
+def set_transport(transport):
+    """Replace the transport, for example in tests and benchmarks."""
+    global _transport
+    _transport = transport
+
+
+def make_transport(mode: str, archive_path: str = TRANSPORT_ARCHIVE,
+                   latency: float = REPLAY_LATENCY):
+    """Create a transport for the mode 'live', 'record' or 'replay'."""
+    if mode == 'live':
+        return LiveTransport()
+    if mode == 'record':
+        return RecordTransport(Archive(archive_path))
+    if mode == 'replay':
+        return ReplayTransport(Archive(archive_path), latency)
+    raise ValueError(f'Unknown transport {mode}, '
+                     f'use one of live, record, replay')
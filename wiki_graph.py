@@ -1,13 +1,27 @@
+"""
+Crawler, corpus and graph of the Wikipedia pages similar to the seed page.
+
+The heavy dependencies (pandas, torch, networkx, pyvis, bs4) are imported
+where they are used, and the SBERT model is loaded on first use (see
+encoder.py), so importing this module is fast.
+"""
+from __future__ import annotations
+import os
 import random
-import requests
-import bs4
-import pandas as pd
+import socket
+import threading
+import time
+from contextlib import contextmanager
 import numpy as np
-import torch
-import networkx as nx
-from pyvis.network import Network
-from sentence_transformers import SentenceTransformer
-from __init__ import logger, config, headers
+from __init__ import logger, config
+from fetcher import (Fetcher, get_fetcher, fetch_page_html,
+                     fetch_page_languages)
+from extract import extract_page
+from titles import TitleIndex, canonical_title, html_url
+from encoder import get_model
+from quantization import RESCORE_FACTOR, rescore, search, to_blob
+from embedding_store import EmbeddingStore
+from ann_index import AnnIndex, use_ann_index
 import db_utils as db
 
 
@@ -16,11 +30,117 @@ DB_NAME = config["DB_NAME"]
 SEED_PAGE_NAME = config["SEED_PAGE_NAME"]
 SIM_THRESHOLD = config["SIM_THRESHOLD"]
 LANG_CODES = config["LANG_CODES"]
-SBERT_MODEL_NAME = config["SBERT_MODEL_NAME"]
+LEASE_SECONDS = config["LEASE_SECONDS"]
+EMBED_BATCH_SIZE = config["EMBED_BATCH_SIZE"]
+PAGE_SCORE = config["PAGE_SCORE"]
+PAGE_SCORE_TOP_K = config["PAGE_SCORE_TOP_K"]
+ENCODER_POOL_SIZE = config["ENCODER_POOL_SIZE"]
+RRF_K = config["RRF_K"]
 
+# Search modes of CorpusManager.similarity_by_paragraphs
+SEARCH_MODES = ('dense', 'text', 'hybrid')
 
-# SBERT model
-MODEL = SentenceTransformer(SBERT_MODEL_NAME)
+# Number of encoder batches gathered and sorted by length before encoding
+EMBED_BUFFER_BATCHES = 16
+
+
+def __getattr__(name):
+    """MODEL is loaded on first access, see encoder.get_model."""
+    if name == 'MODEL':
+        return get_model()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def page_similarity_score(paragraph_embeddings: np.ndarray,
+                          seed_embedding: np.ndarray,
+                          method: str = PAGE_SCORE,
+                          top_k: int = PAGE_SCORE_TOP_K) -> float:
+    """
+    Aggregate the paragraph embeddings of a page into its similarity score
+    against the seed embedding, so that the whole page is scored and not
+    only the start the model reads from the concatenated text.
+
+    Methods (PAGE_SCORE in config.ini):
+        - 'centroid': similarity of the mean paragraph embedding (default).
+        - 'mean': mean of the paragraph similarities.
+        - 'top_k': mean of the top_k paragraph similarities.
+    """
+    if len(paragraph_embeddings) == 0:
+        return 0.0
+    if method == 'centroid':
+        centroid = np.mean(paragraph_embeddings, axis=0)
+        return float(get_model().similarity(centroid, seed_embedding)[0][0])
+    similarities = np.asarray(
+        get_model().similarity(paragraph_embeddings, seed_embedding))[:, 0]
+    if method == 'mean':
+        return float(similarities.mean())
+    if method == 'top_k':
+        return float(np.sort(similarities)[-top_k:].mean())
+    raise ValueError(f'Unknown page score {method}, '
+                     f'use one of centroid, mean, top_k')
+
+
+def reciprocal_rank_fusion(rankings: list, k: int = RRF_K) -> tuple:
+    """
+    Fuse rankings of corpus rows: the score of a row is the sum, over the
+    rankings it is in, of 1 / (k + its rank), ranks counted from 1.
+
+    Args:
+        rankings (list): Arrays of row indices, best first.
+        k (int): The rank constant, greater values flatten the scores of
+            the top ranks.
+
+    Returns:
+        tuple: (scores, indices) of the fused rows, descending.
+    """
+    scores = {}
+    for ranking in rankings:
+        for rank, idx in enumerate(ranking, 1):
+            scores[int(idx)] = scores.get(int(idx), 0.0) + 1.0 / (k + rank)
+    indices = sorted(scores, key=scores.get, reverse=True)
+    return (np.array([scores[i] for i in indices]),
+            np.array(indices, dtype=np.int64))
+
+
+def read_dataframe(reader, columns: list) -> pd.DataFrame:
+    """
+    Read the rows of a chunked reader of db_utils (see db.read_chunks)
+    into a DataFrame. The columns are preallocated from the row count and
+    filled one chunk at a time, without a list of all the rows.
+    """
+    import pandas as pd
+    with reader as (n_rows, chunks):
+        values = [np.empty(n_rows, dtype=object) for _ in columns]
+        i = 0
+        for rows in chunks:
+            for column, column_values in zip(values, zip(*rows)):
+                column[i:i + len(rows)] = column_values
+            i += len(rows)
+    df = pd.DataFrame(dict(zip(columns, values)), copy=False)
+    return df.infer_objects()
+
+
+def encode_paragraphs(paragraphs: list) -> np.ndarray:
+    """Encode the paragraphs of a page in batches."""
+    return get_model().encode(paragraphs, batch_size=EMBED_BATCH_SIZE)
+
+
+def save_paragraph_embeddings(page_id: int, paragraphs: list,
+                              embeddings: np.ndarray, writer=None):
+    """
+    Save the paragraphs of a page with their embeddings, right away or
+    through a BulkWriter of db.PARAGRAPH_INSERT.
+
+    The embeddings are saved as float32, the embedding store converts them
+    to EMBEDDING_DTYPE (see EmbeddingStore.sync).
+    """
+    rows = [(page_id, paragraph, to_blob(embedding, 'float32'), position)
+            for position, (paragraph, embedding)
+            in enumerate(zip(paragraphs, embeddings))]
+    if writer is None:
+        db.insert_paragraphs_bulk(rows)
+    else:
+        writer.add_many([(*row, 'float32') for row in rows])
 
 
 class CorpusManager:
@@ -37,10 +157,14 @@ class CorpusManager:
         - Prepare/coordinate corpus embeddings.
         - Provide convenient access to the main corpus and its properties.
         - Provide access to vector similarity and clustering functions.
+        - Provide full-text (BM25) and hybrid search, see _similarity_search.
 
     - sim_threshold (float): Minimum similarity score for included pages.
-    - corpus: List of (page_id, page_name, text, position) tuples.
-    - corpus_embedding: Numpy array of embeddings for each paragraph.
+    - corpus: The corpus DataFrame, the same as df.
+    - corpus_embedding: Numpy array of embeddings for each paragraph,
+      memory-mapped.
+    - ann_index: The AnnIndex searched instead of corpus_embedding, or None
+      (see ann_index.use_ann_index).
     - df: DataFrame view of the corpus.
 
     Usage:
@@ -53,91 +177,247 @@ class CorpusManager:
         self.lang_codes = LANG_CODES
         self.corpus = None
         self.corpus_embedding = None
+        self.corpus_scales = None
+        self.embedding_store = None
+        self.rescore_factor = RESCORE_FACTOR
+        self.rrf_k = RRF_K
+        self.ann_index = None
         self.df = None
+        self.fetcher = get_fetcher()
+        self.embed_batch_size = EMBED_BATCH_SIZE
+        self.pool_size = ENCODER_POOL_SIZE
+        self.encode_seconds = 0.0
 
-    def load(self):
-        """Initialize the module, build the corpus and load the vectors."""
-        self._build()
-        self.corpus = self._read()
-        self.df = self._to_df()
+    def load(self, build: bool = True):
+        """
+        Initialize the module, build the corpus (unless build is False)
+        and load the vectors.
+        """
+        if build:
+            self._build()
+        self.df = self._read()
+        self.corpus = self.df
         self._load_corpus_embedding()
         assert self.df.shape[0] == self.corpus_embedding.shape[0]
 
     def _read(self):
-        corpus = db.get_paragraph_corpus()
-        return corpus
+        """Read the corpus, by ascending paragraph id, in chunks."""
+        df = read_dataframe(db.paragraph_corpus_chunks(), [
+            'paragraph_id', 'page_id', 'page_name',
+            'text', 'position', 'lang_code'])
+        logger.info(f'Read corpus to dataframe with shape {df.shape}')
+        return df
 
     def _load_corpus_embedding(self):
         """
-        Load all paragraph embeddings from the database
-        and stack them into a numpy array.
+        Memory-map the paragraph embeddings of the corpus.
 
-        This method fetches the binary embeddings from the `embedding` column
-        in the `paragraph_corpus` table, converts each to a float32 np array,
-        and stacks them vertically to produce a 2D array.
+        The embedding store (see embedding_store.py) is brought up to date
+        with the paragraph ids of the corpus and memory-mapped, so that
+        row i of corpus_embedding is the embedding of row i of the corpus,
+        in its stored format (float32, float16 or int8, see
+        quantization.py).
 
         Sets:
             self.corpus_embedding (np.ndarray):
-                An array of shape (num_paragraphs, embedding_dim).
+                A memory-mapped array of shape (num_paragraphs,
+                embedding_dim).
+            self.corpus_scales (np.ndarray): The per-row scales of int8
+                embeddings, or None.
+            self.ann_index (AnnIndex): The ANN index of the embeddings,
+                brought up to date the same way, for large corpora.
         """
-        embeddings = db.get_paragraph_embeddings()
-        self.corpus_embedding = np.vstack(
-            [np.frombuffer(e[0], dtype=np.float32) for e in embeddings]
-            )
-        logger.info('Loaded embeddings.')
+        paragraph_ids = self.df['paragraph_id'].to_numpy()
+        self.embedding_store = EmbeddingStore()
+        self.corpus_embedding, self.corpus_scales = \
+            self.embedding_store.sync(paragraph_ids)
+        logger.info(f'Mapped embeddings as {self.corpus_embedding.dtype} '
+                    f'({self.corpus_embedding.nbytes / 2**20:.1f} MiB).')
+        self.ann_index = None
+        if use_ann_index(len(paragraph_ids)):
+            self.ann_index = AnnIndex()
+            self.ann_index.sync(paragraph_ids, self.corpus_embedding,
+                                self.corpus_scales)
 
     def _build(self):
         """
         Get the pages with sim_threshold >= self.sim_threshold
         and not in the paragraph_corpus table.
-        For each page, create a WikiPage object and save it to the database.
+        For each page, create a WikiPage object and gather its paragraphs,
+        which are encoded in batches across pages and saved to the database.
         """
         logger.info('Building corpus...')
 
         pages = []
         for lang_code in self.lang_codes:
-            pages_ = db.get_pages_data(self.sim_threshold, lang_code)
+            pages_ = db.get_unbuilt_pages(self.sim_threshold, lang_code)
             for p in pages_:
                 pages.append(p)
 
-        corpus = self._read()
-        pc_page_ids = set(i[1] for i in corpus)
+        page_ids = {(page_name, lang_code): page_id
+                    for page_id, page_name, lang_code, _ in pages}
+
+        n = n_paragraphs = 0
+        self.encode_seconds = 0.0
+        # (page_id, position, paragraph) gathered across pages
+        buffer = []
+        # enough batches to keep every worker of the pool busy
+        buffer_size = self.embed_batch_size * max(EMBED_BUFFER_BATCHES,
+                                                  4 * self.pool_size)
+        with self._encoder_pool() as pool, \
+                db.BulkWriter(db.PARAGRAPH_INSERT) as writer:
+            for wp in WikiPage.iter_pages(page_ids, self.fetcher):
+                page_id = page_ids[(wp.page_name, wp.lang_code)]
+                paragraphs = wp.paragraphs
+                if len(paragraphs) == 0:
+                    continue
+                buffer += [(page_id, position, paragraph)
+                           for position, paragraph in enumerate(paragraphs)]
+                if len(buffer) >= buffer_size:
+                    n_paragraphs += self._embed_paragraphs(buffer, writer,
+                                                           pool)
+                    buffer = []
+                n += 1
+            n_paragraphs += self._embed_paragraphs(buffer, writer, pool)
+        rate = n_paragraphs / self.encode_seconds if self.encode_seconds else 0
+        logger.info(f'Added {n} pages to corpus, embedded {n_paragraphs} '
+                    f'paragraphs at {rate:.1f} paragraphs/sec')
 
-        n = 0
-        for page_id, page_name, lang_code, _ in pages:
-            if page_id in pc_page_ids:
-                continue
-            wp = WikiPage(page_name, lang_code=lang_code)
-            paragraphs = wp.paragraphs
-            if len(paragraphs) == 0:
-                continue
-            for position, paragraph in enumerate(paragraphs):
-                embedding = MODEL.encode(paragraph)
-                embedding = np.array(embedding, dtype=np.float32).tobytes()
-                db.insert_paragraph(page_id, paragraph, embedding, position)
-            n += 1
-        logger.info(f'Added {n} pages to corpus')
-
-    def _to_df(self):
-        df = pd.DataFrame(self.corpus)
-        df.columns = [
-            'paragraph_id', 'page_id', 'page_name',
-            'text', 'position', 'lang_code']
-        logger.info(f'Converted corpus to dataframe with shape {df.shape}')
-        return df
+    @contextmanager
+    def _encoder_pool(self):
+        """
+        Yield an EncoderPool when pool_size > 1, otherwise None
+        (the paragraphs are encoded by this process).
+        """
+        if self.pool_size <= 1:
+            yield None
+            return
+        from encoder_pool import EncoderPool
+        with EncoderPool(size=self.pool_size,
+                         batch_size=self.embed_batch_size) as pool:
+            yield pool
+
+    def _embed_paragraphs(self, rows: list, writer: db.BulkWriter,
+                          pool=None) -> int:
+        """
+        Encode paragraphs from many pages and save them.
 
-    def _similarity_search(self, query: str, top_k_min: int=100) -> list:
-        """Given a query, retrieve similar corpus rows."""
-        # todo: add lang code parameter
-        # embeddings
-        corpus_embeddings = self.corpus_embedding
-        query_embedding = MODEL.encode_query(query)
+        The paragraphs are sorted by length, so that each batch holds
+        paragraphs of similar length and little padding, and every batch
+        of embed_batch_size paragraphs is encoded in one call, by this
+        process or by the workers of the encoder pool. The embeddings are
+        written as float32 by this process, through the writer, as the
+        batches are encoded.
+
+        Args:
+            rows (list): List of (page_id, position, paragraph) tuples.
+            writer (db.BulkWriter): The writer of the paragraphs.
+            pool (EncoderPool): The encoder pool, or None.
+
+        Returns:
+            int: The number of paragraphs encoded.
+        """
+        rows = sorted(rows, key=lambda row: len(row[2]))
+        batches = [rows[i:i + self.embed_batch_size]
+                   for i in range(0, len(rows), self.embed_batch_size)]
+        texts = [[paragraph for _, _, paragraph in batch]
+                 for batch in batches]
+        start = time.perf_counter()
+        if pool is None:
+            encoded = ((i, get_model().encode(
+                            batch, batch_size=self.embed_batch_size))
+                       for i, batch in enumerate(texts))
+        else:
+            encoded = pool.encode_batches(texts)
+        for i, embeddings in encoded:
+            writer.add_many(
+                [(page_id, paragraph, to_blob(embedding, 'float32'),
+                  position, 'float32')
+                 for (page_id, position, paragraph), embedding
+                 in zip(batches[i], embeddings)])
+        self.encode_seconds += time.perf_counter() - start
+        return len(rows)
+
+    def _dense_search(self, query: str, top_k: int) -> tuple:
+        """
+        Return the (scores, indices) of the top_k corpus rows most similar
+        to a query.
+
+        The search runs on the ANN index if there is one, otherwise on
+        every stored (possibly quantized) embedding. With quantized
+        embeddings and a rescore_factor, the top_k * rescore_factor
+        candidates are rescored with their float32 embeddings, read from
+        the embedding store (see EmbeddingStore.exact_rows).
+        """
+        query_embedding = get_model().encode_query(query)
+        rescoring = self.rescore_factor \
+            and self.corpus_embedding.dtype != np.float32
+        n_candidates = top_k * self.rescore_factor if rescoring else top_k
+        if self.ann_index is not None:
+            scores, ids = self.ann_index.search(query_embedding,
+                                                n_candidates)
+            scores, indices = self._paragraph_rows(scores, ids)
+        else:
+            scores, indices = search(self.corpus_embedding,
+                                     self.corpus_scales, query_embedding,
+                                     n_candidates)
+        if rescoring:
+            exact = self.embedding_store.exact_rows(
+                self.df['paragraph_id'].to_numpy()[indices])
+            if exact is None:
+                logger.warning('Some candidates have no float32 embedding, '
+                               'returning them unrescored')
+                return scores[:top_k], indices[:top_k]
+            scores, indices = rescore(query_embedding, indices, exact, top_k)
+        return scores, indices
+
+    def _text_search(self, query: str, top_k: int) -> tuple:
+        """
+        Return the (scores, indices) of the top_k corpus rows matching the
+        words of a query, by BM25 relevance, from the full-text index
+        (see db.search_paragraph_text). No embedding is computed.
+        """
+        rows = db.search_paragraph_text(query, top_k)
+        return self._paragraph_rows(
+            np.array([score for _, score in rows]),
+            np.array([i for i, _ in rows], dtype=np.int64))
+
+    def _paragraph_rows(self, scores: np.ndarray, ids: np.ndarray) -> tuple:
+        """
+        Return the (scores, indices) of the corpus rows of paragraph ids.
+        The paragraphs inserted since the corpus was loaded are left out.
+        """
+        # the corpus is sorted by paragraph id
+        paragraph_ids = self.df['paragraph_id'].to_numpy()
+        indices = np.searchsorted(paragraph_ids, ids)
+        found = indices < len(paragraph_ids)
+        found[found] = paragraph_ids[indices[found]] == ids[found]
+        return scores[found], indices[found]
+
+    def _similarity_search(self, query: str, top_k_min: int=100,
+                           mode: str = 'dense') -> list:
+        """
+        Given a query, retrieve similar corpus rows.
 
-        # similarity scores
-        similarity_scores = MODEL.similarity(query_embedding,
-                                             corpus_embeddings)[0]
+        - dense: by embedding similarity, see _dense_search.
+        - text: by BM25 relevance, see _text_search.
+        - hybrid: the top_k_min rows of both, fused by reciprocal rank
+          fusion (see reciprocal_rank_fusion), with the rrf_k constant.
+        """
+        # todo: add lang code parameter
         top_k = min(top_k_min, len(self.df))
-        scores, indices = torch.topk(similarity_scores, k=top_k)
+        if mode == 'dense':
+            scores, indices = self._dense_search(query, top_k)
+        elif mode == 'text':
+            scores, indices = self._text_search(query, top_k)
+        elif mode == 'hybrid':
+            scores, indices = reciprocal_rank_fusion(
+                [self._text_search(query, top_k)[1],
+                 self._dense_search(query, top_k)[1]], self.rrf_k)
+            scores, indices = scores[:top_k], indices[:top_k]
+        else:
+            raise ValueError(f'Unknown search mode {mode}, '
+                             f'expected one of {SEARCH_MODES}')
 
         # similar rows
         rows = []
@@ -151,24 +431,33 @@ class CorpusManager:
     def similarity_by_paragraphs(
             self,
             query: str,
-            top_k_min: int=100
+            top_k_min: int=100,
+            mode: str = 'dense'
             ) -> pd.DataFrame:
         """
         Retrieve similar rows, convert to df and sort by descending similarity.
+        The mode is one of SEARCH_MODES, see _similarity_search.
         """
-        rows = self._similarity_search(query=query, top_k_min=top_k_min)
+        import pandas as pd
+        rows = self._similarity_search(query=query, top_k_min=top_k_min,
+                                       mode=mode)
         df = pd.DataFrame(rows).reset_index(drop=True)
-        df = df.sort_values(by='score', ascending=False)
+        if len(df) > 0:
+            df = df.sort_values(by='score', ascending=False)
         logger.info(f'Returned {len(df)} paragraphs')
         return df
 
     def similarity_by_pages(
             self,
             query: str,
-            top_k_min: int=100
+            top_k_min: int=100,
+            mode: str = 'dense'
             ) -> pd.DataFrame:
         "Group by page name and calculate paragraph similarity average."
-        df = self.similarity_by_paragraphs(query=query, top_k_min=top_k_min)
+        df = self.similarity_by_paragraphs(query=query, top_k_min=top_k_min,
+                                           mode=mode)
+        if len(df) == 0:
+            return df
         dfg = df.groupby('page_name', as_index=False)['score'].mean()
         dfg = dfg.sort_values(by='score', ascending=False)
         logger.info(f'Returned {len(dfg)} pages')
@@ -207,10 +496,9 @@ class CorpusBitexts:
         Each row corresponds to an aligned pair based on cross-lingual
         Wikipedia autonyms data.
         """
-        autonyms_data = db.read_autonyms_data(tgt_lang)
-        df = pd.DataFrame(autonyms_data)
-        df.columns = ['page_name', 'page_id', 'autonym',
-                      'autonym_page_id', 'lang_code']
+        df = read_dataframe(db.autonyms_data_chunks(tgt_lang),
+                            ['page_name', 'page_id', 'autonym',
+                             'autonym_page_id', 'lang_code'])
         df['src_text'] = df['page_id'].apply(db.get_paragraphs_by_page_id)
         df['tgt_text'] = df['autonym_page_id'].apply(db.get_paragraphs_by_page_id)
         df = df.dropna()
@@ -227,6 +515,7 @@ class CorpusBitexts:
             pd.DataFrame: DataFrame containing aligned bitext pairs
             from all languages in 'lang_codes' except for English.
         """
+        import pandas as pd
         dfs = []
         for lang_code in self.lang_codes:
             if lang_code == 'en':
@@ -256,11 +545,28 @@ class CorpusBitexts:
 
 
 class Crawler:
+    """
+    Crawls the pages similar to the seed page.
+
+    Several crawlers (worker processes, on one or several boxes sharing the
+    database) can run at the same time: each one claims the pages it
+    processes through the leases table, and extends its leases with a
+    heartbeat while it works. The leases of a crashed worker expire after
+    LEASE_SECONDS and its pages return to the other workers.
+
+    - max_pages (int): The number of new pages crawled per run at most.
+    - max_new_pages (int): The number of page names claimed from the
+      frontier, and downloaded concurrently, at a time.
+    - worker_id (str): Unique worker name, defaults to hostname-pid.
+    - paragraph_writer (db.BulkWriter): The writer of the paragraphs of the
+      similar pages while crawling.
+    """
     def __init__(
         self,
         lang_code: str = 'en',
         max_pages: int = 50,
-        max_new_pages: int = 50
+        max_new_pages: int = 50,
+        worker_id: str = None
         ):
         self.sim_threshold = SIM_THRESHOLD
         self.seed_page_name = SEED_PAGE_NAME
@@ -269,6 +575,11 @@ class Crawler:
         self.lang_code = lang_code
         self.lang_codes = LANG_CODES
         self.autonym_lang_codes = None
+        self.fetcher = get_fetcher()
+        self.titles = None
+        self.worker_id = worker_id or f'{socket.gethostname()}-{os.getpid()}'
+        self.lease_seconds = LEASE_SECONDS
+        self.paragraph_writer = None
         self.load()
 
     def set_autonym_lang_codes(self):
@@ -281,107 +592,353 @@ class Crawler:
         Initialize crawler with the seed page.
 
         - Save the page name.
-        - Encode the seed paragraphs (todo: save them to vector db)
+        - Encode the seed paragraphs and save them.
+        - Push the seed page links to the crawl frontier.
         """
+        self.titles = TitleIndex(db.get_known_titles(self.lang_code),
+                                 db.get_redirects(self.lang_code))
         wp = WikiPage(self.seed_page_name, lang_code=self.lang_code)
         wp.save_page_name(sim_score=1.0)
         self.seed_paragraphs = wp.paragraphs
+        self.seed_paragraph_embeddings = encode_paragraphs(wp.paragraphs)
         self.seed_embedding = self.get_seed_embedding()
+        save_paragraph_embeddings(wp.page_id, wp.paragraphs,
+                                  self.seed_paragraph_embeddings)
         self.set_autonym_lang_codes()
+        self.expand_page(wp, sim_score=1.0)
         logger.info(f'Loaded seed paragraphs from {self.seed_page_name}')
 
     def get_seed_embedding(self) -> np.ndarray:
         """
-        Encode the seed paragraphs.
+        Average the seed paragraph embeddings.
         This seed embedding will be used to determine the similarity
         of the new crawled pages.
         """
-        seed_embedding = MODEL.encode(' '.join(self.seed_paragraphs))
+        seed_embedding = np.mean(self.seed_paragraph_embeddings, axis=0)
         return seed_embedding
 
-    def get_page_similarity_score(self, paragraphs: list) -> float:
+    def get_page_similarity_score(self, paragraphs: list,
+                                  embeddings: np.ndarray = None) -> float:
         """
         Given a list of paragraphs, encode them and calculate
         their similarity against the seed.
         Args:
             paragraphs (list): A list of paragraphs.
+            embeddings (np.ndarray): The paragraph embeddings, if they
+                were already encoded.
         Returns:
             float: The similarity score between the paragraphs
-            and the seed embedding.
+            and the seed embedding, see page_similarity_score.
+        """
+        if embeddings is None:
+            embeddings = encode_paragraphs(paragraphs)
+        return page_similarity_score(embeddings, self.seed_embedding)
+
+    def save_scored_page(self, wp: WikiPage, page_id: int = None) -> float:
+        """
+        Encode the paragraphs of a page once, score the page and save its
+        score. The paragraphs of a page above the similarity threshold are
+        saved with their embeddings right away, so that the corpus build
+        does not download and encode the page again.
+
+        Args:
+            wp (WikiPage): The page.
+            page_id (int): The id of a page already in the pages table,
+                whose score is updated; otherwise the page is inserted.
+
+        Returns:
+            float: The page similarity score.
         """
-        paragraphs_embedding = MODEL.encode_document(' '.join(paragraphs))
-        sim_score = float(MODEL.similarity(paragraphs_embedding,
-                                           self.seed_embedding)[0])
+        embeddings = encode_paragraphs(wp.paragraphs)
+        sim_score = self.get_page_similarity_score(wp.paragraphs, embeddings)
+        if page_id is None:
+            wp.save_page_name(sim_score)
+        else:
+            wp.page_id = page_id
+            db.update_page_score(page_id, sim_score)
+        if sim_score >= float(self.sim_threshold):
+            save_paragraph_embeddings(wp.page_id, wp.paragraphs, embeddings,
+                                      self.paragraph_writer)
         return sim_score
 
-    def process_new_page(self, page_name):
+    def process_new_page(self, page_name, html=None):
         """
         Process a new Wikipedia page name: fetch the page,
-        compute similarity score, save its metadata to the database.
+        compute similarity score, save its metadata to the database,
+        and push its links to the crawl frontier if it is similar enough.
+
+        If the page name is a redirect, the redirect is cached and the page
+        is saved under the target title, unless the target is already known.
 
         Args:
             page_name (str): The name of the new Wikipedia page to process.
+            html (str): The page HTML, if it was already downloaded.
         """
-        wp_new = WikiPage(page_name, lang_code=self.lang_code)
-        sim_score = self.get_page_similarity_score(wp_new.paragraphs)
-        wp_new.save_page_name(sim_score)
+        wp_new = WikiPage(page_name, lang_code=self.lang_code, html=html)
+        if wp_new.redirect_target:
+            db.insert_redirect(self.lang_code, page_name,
+                               wp_new.redirect_target)
+            self.titles.add_redirect(page_name, wp_new.redirect_target)
+            if wp_new.redirect_target in self.titles:
+                return
+            wp_new.page_name = wp_new.redirect_target
+            wp_new.url = wp_new.get_html_url()
+        sim_score = self.save_scored_page(wp_new)
+        self.titles.add(wp_new.page_name)
+        self.expand_page(wp_new, sim_score)
+
+    def expand_page(self, wp: WikiPage, sim_score: float):
+        """
+        Push the internal page names of a page to the crawl frontier,
+        with the page sim_score as priority. The page names are canonicalized
+        and resolved, and the ones already saved are skipped.
+        Pages below the similarity threshold are not expanded.
+        """
+        if sim_score < float(self.sim_threshold):
+            return
+        new_page_names = self.titles.filter_new(wp.get_internal_page_names())
+        db.push_frontier(new_page_names, self.lang_code, sim_score,
+                         wp.page_id)
+
+    def seed_frontier(self):
+        """
+        Fill an empty frontier from the links of the most similar saved
+        pages (at most max_pages of them).
+        """
+        page_data = db.get_pages_data(self.sim_threshold, self.lang_code)
+        page_data = sorted(page_data, key=lambda p: p[3], reverse=True)
+        sim_scores = {page_name: (page_id, sim_score)
+                      for page_id, page_name, _, sim_score
+                      in page_data[:self.max_pages]}
+        source_pages = [(page_name, self.lang_code)
+                        for page_name in sim_scores]
+        for wp in WikiPage.iter_pages(source_pages, self.fetcher):
+            wp.page_id, sim_score = sim_scores[wp.page_name]
+            self.expand_page(wp, sim_score)
+        logger.info(f'Seeded crawl frontier from {len(source_pages)} pages')
 
     def crawl(self):
         logger.info(f'Crawling pages with similarity threshold '
                     f'{self.sim_threshold}')
-        self.crawl_source_lang_pages()
-        self.crawl_autonym_pages()
+        with db.BulkWriter(db.PARAGRAPH_INSERT) as self.paragraph_writer:
+            self.crawl_source_lang_pages()
+            self.crawl_autonym_pages()
+        self.paragraph_writer = None
         logger.info('Crawling complete')
 
+    @contextmanager
+    def heartbeat(self):
+        """Extend the leases of this worker in the background meanwhile."""
+        stop = threading.Event()
+
+        def beat():
+            while not stop.wait(self.lease_seconds / 3):
+                db.heartbeat_leases(self.worker_id, self.lease_seconds)
+
+        thread = threading.Thread(target=beat, daemon=True)
+        thread.start()
+        try:
+            yield
+        finally:
+            stop.set()
+            thread.join()
+
     def crawl_source_lang_pages(self):
         """
-        Crawl Wikipedia pages based on a similarity threshold.
-        - For each page name from DB, extract internal Wikipedia links
-        (<a> inside <p> tags).
-        - For every internal link not already saved, process it as a new page
-        (fetch the content, compute similarity, save metadata).
+        Crawl Wikipedia pages best-first from the crawl frontier.
+        - Claim the highest-priority page names (internal links discovered in
+        similar pages) in batches of max_new_pages, up to max_pages pages.
+        - Process every page of the batch as a new page (fetch the content,
+        compute similarity, save metadata, push its links to the frontier).
+
+        The pages of a batch are downloaded concurrently.
         """
-        page_data = db.get_pages_data(self.sim_threshold, self.lang_code)
-        page_names = [p[1] for p in page_data]
-        random.shuffle(page_data)
-        visited = set()
-        for _, page_name, _, _ in page_data[:self.max_pages]:
-            wp = WikiPage(page_name=page_name, lang_code=self.lang_code)
-            new_page_names = wp.get_internal_page_names()
-            random.shuffle(new_page_names)
-            for new_page_name in new_page_names[:self.max_new_pages]:
-                if new_page_name in list(visited) + page_names:
-                    continue
-                self.process_new_page(new_page_name)
-                visited.add(new_page_name)
+        if db.get_frontier_size(self.lang_code) == 0:
+            self.seed_frontier()
+        n = 0
+        while n < self.max_pages:
+            batch = db.claim_frontier(self.lang_code,
+                                      min(self.max_new_pages,
+                                          self.max_pages - n),
+                                      self.worker_id, self.lease_seconds)
+            if not batch:
+                break
+            new_pages = [(page_name, self.lang_code) for page_name, _ in batch]
+            with self.heartbeat():
+                for page_name, _, html in self.fetcher.fetch_html(new_pages):
+                    self.process_new_page(page_name, html=html)
+                    db.complete_frontier([page_name], self.lang_code,
+                                         self.worker_id)
+                    n += 1
+        logger.info(f'Processed {n} new pages, '
+                    f'{db.get_frontier_size(self.lang_code)} left in frontier')
 
     def crawl_autonym_pages(self):
-        """Populate the page_autonyms table and save autonym pages."""
+        """
+        Populate the page_autonyms table and save autonym pages.
+
+        - Request the language links of the pages that have none cached
+          (pages ingested from a langlinks dump already have them, see
+          dumps.py). The source pages are claimed in batches of
+          max_new_pages, in random order so that concurrent workers spread
+          over different pages. Their leases are kept until they expire, so
+          that the other workers do not process them again meanwhile.
+        - Fill page_autonyms from the cached language links in one pass.
+        - Fetch only the autonym pages whose content is missing.
+        """
         logger.info('populate_autonyms_table...')
-        unsaved_pages = db.get_unsaved_autonym_page_ids(self.lang_code,
-                                                        self.sim_threshold)
-        n = 0
-        for page_id, page_name in unsaved_pages:
-            wp = WikiPage(page_name, self.lang_code)
-            languages = wp.get_languages()
-            if len(languages) == 0:
+        unsaved_pages = db.get_pages_without_language_links(
+            self.lang_code, self.sim_threshold)
+        random.shuffle(unsaved_pages)
+        for i in range(0, len(unsaved_pages), self.max_new_pages):
+            batch = {f'autonyms:{page_id}': page_name
+                     for page_id, page_name
+                     in unsaved_pages[i:i + self.max_new_pages]}
+            claimed = db.claim_leases(list(batch), self.worker_id,
+                                      self.lease_seconds)
+            if not claimed:
                 continue
+            with self.heartbeat():
+                self.save_language_links([batch[key] for key in claimed])
+        n = db.fill_autonyms(self.lang_code, self.sim_threshold,
+                             self.autonym_lang_codes)
+        logger.info(f'Saved {n} autonyms')
+        self.save_autonym_pages()
+
+    def save_language_links(self, page_names: list):
+        """Request and cache the language links of the source pages."""
+        rows = []
+        for page_name, _, languages in self.fetcher.fetch_languages(
+                [(page_name, self.lang_code) for page_name in page_names]):
             for lang in languages:
                 if not isinstance(lang, dict):
                     continue
-                autonym = lang['key']
-                lang_code = lang['code']
-                if lang_code in self.autonym_lang_codes:
-                    wp_x = WikiPage(page_name=autonym, lang_code=lang_code)
-                    if len(wp_x.paragraphs) == 0:
-                        continue
-                    sim_score = self.get_page_similarity_score(wp_x.paragraphs)
-                    wp_x.save_page_name(sim_score)
-                    autonym_page_id = wp_x.page_id
-                    db.insert_autonym(page_id, autonym,
-                                      autonym_page_id, lang_code)
-                    n += 1
-        logger.info(f'Saved {n} autonyms')
+                rows.append((self.lang_code, canonical_title(page_name),
+                             lang['code'], canonical_title(lang['key'])))
+        db.insert_language_links(rows)
+
+    def save_autonym_pages(self) -> int:
+        """
+        Fetch and score the autonym pages that were not fetched yet.
+
+        Returns:
+            int: The number of autonym pages saved.
+        """
+        pages = db.get_unfetched_autonym_pages(self.lang_code,
+                                               self.sim_threshold)
+        random.shuffle(pages)
+        n = 0
+        for i in range(0, len(pages), self.max_new_pages):
+            batch = {f'autonym_page:{page_id}': (page_id, page_name, lang_code)
+                     for page_id, page_name, lang_code
+                     in pages[i:i + self.max_new_pages]}
+            claimed = db.claim_leases(list(batch), self.worker_id,
+                                      self.lease_seconds)
+            if not claimed:
+                continue
+            page_ids = {(page_name, lang_code): page_id
+                        for page_id, page_name, lang_code
+                        in (batch[key] for key in claimed)}
+            with self.heartbeat():
+                for wp_x in WikiPage.iter_pages(page_ids, self.fetcher):
+                    self.save_scored_page(
+                        wp_x, page_ids[(wp_x.page_name, wp_x.lang_code)])
+                    if len(wp_x.paragraphs) > 0:
+                        n += 1
+        logger.info(f'Saved {n} autonym pages')
+        return n
+
+
+class Recrawler:
+    """
+    Keeps the crawled pages fresh incrementally.
+
+    Pages crawled more than max_age_days ago are checked against their
+    latest revision id, which is cheap. Only the pages with a new revision
+    are downloaded again, and only their new or changed paragraphs are
+    embedded: removed paragraphs are deleted from the paragraph_corpus
+    and moved paragraphs get their new position.
+
+    Usage:
+        Recrawler(max_age_days=30).recrawl()
+    """
+    def __init__(self, max_age_days: int = 30):
+        self.max_age_days = max_age_days
+        self.lang_codes = LANG_CODES
+        self.fetcher = get_fetcher()
+
+    def recrawl(self):
+        logger.info(f'Recrawling pages older than {self.max_age_days} days')
+        for lang_code in self.lang_codes:
+            self.recrawl_lang(lang_code)
+        logger.info('Recrawling complete')
+
+    def recrawl_lang(self, lang_code: str):
+        """Refresh the stale pages of one language."""
+        stale_pages = db.get_stale_pages(self.max_age_days, lang_code)
+        pages = {page_name: (page_id, revision_id)
+                 for page_id, page_name, revision_id in stale_pages}
+
+        # (page_name, lang_code) -> (page_id, latest revision id)
+        changed = {}
+        for page_name, _, latest in self.fetcher.fetch_latest_revisions(
+                (page_name, lang_code) for page_name in pages):
+            page_id, revision_id = pages[page_name]
+            if latest is None:
+                continue
+            if latest == revision_id:
+                db.update_page_revision(page_id, revision_id)
+            else:
+                changed[(page_name, lang_code)] = (page_id, latest)
+        logger.info(f'{len(changed)} of {len(pages)} stale pages changed')
+
+        n = 0
+        for wp in WikiPage.iter_pages(changed, self.fetcher, revalidate=True):
+            page_id, latest = changed[(wp.page_name, wp.lang_code)]
+            n += self.update_paragraphs(page_id, wp.paragraphs)
+            db.update_page_revision(page_id, latest)
+        logger.info(f'Embedded {n} new or changed paragraphs')
+
+    @staticmethod
+    def update_paragraphs(page_id: int, paragraphs: list) -> int:
+        """
+        Update the paragraphs of a page in the corpus to the new paragraphs.
+        Pages that are not in the corpus are left to CorpusManager._build.
+
+        Returns:
+            int: The number of paragraphs embedded.
+        """
+        rows = db.get_paragraph_rows(page_id)
+        if not rows:
+            return 0
+        # the k-th occurrence of a text is matched with its k-th stored row
+        old = {}
+        for paragraph_id, text, position in sorted(rows,
+                                                   key=lambda row: row[2]):
+            old.setdefault(text, []).append((paragraph_id, position))
+        # a page holds one row per text (UNIQUE(page_id, text)), the
+        # repeated texts are not stored, as in CorpusManager._build
+        texts = set(old)
+        moved = []
+        added = []
+        for position, text in enumerate(paragraphs):
+            if old.get(text):
+                paragraph_id, old_position = old[text].pop(0)
+                if old_position != position:
+                    moved.append((paragraph_id, position))
+            elif text not in texts:
+                texts.add(text)
+                added.append((text, position))
+        removed = [paragraph_id for matches in old.values()
+                   for paragraph_id, _ in matches]
+        db.delete_paragraphs(removed)
+        db.update_paragraph_positions(moved)
+        if added:
+            embeddings = get_model().encode([text for text, _ in added])
+            db.insert_paragraphs_bulk(
+                [(page_id, text, to_blob(embedding, 'float32'), position)
+                 for (text, position), embedding in zip(added, embeddings)])
+        return len(added)
 
 
 class WikiPage:
@@ -391,11 +948,18 @@ class WikiPage:
     Includes methods to extract data and save it to the DB, such as
     page name, description, paragraph text, internal links and languages.
 
+    The page HTML can be passed in when it was already downloaded, for example
+    by a Fetcher; otherwise it is downloaded on load. The content is extracted
+    in a single pass over the html (see extract.py); the bs4 soup is only
+    built when it is accessed.
     """
-    def __init__(self, page_name: str, lang_code: str):
+    def __init__(self, page_name: str, lang_code: str, html: str = None):
         self.page_name = page_name
         self.lang_code = lang_code
-        self.soup = None
+        self.html = html
+        self.extracted = None
+        self._soup = None
+        self.redirect_target = None
         self.paragraphs = None
         self.shortdescription = None
         self.url = None
@@ -403,35 +967,60 @@ class WikiPage:
         self.load()
 
     def load(self):
-        """Get the page's url, download the soup and extract the paragraphs."""
+        """
+        Get the page's url, download the soup and extract the paragraphs.
+        The html is read from the page store first, see fetch_page_html.
+        """
         self.url = self.get_html_url()
-        self.soup = self.download_soup()
+        if self.html is None:
+            self.html = self.download_html()
+        self.extracted = extract_page(self.html)
         self.paragraphs = self.get_paragraphs_text()
         self.shortdescription = self.get_shortdescription()
+        self.redirect_target = self.get_redirect_target()
 
     def __repr__(self):
         return f"<WikiPage {self.page_name}>"
 
+    @property
+    def soup(self) -> bs4.BeautifulSoup:
+        """The parsed html as a bs4 soup, built on first access."""
+        import bs4
+        if self._soup is None:
+            self._soup = bs4.BeautifulSoup(self.html, features="html.parser")
+        return self._soup
+
+    @classmethod
+    def iter_pages(cls, items, fetcher: Fetcher, revalidate: bool = False):
+        """
+        Download a batch of pages concurrently and yield them as WikiPage
+        objects in completion order.
+
+        Args:
+            items: Iterable of (page_name, lang_code) tuples.
+            fetcher (Fetcher): The fetcher used to download the pages.
+            revalidate (bool): Revalidate the stored pages even if fresh.
+        """
+        for page_name, lang_code, html in fetcher.fetch_html(items,
+                                                             revalidate):
+            yield cls(page_name, lang_code=lang_code, html=html)
+
     def get_html_url(self):
         """Format the URL with the language code and page name."""
-        return (
-            f'https://api.wikimedia.org/core/v1/wikipedia/'
-            f'{self.lang_code}/page/{self.page_name}/html'
-        )
+        return html_url(self.page_name, self.lang_code)
+
+    def download_html(self) -> str:
+        """Request a Wikipedia url and return the html text."""
+        return fetch_page_html(self.page_name, self.lang_code)
 
     def download_soup(self) -> bs4.BeautifulSoup:
         """"
         Request a Wikipedia url
         and return the parsed html page as a bs4 soup.
         """
-        try:
-            response = requests.get(self.url, headers=headers, timeout=180)
-            soup = bs4.BeautifulSoup(response.text, features="html.parser")
-        except requests.exceptions.ConnectionError as e:
-            logger.info(str(e))
-        except requests.exceptions.ReadTimeout as e:
-            logger.info(str(e))
-        return soup
+        import bs4
+        return bs4.BeautifulSoup(self.download_html(),
+                                 features="html.parser")
 
     def save_page_name(self, sim_score):
         """
@@ -440,13 +1029,19 @@ class WikiPage:
         self.page_id = db.insert_page_metadata(self.page_name, self.lang_code,
                                                self.url, sim_score)
 
+    def get_redirect_target(self):
+        """
+        Return the canonical title of the page served for this page name,
+        if the page name is a redirect to it, or None.
+        """
+        title = self.extracted.title
+        if title and canonical_title(title) != canonical_title(self.page_name):
+            return canonical_title(title)
+        return None
+
     def get_shortdescription(self) -> str:
         """Extract the short description."""
-        try:
-            shortdescr = self.soup.find('div', class_='shortdescription').text
-        except AttributeError:
-            shortdescr = 'no_shortdescription'
-        return shortdescr
+        return self.extracted.shortdescription
 
     def get_paragraphs_text(self) -> list:
         """
@@ -454,38 +1049,14 @@ class WikiPage:
 
         Constraints: minimum words: 5. Alphabetic characters ratio: 75%.
         """
-
-        def get_alpha_ratio(string: str) -> float:
-            """Calculate the ratio of alphabetic characters in a string."""
-            alpha_n = [ch for ch in string if ch.isalpha()]
-            alpha_ratio = len(alpha_n) / len(string)
-            return alpha_ratio
-
-        paragraphs = []
-        for p in self.soup.find_all('p'):
-            p_text = p.text
-            if len(p_text.split()) > 5 and get_alpha_ratio(p_text) > .75:
-                paragraphs.append(p_text)
-        return paragraphs
+        return list(self.extracted.paragraphs)
 
     def get_internal_page_names(self) -> list:
         """
         Extract all unique links from the page's content.
         Specifically, get all hrefs from <a> tags in <p> elements.
         """
-        # List of characters or words to ignore when collecting page names
-        exclude = ['#', '%', ':', '=', 'File:', 'Help:', 'List_of']
-        hrefs = set()
-        for p in self.soup.find_all('p'):
-            for a in p.find_all('a'):
-                try:
-                    href = a.get('href')
-                    if href.startswith('.') \
-                        and not any(e in href for e in exclude):
-                        hrefs.add(href[2:])
-                except AttributeError:
-                    continue
-        return list(hrefs)
+        return list(self.extracted.internal_page_names)
 
     def get_languages(self) -> list:
         """
@@ -497,12 +1068,7 @@ class WikiPage:
         Refer to: https://api.wikimedia.org/wiki/Core_REST_API/
                   Reference/Pages/Get_languages
         """
-        url = (
-            f'https://api.wikimedia.org/core/v1/wikipedia/{self.lang_code}'
-            f'/page/{self.page_name}/links/language'
-        )
-        response = requests.get(url, headers=headers, timeout=180)
-        languages = response.json()
+        languages = fetch_page_languages(self.page_name, self.lang_code)
         return languages
 
 
@@ -521,6 +1087,7 @@ class PagesGraph:
         self.lang_code = lang_code
         self.lang_codes = LANG_CODES
         self.sim_threshold = sim_threshold
+        self.fetcher = get_fetcher()
 
     def load(self):
         self.build_page_links()
@@ -532,31 +1099,36 @@ class PagesGraph:
         """Use the page names in page table to build the page_links data."""
         logger.info('Building page_links corpus...')
         pages = db.get_pages_data(self.sim_threshold, self.lang_code)
-        page_id_dict = {name: id_ for id_, name, _, _ in pages}
+        page_id_dict = {canonical_title(name): id_ for id_, name, _, _ in pages}
+        titles = TitleIndex(redirects=db.get_redirects(self.lang_code))
 
-        links_page_ids = db.get_page_links_page_ids()
+        unlinked_pages = [(page_name, self.lang_code)
+                          for _, page_name, _, _
+                          in db.get_unlinked_pages(self.sim_threshold,
+                                                   self.lang_code)]
         n = 0
-        for page_id, page_name, _, _ in pages:
-            if page_id in links_page_ids:
-                continue
-            wp = WikiPage(page_name, self.lang_code)
-            new_page_names = wp.get_internal_page_names()
-            for new_page_name in new_page_names:
-                if new_page_name not in page_id_dict:
-                    continue
-                target_page_id = page_id_dict[new_page_name]
-                db.insert_page_link(page_id, target_page_id)
-                n += 1
+        with db.BulkWriter(db.PAGE_LINK_INSERT) as links:
+            for wp in WikiPage.iter_pages(unlinked_pages, self.fetcher):
+                page_id = page_id_dict[canonical_title(wp.page_name)]
+                new_page_names = wp.get_internal_page_names()
+                for new_page_name in new_page_names:
+                    new_page_name = titles.resolve(new_page_name)
+                    if new_page_name not in page_id_dict:
+                        continue
+                    target_page_id = page_id_dict[new_page_name]
+                    links.add((page_id, target_page_id))
+                    n += 1
         logger.info(f'Added {n} page_links')
 
     def read_page_links(self) -> pd.DataFrame:
         """Read the page_links data."""
-        page_links = db.get_page_links_data(self.lang_code)
         columns = [
             's_page_id', 's_page_name', 's_page_sim_score',
             't_page_id', 't_page_name'
             ]
-        df = pd.DataFrame(page_links, columns=columns)
+        df = read_dataframe(db.page_links_data_chunks(self.lang_code),
+                            columns)
+        logger.info(f'Read {len(df)} page_links from page_links table')
         return df
 
     def _filter(
@@ -581,6 +1153,7 @@ class PagesGraph:
         Returns:
             pd.DataFrame: Filtered relationship dataframe.
         """
+        import pandas as pd
         df = df.drop(columns=['s_page_id', 't_page_id'])
         df.columns = ['source', 'sim_score', 'target']
         df['sim_score'] = df['sim_score'].astype(float)
@@ -602,6 +1175,7 @@ class PagesGraph:
         return df
 
     def build_graph(self, df) -> nx.Graph:
+        import networkx as nx
         # rd = pd.read_csv('data/csv/role_attrs.csv')
         # role_colors = dict(zip(rd['role'], rd['color']))
         # role_types = dict(zip(rd['role'], rd['type']))
@@ -640,6 +1214,7 @@ class PagesGraph:
         return G
 
     def draw_graph(self, df) -> None:
+        from pyvis.network import Network
         net = Network(
             height="1800px",
             width="100%",